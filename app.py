@@ -1,3 +1,4 @@
+import hmac
 import os
 import logging
 from flask import Flask, request, abort, jsonify
@@ -8,6 +9,7 @@ from utils.verify import verify_challenge, verify_x_hub_signature
 from utils.event_bus import EventBus
 from utils.idempotency import SeenCache
 from utils.mongo_client import MongoDB
+from utils.metrics import metrics
 
 # ✅ Import from handler (correct folder)
 from handler.send_message import send_text_reply
@@ -19,6 +21,10 @@ logger = logging.getLogger("whatsapp-webhook")
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "")
 APP_SECRET = os.getenv("APP_SECRET", "")
+# Bearer token for /metrics; the endpoint is off while unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Bearer token Vercel Cron sends to /tasks/session-expiry; the endpoint is off while unset
+CRON_SECRET = os.getenv("CRON_SECRET", "")
 
 app = Flask(__name__)
 
@@ -70,6 +76,24 @@ def home():
 def health():
     return jsonify(status="ok"), 200
 
+@app.get("/metrics")
+def metrics_snapshot():
+    if not METRICS_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    return jsonify(metrics.snapshot()), 200
+
+@app.get("/tasks/session-expiry")
+def session_expiry_sweep():
+    """Serverless deployments have no background processor; a cron request runs one sweep."""
+    if not CRON_SECRET:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {CRON_SECRET}"):
+        abort(401)
+    from handler.session_expiry import run_expiry_sweep
+    return jsonify(summarized=run_expiry_sweep()), 200
+
 
 # --- Routes ---
 @app.get("/webhook/whatsapp")
@@ -0,0 +1,42 @@
+"""
+Offline Redis for benchmarks: installs a fakeredis-backed utils.redis_client
+and counts network round trips (one per packed command write).
+"""
+import sys
+import types
+
+import fakeredis
+
+_client = fakeredis.FakeStrictRedis(decode_responses=True)
+_conn_cls = _client.connection_pool.connection_class
+round_trips = [0]
+
+_send = _conn_cls.send_packed_command
+def _counting_send(self, *args, **kwargs):
+    round_trips[0] += 1
+    return _send(self, *args, **kwargs)
+_conn_cls.send_packed_command = _counting_send
+
+
+class RedisClient:
+    def __init__(self):
+        self.client = _client
+
+    def get_client(self):
+        return self.client
+
+
+def install():
+    """Replace utils.redis_client before service modules import it."""
+    mod = types.ModuleType("utils.redis_client")
+    mod.RedisClient = RedisClient
+    sys.modules["utils.redis_client"] = mod
+    _client.ping()  # connection handshake is not part of a turn
+    return _client
+
+
+def count(fn, *args, **kwargs):
+    """Run fn and return (result, round trips it made)."""
+    before = round_trips[0]
+    result = fn(*args, **kwargs)
+    return result, round_trips[0] - before
@@ -0,0 +1,81 @@
+"""
+Recall / latency / build-time / memory of each knowledge-index kind on a
+synthetic clustered corpus (unit vectors, inner product), against exact search.
+
+    python -m benchmarks.ann_indexes [--n 10000,100000] [--dim 384] [--k 3] [--queries 500] [--kinds flat,hnsw]
+
+1M vectors at dim 1536 is ~6 GB of float32; use a smaller --dim for the largest sizes.
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from prompt_engine.ann_index import INDEX_KINDS, apply_search_params, build_ann_index, normalize
+from utils.config import knowledge_index as index_config
+from utils.metrics import percentile
+
+
+def synthetic_corpus(n, dim, n_queries, clusters=256, seed=0):
+    """Gaussian mixture: real embeddings are clustered, which is what IVF/HNSW exploit."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    def sample(count):
+        labels = rng.integers(0, clusters, count)
+        return normalize(centers[labels] + 0.6 * rng.standard_normal((count, dim), dtype=np.float32))
+    return sample(n), sample(n_queries)
+
+
+def index_bytes(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def run(kind, corpus, queries, truth, k):
+    start = time.perf_counter()
+    index = apply_search_params(build_ann_index(corpus, **{**index_config, "kind": kind}), **index_config)
+    build_s = time.perf_counter() - start
+
+    latencies, hits = [], 0
+    for q, expected in zip(queries, truth):
+        t0 = time.perf_counter()
+        _, ids = index.search(q.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        hits += len(set(ids[0]) & set(expected))
+    return {
+        "kind": kind,
+        "actual": type(index).__name__,
+        "build_s": build_s,
+        "mb": index_bytes(index) / 1e6,
+        "recall": hits / (len(queries) * k),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--n", default="10000,100000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--kinds", default=",".join(INDEX_KINDS))
+    args = parser.parse_args(argv)
+
+    for n in (int(v) for v in args.n.split(",")):
+        corpus, queries = synthetic_corpus(n, args.dim, args.queries)
+        exact = faiss.IndexFlatIP(args.dim)
+        exact.add(corpus)
+        _, truth = exact.search(queries, args.k)
+
+        print(f"\nn={n} dim={args.dim} k={args.k} queries={args.queries}")
+        print(f"  {'kind':<9} {'index':<26} {'build s':>8} {'MB':>8} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for kind in args.kinds.split(","):
+            r = run(kind, corpus, queries, truth, args.k)
+            print(f"  {r['kind']:<9} {r['actual']:<26} {r['build_s']:>8.2f} {r['mb']:>8.1f} {r['recall']:>7.3f}"
+                  f" {r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Hit quality and latency of each retrieval mode on a labeled query set.
+
+    python -m benchmarks.hybrid_retrieval [--embedder local|openai] [--threshold 0.8]
+
+Builds a throwaway index of the knowledge JSONL with the chosen embedder
+(local by default, so it runs offline) and reports hit@1, hit@3, MRR, latency
+percentiles and how many queries needed an embedding call.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.embedders import make_embedder
+from utils.config import retrieval as retrieval_config
+from utils.metrics import percentile
+
+EVAL_PATH = "benchmarks/data/retrieval_eval.jsonl"
+K = 3
+
+
+def evaluate(knowledge, embedder, rows, mode):
+    calls = [0]
+
+    def embed(text):
+        calls[0] += 1
+        return embedder.embed([text])[0]
+
+    hit1 = hit3 = rr = 0.0
+    latencies = []
+    for row in rows:
+        start = time.perf_counter()
+        ids = knowledge.retrieve_ids(row["query"], embed, K, mode)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        situations = [knowledge.data[i]["situation"] for i in ids]
+        if row["situation"] in situations:
+            rank = situations.index(row["situation"]) + 1
+            hit1 += rank == 1
+            hit3 += 1
+            rr += 1.0 / rank
+    n = len(rows)
+    return {"hit@1": hit1 / n, "hit@3": hit3 / n, "mrr": rr / n, "embed_calls": calls[0],
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retrieval mode comparison")
+    parser.add_argument("--embedder", choices=("local", "openai"), default="local")
+    parser.add_argument("--threshold", type=float, default=retrieval_config["lexical_short_circuit"])
+    parser.add_argument("--eval", default=EVAL_PATH)
+    args = parser.parse_args(argv)
+
+    with open(args.eval, "r", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    embedder = make_embedder(args.embedder)
+    with tempfile.TemporaryDirectory() as tmp:
+        knowledge_dir = os.path.join(tmp, "knowledge")
+        stats = indexer.build_index(embedder.embed, embedder.name, docs_dir=None, knowledge_dir=knowledge_dir)
+        knowledge = ki.KnowledgeIndex.load(ki.version_dir(stats["version"], knowledge_dir))
+        # Warm lazy structures so latency reflects steady state
+        knowledge.retrieve_ids("warm up", lambda t: embedder.embed([t])[0], K, "hybrid")
+
+        print(f"{len(rows)} labeled queries, embedder={embedder.name}, k={K}")
+        print(f"  {'mode':<28} {'hit@1':>6} {'hit@3':>6} {'mrr':>6} {'embeds':>7} {'p50 ms':>8} {'p95 ms':>8}")
+        configs = [("vector", "vector", None), ("lexical", "lexical", None),
+                   ("hybrid (always fuse)", "hybrid", 1.01), (f"hybrid (short-circuit {args.threshold})", "hybrid", args.threshold)]
+        original = retrieval_config["lexical_short_circuit"]
+        try:
+            for label, mode, threshold in configs:
+                retrieval_config["lexical_short_circuit"] = threshold if threshold is not None else original
+                r = evaluate(knowledge, embedder, rows, mode)
+                print(f"  {label:<28} {r['hit@1']:>6.2f} {r['hit@3']:>6.2f} {r['mrr']:>6.2f} {r['embed_calls']:>7}"
+                      f" {r['p50']:>8.3f} {r['p95']:>8.3f}")
+        finally:
+            retrieval_config["lexical_short_circuit"] = original
+
+
+if __name__ == "__main__":
+    main()
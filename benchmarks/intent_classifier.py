@@ -0,0 +1,60 @@
+"""
+Offline accuracy and latency of the local intent classifier on a held-out set.
+
+    python -m benchmarks.intent_classifier [eval.jsonl]
+"""
+import json
+import sys
+import time
+from collections import Counter
+
+from prompt_engine.intent_classifier import EXAMPLES_PATH, IntentClassifier
+from utils.metrics import percentile
+
+EVAL_PATH = "benchmarks/data/intent_eval.jsonl"
+
+
+def _texts(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return {json.loads(line)["text"].strip().lower() for line in f if line.strip()}
+
+
+def training_overlap(path=EVAL_PATH, examples_path=EXAMPLES_PATH):
+    """Eval texts that are also training examples; a held-out set must have none."""
+    return sorted(_texts(path) & _texts(examples_path))
+
+
+def main(path=EVAL_PATH):
+    overlap = training_overlap(path)
+    if overlap:
+        sys.exit(f"{path} repeats training examples: {overlap}")
+    start = time.perf_counter()
+    clf = IntentClassifier.from_jsonl()
+    build_ms = (time.perf_counter() - start) * 1000.0
+
+    with open(path, "r", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    latencies, correct, confusion = [], 0, Counter()
+    for row in rows:
+        t0 = time.perf_counter()
+        predicted, _ = clf.classify(row["text"])
+        latencies.append((time.perf_counter() - t0) * 1e6)
+        correct += predicted == row["intent"]
+        if predicted != row["intent"]:
+            confusion[(row["intent"], predicted)] += 1
+
+    print(f"build: {build_ms:.1f} ms for {len(clf.intents)} intents")
+    print(f"accuracy: {correct}/{len(rows)} = {correct / len(rows):.1%}")
+    for intent in clf.intents:
+        total = sum(1 for r in rows if r["intent"] == intent)
+        missed = sum(n for (gold, _), n in confusion.items() if gold == intent)
+        if total:
+            print(f"  {intent:<12} recall {(total - missed) / total:.0%} ({total})")
+    for (gold, predicted), n in confusion.most_common():
+        print(f"  confused {gold} -> {predicted}: {n}")
+    print(f"latency us: p50 {percentile(latencies, 50):.0f}, p99 {percentile(latencies, 99):.0f}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,80 @@
+"""
+Per-turn knowledge-index cost: reading faiss_index.bin + vectors.pkl on every
+turn (old prompt_LLM) versus the process-wide memory-mapped singleton.
+
+    python -m benchmarks.knowledge_index_load [n_vectors] [turns]
+
+Uses a synthetic index of n_vectors x 1536 (text-embedding-3-small) in a temp dir.
+"""
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from prompt_engine import knowledge_index as ki
+from prompt_engine.indexer import set_current_version
+from prompt_engine.metadata_store import write_store
+from utils.metrics import percentile
+
+DIM = 1536
+
+
+def legacy_turn(index_path, vectors_path):
+    index = faiss.read_index(index_path)
+    with open(vectors_path, "rb") as f:
+        data = pickle.load(f)
+    return index, data
+
+
+def singleton_turn():
+    return ki.get_knowledge_index()
+
+
+def timed(fn, turns):
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples
+
+
+def main(n_vectors=20000, turns=50):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        index_path = os.path.join(tmp, "faiss_index.bin")
+        vectors_path = os.path.join(tmp, "vectors.pkl")
+        index = faiss.IndexFlatL2(DIM)
+        index.add(rng.standard_normal((n_vectors, DIM), dtype=np.float32))
+        faiss.write_index(index, index_path)
+        records = [{"situation": f"s{i}", "tone": "calming", "response": f"r{i}"} for i in range(n_vectors)]
+        with open(vectors_path, "wb") as f:
+            pickle.dump(records, f)
+        version_path = ki.version_dir("bench", os.path.join(tmp, "knowledge"))
+        os.makedirs(version_path)
+        faiss.write_index(index, os.path.join(version_path, ki.INDEX_FILE))
+        write_store(records, os.path.join(version_path, ki.METADATA_FILE))
+        with open(os.path.join(version_path, ki.MANIFEST_FILE), "w") as f:
+            json.dump({"model": "synthetic", "dim": DIM}, f)
+        del index
+
+        ki.KNOWLEDGE_DIR = os.path.dirname(version_path)
+        set_current_version("bench")
+
+        legacy = timed(lambda: legacy_turn(index_path, vectors_path), turns)
+        singleton = timed(singleton_turn, turns)
+
+    size_mb = n_vectors * DIM * 4 / 1e6
+    print(f"index: {n_vectors} x {DIM} float32 ({size_mb:.0f} MB), {turns} turns")
+    for name, samples in (("load per turn", legacy), ("shared singleton", singleton)):
+        print(f"  {name:<17} p50 {percentile(samples, 50):9.3f} ms  p95 {percentile(samples, 95):9.3f} ms"
+              f"  first {samples[0]:9.3f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
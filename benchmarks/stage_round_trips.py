@@ -0,0 +1,164 @@
+"""
+Redis round trips per turn for the stage engine, before and after the
+table-driven rewrite, plus trigger-matcher timing. The last two columns count
+all of a turn's metadata traffic (stage, quota reservation and settlement, the
+post-turn low-token check): per-call helpers versus one UserSession.
+
+    python -m benchmarks.stage_round_trips
+"""
+import re
+import time
+
+from benchmarks import _fake_redis
+
+redis = _fake_redis.install()
+
+from handler.session import UserSession  # noqa: E402
+from service.redis import (  # noqa: E402
+    detect_tools_r, get_remaining_tokens, get_tools_r, get_user_detail_r, get_user_stage_r, get_user_stage_step_r,
+    reserve_tokens_r, set_user_stage_r, settle_tokens_r,
+)
+from prompt_engine.user_stage import (  # noqa: E402
+    TOOLS_TRIGGERS, detect_tools_trigger, find_stage, load_stage_state, max_step, save_stage_state,
+)
+
+USER = "bench-user"
+KEY = f"user:{USER}:metadata"
+
+# (user batch, bot reply) for one walk through every stage
+SCRIPT = [
+    ("Hey there", "Hey! I'm Flank."),
+    ("my sister keeps reading my messages", "That sounds really frustrating."),
+    ("yeah it makes me so angry", "What bothers you most about it?"),
+    ("that she doesn't trust me", "What would trust look like for you?"),
+    ("honestly i'm stuck, what should i do", "Let's try an I-statement. [tool_name=I-statements]"),
+    ("ok", "Step one: name the feeling."),
+    ("i feel hurt", "Great. Step two: the need."),
+    ("i need privacy", "Nice work."),
+    ("thanks", "Want to check in later?"),
+    ("sure", "Take care!"),
+]
+
+LEGACY_PATTERNS = [r"\b%s\b" % re.escape(p) for p in TOOLS_TRIGGERS]
+
+
+def legacy_find_stage(user_id, current_stage, text):
+    if current_stage == "initial":
+        return "Greeting", 1
+    if current_stage == "Greeting":
+        return "Validation", 1
+    if current_stage == "Validation":
+        return "Reflection", 1
+    if any(re.search(p, text.lower().strip()) for p in LEGACY_PATTERNS) and current_stage in ["Reflection", "Next Steps"]:
+        return "Tools", 1
+    stage_step = int(get_user_stage_step_r(user_id))
+    if current_stage == "Reflection" and stage_step > max_step[current_stage]:
+        return "Tools", 1
+    if current_stage == "Tools" and stage_step > max_step[current_stage]:
+        return "Next Steps", 1
+    return current_stage, stage_step + 1
+
+
+def legacy_turn(text, reply):
+    """The stage bookkeeping prompt_LLM did per turn before the rewrite."""
+    if "Hello" in text or "Hi" in text or "Hey" in text:
+        set_user_stage_r(USER, "initial", 1)
+    stage = get_user_stage_r(USER)
+    if stage is None:
+        set_user_stage_r(USER, "Greeting")
+    curr_stage, stage_step = legacy_find_stage(USER, stage, text)
+    set_user_stage_r(USER, curr_stage, stage_step)
+    redis.hgetall(KEY)  # plan lookup for model routing
+    if curr_stage == "Tools":
+        get_tools_r(USER)
+    detect_tools_r(reply, USER)
+    return curr_stage
+
+
+def table_turn(text, reply):
+    state = load_stage_state(USER)
+    curr_stage, stage_step = find_stage(state, text)
+    save_stage_state(USER, state, curr_stage, stage_step, reply)
+    return curr_stage
+
+
+PROMPT_TOKENS, MAX_TOKENS, USED_TOKENS = 400, 300, 550
+
+
+def helpers_turn(text, reply):
+    """A whole turn's metadata traffic through the per-call helpers."""
+    state = load_stage_state(USER)
+    curr_stage, stage_step = find_stage(state, text)
+    granted = reserve_tokens_r(USER, PROMPT_TOKENS, MAX_TOKENS)
+    save_stage_state(USER, state, curr_stage, stage_step, reply)
+    settle_tokens_r(USER, PROMPT_TOKENS + granted, USED_TOKENS)
+    get_remaining_tokens(get_user_detail_r(USER))
+    return curr_stage
+
+
+def session_turn(text, reply):
+    """The same turn through one UserSession: a read, the reservation, a flush."""
+    session = UserSession.load(USER)
+    state = load_stage_state(USER, session)
+    curr_stage, stage_step = find_stage(state, text)
+    granted = session.reserve_tokens(PROMPT_TOKENS, MAX_TOKENS)
+    save_stage_state(USER, state, curr_stage, stage_step, reply, session)
+    session.settle_tokens(PROMPT_TOKENS + granted, USED_TOKENS)
+    get_remaining_tokens(session.fields())
+    session.flush()
+    return curr_stage
+
+
+def run(turn_fn):
+    redis.delete(KEY)
+    redis.hset(KEY, mapping={"stage": "initial", "tool_name": "None", "subscription_plan": "PROMO_FLANK_BASIC",
+                             "token_limit": 100000, "token_used": 0})
+    stages, trips = [], []
+    for text, reply in SCRIPT:
+        stage, n = _fake_redis.count(turn_fn, text, reply)
+        stages.append(stage)
+        trips.append(n)
+    return stages, trips
+
+
+def time_matchers(rounds=20000):
+    texts = [t for t, _ in SCRIPT]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in texts:
+            any(re.search(p, t.lower().strip()) for p in LEGACY_PATTERNS)
+    legacy = (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for t in texts:
+            detect_tools_trigger(t)
+    compiled = (time.perf_counter() - start) / (rounds * len(texts)) * 1e6
+    return legacy, compiled
+
+
+def main():
+    legacy_stages, legacy_trips = run(legacy_turn)
+    table_stages, table_trips = run(table_turn)
+    _, helper_trips = run(helpers_turn)
+    _, session_trips = run(session_turn)
+
+    print(f"{'turn':<5}{'legacy stage':<14}{'trips':>6}   {'table stage':<14}{'trips':>6}   "
+          f"{'turn: helpers':>13}{'session':>9}")
+    for i, (ls, lt, ts, tt, ht, st) in enumerate(
+            zip(legacy_stages, legacy_trips, table_stages, table_trips, helper_trips, session_trips), 1):
+        print(f"{i:<5}{ls:<14}{lt:>6}   {ts:<14}{tt:>6}   {ht:>13}{st:>9}")
+
+    def mean(trips):
+        return sum(trips) / len(trips)
+
+    print(f"mean round trips/turn: legacy {mean(legacy_trips):.1f}, table {mean(table_trips):.1f}; "
+          f"whole turn: helpers {mean(helper_trips):.1f}, session {mean(session_trips):.1f}")
+
+    legacy_us, compiled_us = time_matchers()
+    print(f"trigger match: {len(LEGACY_PATTERNS)} regexes {legacy_us:.2f} us/msg, "
+          f"single alternation {compiled_us:.2f} us/msg")
+
+
+if __name__ == "__main__":
+    main()
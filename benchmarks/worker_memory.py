@@ -0,0 +1,177 @@
+"""
+Per-worker memory of the knowledge stack under gunicorn, by mode and worker count.
+
+    python -m benchmarks.worker_memory [--vectors 50000] [--dim 384] [--workers 1 2 4] [--modes copy mmap preload]
+
+Modes:
+- copy:    no preload, index read into each worker's heap (no mmap).
+- mmap:    no preload, files opened with the mmap flags (the metadata store is
+           mapped; FAISS 1.8 still reads flat indexes into the heap).
+- preload: gunicorn.conf.py preload — loaded in the master, gc.freeze(), forked.
+
+Each run serves a synthetic index of --vectors x --dim through this module's
+WSGI app (hybrid retrieval per request) and reads /proc/<pid>/smaps_rollup.
+PSS splits shared pages between the processes mapping them, so total PSS is
+what the workers really cost together. Linux only.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_DIR = "WORKER_MEMORY_DIR"
+ENV_COPY = "WORKER_MEMORY_COPY"
+
+# ------------------ WSGI app (imported by gunicorn) ------------------
+app = None
+if os.getenv(ENV_DIR):
+    import faiss
+
+    from prompt_engine import knowledge_index as ki
+
+    ki.KNOWLEDGE_DIR = os.environ[ENV_DIR]
+    if os.getenv(ENV_COPY) == "1":
+        ki.READ_FLAGS = faiss.IO_FLAG_READ_ONLY
+    # Without preload every worker imports this module and loads its own copy here
+    ki.warm_knowledge_index()
+
+    _rng = np.random.default_rng(os.getpid())
+
+    def app(environ, start_response):
+        knowledge = ki.get_knowledge_index()
+        query = _rng.standard_normal(knowledge.index.d).astype(np.float32)
+        ids = knowledge.retrieve_ids("user feels guilty about a friend", lambda _: query, 3, "hybrid")
+        body = json.dumps({"pid": os.getpid(), "ids": ids}).encode("utf-8")
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+
+# ------------------ harness ------------------
+def build_synthetic(path, n_vectors, dim):
+    from prompt_engine import knowledge_index as ki
+    from prompt_engine.ann_index import build_ann_index
+    from prompt_engine.indexer import set_current_version, write_partitions
+    from prompt_engine.metadata_store import write_store
+    from utils.config import knowledge_partitions as partition_config
+    import faiss
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((n_vectors, dim), dtype=np.float32)
+    tones = sorted({t for routed in partition_config["stage_routes"].values() for t in routed})
+    records = [{"situation": f"user situation {i % 997} friend guilty {i % 13}", "tone": tones[i % len(tones)],
+                "response": f"response {i}"} for i in range(n_vectors)]
+    version_path = ki.version_dir("synthetic", path)
+    os.makedirs(version_path)
+    faiss.write_index(build_ann_index(vectors, "flat"), os.path.join(version_path, ki.INDEX_FILE))
+    write_store(records, os.path.join(version_path, ki.METADATA_FILE))
+    hashes = [str(i) for i in range(n_vectors)]
+    write_partitions(vectors, records, hashes, {"kind": "flat"}, os.path.join(version_path, ki.PARTITIONS_SUBDIR))
+    with open(os.path.join(version_path, ki.MANIFEST_FILE), "w") as f:
+        json.dump({"model": "synthetic", "dim": dim}, f)
+    set_current_version("synthetic", path)
+
+
+def memory_kb(pid) -> dict:
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    return fields
+
+
+def children(pid) -> list:
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces; fields after it are space separated
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            found.append(int(entry))
+    return found
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(mode, workers, data_dir, requests_per_worker=50) -> dict:
+    port = free_port()
+    env = dict(os.environ, **{ENV_DIR: data_dir, "GUNICORN_PRELOAD": "1" if mode == "preload" else "0",
+                              ENV_COPY: "1" if mode == "copy" else "0", "WEB_CONCURRENCY": str(workers),
+                              "GUNICORN_THREADS": "1", "PYTHONPATH": ROOT})
+    cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+           "-b", f"127.0.0.1:{port}", "--log-level", "warning", "benchmarks.worker_memory:app"]
+    master = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    try:
+        url = f"http://127.0.0.1:{port}/"
+        deadline = time.time() + 120
+        seen = set()
+        while time.time() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as r:
+                    seen.add(json.loads(r.read())["pid"])
+                if len(children(master.pid)) >= workers:
+                    break
+            except OSError:
+                time.sleep(0.2)
+        for _ in range(requests_per_worker * workers):
+            with urllib.request.urlopen(url, timeout=10) as r:
+                seen.add(json.loads(r.read())["pid"])
+
+        worker_pids = children(master.pid)
+        per_worker = [memory_kb(pid) for pid in worker_pids]
+        master_mem = memory_kb(master.pid)
+    finally:
+        master.terminate()
+        master.wait(30)
+
+    def avg(field):
+        return sum(m.get(field, 0) for m in per_worker) / max(1, len(per_worker)) / 1024
+
+    return {
+        "mode": mode, "workers": len(per_worker), "served_by": len(seen),
+        "rss_mb": avg("Rss"), "pss_mb": avg("Pss"), "private_mb": avg("Private_Dirty") + avg("Private_Clean"),
+        "total_pss_mb": (sum(m.get("Pss", 0) for m in per_worker) + master_mem.get("Pss", 0)) / 1024,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-worker RSS/PSS under gunicorn")
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", default=["copy", "mmap", "preload"],
+                        choices=["copy", "mmap", "preload"])
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build_synthetic(tmp, args.vectors, args.dim)
+        print(f"index: {args.vectors} x {args.dim} float32 ({args.vectors * args.dim * 4 / 1e6:.0f} MB) + metadata")
+        print(f"  {'mode':<8} {'workers':>7} {'RSS/worker':>11} {'PSS/worker':>11} {'private/worker':>15} "
+              f"{'total PSS':>10}  (MB)")
+        for mode in args.modes:
+            for workers in args.workers:
+                r = run(mode, workers, tmp)
+                print(f"  {r['mode']:<8} {r['workers']:>7} {r['rss_mb']:>11.1f} {r['pss_mb']:>11.1f} "
+                      f"{r['private_mb']:>15.1f} {r['total_pss_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
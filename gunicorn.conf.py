@@ -0,0 +1,67 @@
+"""
+Gunicorn settings:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+With preload (the default, GUNICORN_PRELOAD=0 turns it off) the app is imported
+once in the master, which also loads the knowledge index, its BM25 postings and
+partitions, the intent classifier and the tokenizer, then calls gc.freeze() so
+the collector never writes to those objects. Forked workers share all of it
+copy-on-write instead of each loading a copy. (The metadata store is
+memory-mapped and shared through the page cache either way; FAISS only maps
+index types that support it, which excludes the flat index.)
+
+    python -m benchmarks.worker_memory    # per-worker RSS / PSS by mode and worker count
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3001')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# The debouncer and prefetchers run on threads inside each worker
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    """Runs in the master after the (pre)loaded app, before the first fork."""
+    if not preload_app:
+        return
+    from prompt_engine.intent_classifier import get_intent_classifier
+    from prompt_engine.knowledge_index import KnowledgeIndexUnavailable, warm_knowledge_index
+    from utils.tokens import count_tokens
+
+    try:
+        knowledge = warm_knowledge_index()
+        server.log.info("Preloaded knowledge index: %d vectors", knowledge.index.ntotal)
+    except KnowledgeIndexUnavailable as e:
+        server.log.warning("Knowledge index not preloaded: %s", e)
+    try:
+        get_intent_classifier()
+    except (OSError, ValueError) as e:
+        server.log.warning("Intent classifier not preloaded: %s", e)
+    count_tokens("warm up the tokenizer")
+
+    # Everything allocated so far is permanent: keep the collector off those pages
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # A MongoClient must not be shared across fork; the worker opens its own on first use
+    from utils.mongo_client import MongoDB
+
+    MongoDB.reset()
+
+    # Every worker runs a session-expiry processor; one at a time holds the lease and claims work
+    from handler.session_expiry import start_session_expiry
+
+    start_session_expiry()
+
+
+def worker_exit(server, worker):
+    # Hand the leader lease over now rather than when it lapses
+    from handler.session_expiry import stop_session_expiry
+
+    stop_session_expiry()
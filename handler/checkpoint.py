@@ -0,0 +1,56 @@
+import hashlib
+import logging
+
+from service.redis import get_turn_checkpoint_r, set_turn_checkpoint_r
+
+logger = logging.getLogger("handlers")
+
+# Pipeline steps of one flushed batch, in order
+TURN_STEPS = ("persist", "llm", "bookkeeping", "send")
+CHECKPOINT_TTL = 3600
+
+
+def batch_hash(ws_id, combined, convo_str) -> str:
+    """
+    Content hash identifying a flushed batch.
+    WhatsApp message ids are stable across redeliveries, so they are used when every
+    message has one; otherwise the batch text is hashed with the nonce the debouncer
+    stamped on the batch, so the same text sent again later is a new batch while a
+    retry of this one (same list) still matches.
+    """
+    ids = [m.get("message_id") for m in combined]
+    if ids and all(ids):
+        material = "|".join(ids)
+    else:
+        material = f"{combined[0].get('batch_nonce', '') if combined else ''}\n{convo_str}"
+    return hashlib.sha256(f"{ws_id}\n{material}".encode("utf-8")).hexdigest()[:32]
+
+
+class TurnCheckpoint:
+    """
+    Per-batch record of finished pipeline steps (and their outputs) in Redis,
+    so a retried batch resumes after the last finished step.
+    """
+
+    def __init__(self, ws_id, batch_id, ttl=CHECKPOINT_TTL):
+        self.ws_id = ws_id
+        self.batch_id = batch_id
+        self.ttl = ttl
+        self._fields = get_turn_checkpoint_r(ws_id, batch_id) or {}
+        if self._fields:
+            logger.info(f"Resuming batch {batch_id} for user {ws_id} after {self.last_step()}")
+
+    def done(self, step) -> bool:
+        return self._fields.get(f"{step}_done") == "1"
+
+    def get(self, field, default=None):
+        return self._fields.get(field, default)
+
+    def last_step(self):
+        finished = [s for s in TURN_STEPS if self.done(s)]
+        return finished[-1] if finished else None
+
+    def mark(self, step, **data):
+        fields = {f"{step}_done": "1", **{k: str(v) for k, v in data.items()}}
+        set_turn_checkpoint_r(self.ws_id, self.batch_id, fields, self.ttl)
+        self._fields.update(fields)
@@ -1,55 +1,117 @@
 from datetime import datetime
+import logging
 import threading
 from collections import defaultdict
 import re
+import uuid
+
+from utils.config import speculation
+
+logger = logging.getLogger("handlers")
 
 # Store messages per ws_id
 message_buffer = defaultdict(list)
 is_forwared_buffer = defaultdict(list)
+message_id_buffer = defaultdict(list)
 timers = {}
+speculation_timers = {}
 
-def sequence_message(ws_id, process_message):
-    """Called when user stops sending messages."""
+# Silence after the last message before the batch is processed
+DEBOUNCE_SECONDS = 5
+
+# A failed batch is re-run (resuming from its checkpoints) after 2s, 4s, ...
+PROCESS_MAX_ATTEMPTS = 3
+PROCESS_RETRY_DELAY = 2
+
+def run_with_retry(ws_id, process_message, combined, convo_str, attempt=1):
+    """Run process_message; on failure re-schedule the same batch a bounded number of times."""
+    try:
+        process_message(ws_id, combined, convo_str)
+    except Exception as e:
+        if attempt >= PROCESS_MAX_ATTEMPTS:
+            logger.exception("Giving up on batch for %s after %d attempts: %s", ws_id, attempt, e)
+            return
+        delay = PROCESS_RETRY_DELAY * attempt
+        logger.warning("Batch for %s failed (%s); retrying in %ss", ws_id, e, delay)
+        threading.Timer(delay, run_with_retry, args=(ws_id, process_message, combined, convo_str, attempt + 1)).start()
+
+def combine_buffer(ws_id):
+    """(combined batch, convo_str) for what is buffered now; the buffers are left as they are."""
     combined = []
+    message_ids = message_id_buffer[ws_id] or [None] * len(message_buffer[ws_id])
     if ws_id in is_forwared_buffer and any(is_forwared_buffer[ws_id]):
-        convo, convo_str = [], ''
-        for item1, item2 in zip(message_buffer[ws_id], is_forwared_buffer[ws_id]):
+        convo_str = ''
+        for item1, item2, msg_id in zip(message_buffer[ws_id], is_forwared_buffer[ws_id], message_ids):
             if item2:
-                convo.append({"message":item1,"role":"third-forwarded", "timestamp": datetime.utcnow(),})
+                combined.append({"message":item1,"role":"third-forwarded", "timestamp": datetime.utcnow(), "message_id": msg_id})
                 convo_str += f"third-forwarded: {item1}\n"
             else:
                 convo_str += f"user-forwarded: {item1}\n"
-                convo.append({"message":item1,"role":"user-forwarded","timestamp": datetime.utcnow(),})
-            
-            combined.extend(convo)
+                combined.append({"message":item1,"role":"user-forwarded","timestamp": datetime.utcnow(), "message_id": msg_id})
     else:
         convo_str = f"user: {' '.join(message_buffer[ws_id])}\n"
-        for msg in message_buffer[ws_id]:
-            combined.append({"message": msg,"role": "user"})
+        for msg, msg_id in zip(message_buffer[ws_id], message_ids):
+            combined.append({"message": msg,"role": "user", "message_id": msg_id})
+    return combined, convo_str
+
+def sequence_message(ws_id, process_message):
+    """Called when user stops sending messages."""
+    combined, convo_str = combine_buffer(ws_id)
+    # Identifies this flush for checkpointing when messages lack ids; retries reuse it
+    batch_nonce = uuid.uuid4().hex
+    for message in combined:
+        message["batch_nonce"] = batch_nonce
 
     is_forwared_buffer[ws_id].clear()  # Clear after processing
     message_buffer[ws_id].clear()  # Clear after processing
+    message_id_buffer[ws_id].clear()
 
-    process_message(ws_id, combined, convo_str)
+    run_with_retry(ws_id, process_message, combined, convo_str)
 
-def schedule_processing(ws_id, process_message):
-    """Wait 1 second after last message, then process."""
+def schedule_processing(ws_id, process_message, speculate=None):
+    """
+    Process after DEBOUNCE_SECONDS of silence. With `speculate`, the batch so far
+    is also handed to speculate(ws_id, combined, convo_str) after the shorter
+    speculation idle_seconds, so its reply can be ready at the flush.
+    """
     def delayed():
         sequence_message(ws_id, process_message)
         timers.pop(ws_id, None)
 
     if ws_id in timers:
         timers[ws_id].cancel()  # Cancel old timer if new message arrived
+    if ws_id in speculation_timers:
+        speculation_timers.pop(ws_id).cancel()
 
-    timer = threading.Timer(5, delayed)
+    timer = threading.Timer(DEBOUNCE_SECONDS, delayed)
     timers[ws_id] = timer
     timer.start()
 
-def debouncer_message(ws_id, message, process_message, is_forwarded=False):
-    """Simulate receiving a message from a user."""
+    if speculate is not None and speculation["idle_seconds"] < DEBOUNCE_SECONDS:
+        def early():
+            speculation_timers.pop(ws_id, None)
+            speculate(ws_id, *combine_buffer(ws_id))
+
+        early_timer = threading.Timer(speculation["idle_seconds"], early)
+        speculation_timers[ws_id] = early_timer
+        early_timer.start()
+
+def debouncer_message(ws_id, message, process_message, is_forwarded=False, message_id=None, on_update=None,
+                      speculate=None):
+    """
+    Simulate receiving a message from a user. `on_update(ws_id, convo_str)` is
+    told what the batch would look like if it flushed now, so work can start
+    during the wait; `speculate` is passed on to schedule_processing.
+    """
     is_forwared_buffer[ws_id].append(is_forwarded)
+    message_id_buffer[ws_id].append(message_id)
     cleaned = re.sub(r'[ ]+', ' ', message)       # collapse spaces
     cleaned = re.sub(r'\n+', ' ', cleaned)    # collapse multiple newlines to one
     cleaned = cleaned.strip()
     message_buffer[ws_id].append(cleaned)
-    schedule_processing(ws_id, process_message)
\ No newline at end of file
+    if on_update is not None:
+        try:
+            on_update(ws_id, combine_buffer(ws_id)[1])
+        except Exception as e:
+            logger.warning("Debounce update hook failed for %s: %s", ws_id, e)
+    schedule_processing(ws_id, process_message, speculate)
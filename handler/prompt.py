@@ -1,127 +1,344 @@
 import os
-import json
-import pickle
 import re
-import faiss
-import numpy as np
 import openai
 import logging
+import threading
+import time
+from typing import NamedTuple
 
-from service.redis import detect_tools_r, set_user_stage_r
+from service.redis import (
+    add_speculation_waste_r, get_conversation_turns, get_speculation_waste_r
+)
+from utils.config import embedding_cache, long_term_memory, rag_prefetch, retrieval, speculation, token_quota
+from utils.embedding_cache import EmbeddingCache
+from utils.metrics import metrics
+from utils.prefetch import Prefetcher
+from utils.resilience import OPENAI_TRANSIENT, CircuitOpenError, call_with_resilience
+from utils.token_profile import record_prompt_profile
+from utils.tokens import estimate_prompt_tokens
 
 logger = logging.getLogger("handlers")
 
-from prompt_engine.user_stage import build_messages, find_stage, get_user_stage
+from handler.session import UserSession
+from prompt_engine.conversation import turns_from_batch
+from prompt_engine.embedders import embedder_for_model, get_embedder
+from prompt_engine.indexer import build_index
+from prompt_engine.knowledge_index import KnowledgeIndexUnavailable, get_knowledge_index, reload_knowledge_index
+from prompt_engine.memory import recall
+from prompt_engine.model_routing import get_stage_route
+from prompt_engine.user_stage import (
+    StageState, build_message_segments, find_stage, load_stage_state, save_stage_state
+)
 
 # ------------------ CONFIG ------------------
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# Retries are owned by utils.resilience so they share breakers and budgets
+openai.max_retries = 0
 
-PROMPT_PATH = "prompt_engine/prompt.txt"
-JSONL_PATH = "prompt_engine/emotional_support_knowledge.jsonl"
-INDEX_PATH = "prompt_engine/faiss_index.bin"
-VECTORS_PATH = "prompt_engine/vectors.pkl"
-EMBED_MODEL = "text-embedding-3-small"
+# Tried when the routed model is unavailable
+FALLBACK_MODEL = "gpt-4o-mini"
+OVER_QUOTA_REPLY = "You've used all the tokens in your plan. Please upgrade your plan to keep chatting."
+
+embedder = get_embedder()
+
+def embed_text(text):
+    """Embed one text with the configured backend."""
+    return embedder.embed([text])[0]
+
+def embed_texts(texts):
+    """Embed a batch of texts in one call (order preserved)."""
+    return embedder.embed(texts)
+
+# Remote queries repeat a lot ("I don't know", "what should I do"); the local
+# backend is cheaper than a cache lookup. Index builds bypass the cache.
+query_embeddings = EmbeddingCache(embed_text, embedder.name, **embedding_cache) if embedder.remote else None
+if query_embeddings is not None:
+    metrics.register_collector("embedding_cache", query_embeddings.stats)
+
+def embed_query(text):
+    if query_embeddings is None:
+        return embed_text(text)
+    return query_embeddings.get(text)
+
+# Query embeddings started while the debouncer waits, so retrieval after the flush is a local search
+query_prefetch = Prefetcher(embed_query, "rag", rag_prefetch["workers"], rag_prefetch["wait_seconds"],
+                            ttl_seconds=rag_prefetch["ttl_seconds"])
+
+def prefetch_context(user_id, convo_str):
+    """Debouncer hook: embed the batch-so-far; a newer message supersedes it."""
+    if not (rag_prefetch["enabled"] and retrieval["enabled"]) or retrieval["mode"] == "lexical":
+        return
+    query_prefetch.submit(user_id, convo_str)
 
 # ------------------ FAISS INDEX ------------------
 def build_faiss_index_jsonl():
-    """Load FAISS index + data if exists, otherwise build from JSONL."""
-    if os.path.exists(INDEX_PATH) and os.path.exists(VECTORS_PATH):
-        index = faiss.read_index(INDEX_PATH)
-        with open(VECTORS_PATH, "rb") as f:
-            data = pickle.load(f)
-        print("✅ FAISS JSONL index loaded")
-        return index, data
-
-    # Build index from scratch
-    data = []
-    texts = []
-    if not os.path.exists(JSONL_PATH):
-        raise FileNotFoundError(f"{JSONL_PATH} not found. Add your JSONL RAG knowledge.")
-
-    with open(JSONL_PATH, "r") as f:
-        for line in f:
-            obj = json.loads(line.strip())
-            data.append(obj)
-            texts.append(f"{obj['situation']} - {obj['response']}")
-
-    embeddings = []
-    for t in texts:
-        emb = openai.embeddings.create(model=EMBED_MODEL, input=t).data[0].embedding
-        embeddings.append(np.array(emb, dtype=np.float32))
-
-    dim = len(embeddings[0])
-    index = faiss.IndexFlatL2(dim)
-    index.add(np.vstack(embeddings))
-
-    os.makedirs(os.path.dirname(VECTORS_PATH), exist_ok=True)
-    faiss.write_index(index, INDEX_PATH)
-    with open(VECTORS_PATH, "wb") as f:
-        pickle.dump(data, f)
-
+    """Incrementally rebuild the knowledge index (offline) and swap it into this process."""
+    build_index(embed_texts, embedder.name)
+    knowledge = reload_knowledge_index()
     print("✅ FAISS JSONL index built")
-    return index, data
+    return knowledge.index, knowledge.data
+
+def retrieve_context_jsonl(query, knowledge=None, top_k=3, stage=None, user_id=None):
+    """
+    Retrieve top-k emotional responses for the query, from the partitions routed for `stage`.
+    With `user_id`, an embedding prefetched during the debounce window is used if it matches.
+    Queries are embedded by the model that built the served index version, which
+    differs from the configured one while an embedding-model migration rolls out.
+    """
+    knowledge = knowledge or get_knowledge_index()
+    prefetched = query_prefetch.take(user_id, query) if user_id is not None else None
+
+    if knowledge.model and knowledge.model != embedder.name:
+        index_embedder = embedder_for_model(knowledge.model)
+
+        def embed_fn(text):
+            return index_embedder.embed([text])[0]
+    else:
+        def embed_fn(text):
+            return prefetched if prefetched is not None and text == query else embed_query(text)
+
+    return "\n".join(r['response'] for r in knowledge.retrieve(query, embed_fn, top_k, stage=stage))
+
+def retrieve_context(user_id, query, stage):
+    """Knowledge-base context for the turn's stage; retrieval problems never block a reply."""
+    if not retrieval["enabled"] or not query:
+        return ""
+    try:
+        return retrieve_context_jsonl(query, top_k=retrieval["top_k"], stage=stage, user_id=user_id)
+    except KnowledgeIndexUnavailable as e:
+        logger.warning(f"RAG disabled: {e}")
+    except Exception as e:
+        logger.warning(f"RAG retrieval failed for {user_id}: {e}")
+        metrics.incr("rag.errors")
+    return ""
+
+def recall_memories(user_id, query):
+    """Long-term memories relevant to this batch; memory problems never block a reply."""
+    if not long_term_memory["enabled"]:
+        return []
+    try:
+        return recall(user_id, query, embed_query, embedder.name)
+    except Exception as e:
+        logger.warning(f"Long-term memory unavailable for {user_id}: {e}")
+        return []
+
+def record_llm_turn(user_id, stage, model, latency_ms, response):
+    """Log and export per-stage latency and token usage so the routing table can be tuned."""
+    usage = response.usage
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    finish_reason = getattr(response.choices[0], "finish_reason", None)
+
+    metrics.observe("llm.latency_ms", latency_ms, stage=stage, model=model)
+    metrics.observe("llm.prompt_tokens", prompt_tokens, stage=stage, model=model)
+    metrics.observe("llm.completion_tokens", completion_tokens, stage=stage, model=model)
+    if finish_reason == "length":
+        # Reply hit max_tokens: the stage cap may be too tight
+        metrics.incr("llm.truncated", stage=stage, model=model)
+
+    logger.info(
+        "llm_turn user=%s stage=%s model=%s latency_ms=%.0f prompt_tokens=%s completion_tokens=%s finish=%s",
+        user_id, stage, model, latency_ms, prompt_tokens, completion_tokens, finish_reason,
+    )
+
+
+class PreparedTurn(NamedTuple):
+    """Everything decided before the model call; a speculative reply carries the one it used."""
+    state: StageState
+    curr_stage: str
+    stage_step: int
+    segments: list
+    route: dict
+    prompt_tokens: int
 
-def retrieve_context_jsonl(query, index, data, top_k=3):
-    """Retrieve top-k emotional responses for the query."""
-    q_emb = openai.embeddings.create(model=EMBED_MODEL, input=query).data[0].embedding
-    D, I = index.search(np.array([q_emb], dtype=np.float32), top_k)
-    return "\n".join([data[i]['response'] for i in I[0]])
+    @property
+    def messages(self):
+        return [m for _, m in self.segments]
 
+def prepare_turn(turns, current_convo, state: StageState, memories=(), user_id=None) -> PreparedTurn:
+    """Stage transition, chat messages (with the stage's RAG context) and model route for a turn; no writes."""
+    curr_stage, stage_step = find_stage(state, current_convo)
+    context = retrieve_context(user_id, current_convo, curr_stage)
+    segments = build_message_segments(turns, curr_stage, stage_step, state.tool_name, memories, context)
+    route = get_stage_route(curr_stage, state.plan)
+    prompt_tokens = estimate_prompt_tokens([m for _, m in segments], route["model"])
+    return PreparedTurn(state, curr_stage, stage_step, segments, route, prompt_tokens)
+
+# ------------------ SPECULATIVE REPLIES ------------------
+class SpeculativeReply(NamedTuple):
+    prepared: PreparedTurn
+    history: tuple      # (role, text) of the turns the prompt was built from
+    answer: str
+    total_tokens: int
+    completion_tokens: int
+    latency_ms: float
+
+speculation_stats = {"generated": 0, "committed": 0, "wasted": 0, "wasted_tokens": 0, "latency_saved_ms": 0.0}
+_speculation_lock = threading.Lock()
+
+def _count_speculation(**deltas):
+    with _speculation_lock:
+        for name, value in deltas.items():
+            speculation_stats[name] += value
+
+def speculation_report():
+    """Commit rate against the latency committed replies saved and the tokens discarded ones cost."""
+    with _speculation_lock:
+        stats = dict(speculation_stats)
+    finished = stats["committed"] + stats["wasted"]
+    stats["commit_rate"] = stats["committed"] / finished if finished else None
+    stats["avg_latency_saved_ms"] = stats["latency_saved_ms"] / stats["committed"] if stats["committed"] else None
+    return stats
+
+metrics.register_collector("speculation", speculation_report)
+
+def waste_speculation(reply, reason="superseded"):
+    """A speculative reply that won't be sent: its tokens go to the plan's waste, never to the user."""
+    if reply is None:
+        return
+    plan = reply.prepared.state.plan
+    add_speculation_waste_r(plan, reply.total_tokens)
+    _count_speculation(wasted=1, wasted_tokens=reply.total_tokens)
+    metrics.incr("speculation.wasted", reason=reason, plan=plan or "default")
+    metrics.incr("speculation.wasted_tokens", reply.total_tokens, plan=plan or "default")
+
+def _speculate(convo_str, user_id, combined):
+    state = load_stage_state(user_id)
+    caps = speculation["daily_waste_cap"]
+    if get_speculation_waste_r(state.plan) >= caps.get(state.plan, caps["default"]):
+        metrics.incr("speculation.skipped", reason="waste_cap", plan=state.plan or "default")
+        return None
+
+    # The batch isn't persisted until the flush; build the prompt as if it were
+    turns = get_conversation_turns(user_id) + turns_from_batch(combined)
+    prepared = prepare_turn(turns, convo_str, state, recall_memories(user_id, convo_str), user_id)
+    start = time.perf_counter()
+    response = call_with_resilience(
+        "openai-chat", openai.chat.completions.create,
+        model=prepared.route["model"],
+        messages=prepared.messages,
+        temperature=prepared.route["temperature"],
+        max_tokens=prepared.route["max_tokens"],
+        retry_on=OPENAI_TRANSIENT,
+    )
+    latency_ms = (time.perf_counter() - start) * 1000.0
+    record_llm_turn(user_id, prepared.curr_stage, prepared.route["model"], latency_ms, response)
+    _count_speculation(generated=1)
+    return SpeculativeReply(
+        prepared, tuple((t["role"], t["text"]) for t in turns),
+        response.choices[0].message.content.strip(), response.usage.total_tokens,
+        getattr(response.usage, "completion_tokens", 0) or 0, latency_ms,
+    )
+
+speculative_replies = Prefetcher(_speculate, "llm", speculation["workers"], speculation["wait_seconds"],
+                                 on_discard=waste_speculation, ttl_seconds=speculation["ttl_seconds"])
+
+def speculate_reply(user_id, combined, convo_str):
+    """Debouncer hook at the early idle threshold: generate the reply for the batch so far."""
+    if combined:
+        speculative_replies.submit(user_id, convo_str, user_id, combined)
+
+def discard_speculation(user_id):
+    """The user kept typing: whatever was generated for the shorter batch is wasted."""
+    speculative_replies.discard(user_id)
+
+def take_speculation(user_id, current_convo, turns, state: StageState):
+    """The speculative reply for exactly this batch, history and stage state, or None."""
+    if not speculation["enabled"]:
+        return None
+    start = time.perf_counter()
+    reply = speculative_replies.take(user_id, current_convo)
+    if reply is None:
+        return None
+    history = tuple((t["role"], t["text"]) for t in turns)
+    # Windowed reads may start at different turns; the newest ones must agree
+    n = min(len(history), len(reply.history))
+    if reply.prepared.state != state or history[len(history) - n:] != reply.history[len(reply.history) - n:]:
+        waste_speculation(reply, "stale")
+        return None
+    saved = max(0.0, reply.latency_ms - (time.perf_counter() - start) * 1000.0)
+    _count_speculation(committed=1, latency_saved_ms=saved)
+    metrics.observe("speculation.latency_saved_ms", saved, stage=reply.prepared.curr_stage)
+    return reply
 
 # ------------------ MAIN PROMPT FUNCTION ------------------
-def prompt_LLM(user_id, conversation, current_convo=""):
-    print(f"💬 Prompting model for user {user_id}", conversation)
-
-    # Load RAG / FAISS
-    index, data = build_faiss_index_jsonl()
-
-    # Retrieve top relevant emotional support responses
-    # context_text = retrieve_context_jsonl(conversation, index, data)
-    # print(f"🧠 Retrieved RAG context for user {user_id}:", context_text)
-
-    if "Hello" in current_convo or "Hi" in current_convo or "Hey" in current_convo:
-        set_user_stage_r(user_id, "initial", 1)
-    elif "<1>" in conversation:
-        set_user_stage_r(user_id, "Greeting", 1)
-    # Load refined prompt
-    if not os.path.exists(PROMPT_PATH):
-        raise FileNotFoundError(f"{PROMPT_PATH} not found. Add refined prompt.txt.")
-    with open(PROMPT_PATH, "r") as f:
-        system_prompt = f.read()
-
-    # Append RAG context to system prompt
-    # system_prompt += f"\n\nRelevant emotional context from knowledge base:\n{context_text}"
-
-    # Prompting stages
-    stage = get_user_stage(user_id)
-    logger.info(f"User {user_id} at old stage {stage}")
-    curr_stage, stage_step = find_stage(user_id, stage, current_convo)
-    logger.info(f"User {user_id} at stage {curr_stage}")
-    set_user_stage_r(user_id, curr_stage, stage_step)
-
-    # Build the chat messages
-    message = build_messages(conversation, curr_stage, stage_step,user_id)
-
-    logger.info(f"User {user_id} at stage {curr_stage}")
-    # Attempt GPT-4o-mini can add fallback logic here
-    model_list = ["gpt-4o-mini"]
-    for model_name in model_list:
+def prompt_LLM(user_id, turns, current_convo="", session=None):
+    """
+    Answer the newest batch; `turns` is the conversation as turn records (oldest first).
+    Metadata reads and writes go through the turn's `session`; without one the
+    function loads and flushes its own.
+    """
+    if session is None:
+        session = UserSession.load(user_id)
         try:
-            response = openai.chat.completions.create(
-                model=model_name,
-                messages=message,
-                temperature=0.8,
-                max_tokens=300
-            )
-
-            total_tokens = response.usage.total_tokens
-            answer = response.choices[0].message.content.strip()
-            detect_tools_r(answer,user_id)
-            return answer, total_tokens
-        except openai.error.InvalidRequestError as e:
-            print(f"⚠️ Model {model_name} unavailable, trying next. {str(e)}")
-        except openai.error.OpenAIError as e:
-            print(f"⚠️ OpenAI API error: {str(e)}")
-            break
+            return prompt_LLM(user_id, turns, current_convo, session)
+        finally:
+            session.flush()
+
+    print(f"💬 Prompting model for user {user_id} with {len(turns)} turns")
+
+    # Prompting stages: one read, table-driven transition, one write after the reply
+    state = load_stage_state(user_id, session)
+    logger.info(f"User {user_id} at old stage {state.stage}")
+    speculative = take_speculation(user_id, current_convo, turns, state)
+    prepared = speculative.prepared if speculative else prepare_turn(
+        turns, current_convo, state, recall_memories(user_id, current_convo), user_id)
+    curr_stage, stage_step, route = prepared.curr_stage, prepared.stage_step, prepared.route
+    message, prompt_tokens = prepared.messages, prepared.prompt_tokens
+    logger.info(f"User {user_id} at stage {curr_stage} routed to {route}")
+    record_prompt_profile(curr_stage, route["model"], prepared.segments)
+
+    # Reserve quota before any network call; reject turns that can't fit
+    granted = session.reserve_tokens(prompt_tokens, route["max_tokens"], token_quota["min_completion_tokens"])
+    if granted == 0:
+        logger.info(f"User {user_id} over quota (estimated prompt {prompt_tokens} tokens)")
+        metrics.incr("quota.rejected", stage=curr_stage)
+        waste_speculation(speculative, "over_quota")
+        return OVER_QUOTA_REPLY, 0
+    max_tokens = granted or route["max_tokens"]
+    reserved = prompt_tokens + granted if granted else 0
+
+    if speculative and speculative.completion_tokens > max_tokens:
+        # Generated before the quota check; a reply the user couldn't afford isn't sent
+        waste_speculation(speculative, "over_quota")
+        speculative = None
+    if speculative:
+        save_stage_state(user_id, state, curr_stage, stage_step, speculative.answer, session)
+        session.settle_tokens(reserved, speculative.total_tokens)
+        return speculative.answer, speculative.total_tokens
+
+    model_list = [route["model"]]
+    if route["model"] != FALLBACK_MODEL:
+        model_list.append(FALLBACK_MODEL)
+    try:
+        for model_name in model_list:
+            try:
+                start = time.perf_counter()
+                response = call_with_resilience(
+                    "openai-chat", openai.chat.completions.create,
+                    model=model_name,
+                    messages=message,
+                    temperature=route["temperature"],
+                    max_tokens=max_tokens,
+                    retry_on=OPENAI_TRANSIENT,
+                )
+                record_llm_turn(user_id, curr_stage, model_name, (time.perf_counter() - start) * 1000.0, response)
+
+                total_tokens = response.usage.total_tokens
+                answer = response.choices[0].message.content.strip()
+                # Only advance the flow for turns we answered
+                save_stage_state(user_id, state, curr_stage, stage_step, answer, session)
+                session.settle_tokens(reserved, total_tokens)
+                reserved = 0
+                return answer, total_tokens
+            except CircuitOpenError as e:
+                logger.warning(f"⚠️ {e}")
+                break
+            except Exception as e:
+                logger.warning(f"⚠️ Model {model_name} failed, trying next. {str(e)}")
+    finally:
+        if reserved:
+            # Nothing was billed: hand the reservation back
+            session.settle_tokens(reserved, 0)
 
     return "Sorry, the model is temporarily unavailable. Please try again later.", 0
@@ -1,12 +1,16 @@
 import logging
 import asyncio
-from handler.prompt import prompt_LLM
+from handler.prompt import OVER_QUOTA_REPLY, discard_speculation, prefetch_context, prompt_LLM, speculate_reply
+from handler.checkpoint import TurnCheckpoint, batch_hash
 from handler.debouncer import debouncer_message
 from handler.send_message import send_text_reply
+from handler.session import UserSession
 from handler.summarize_user import summarize_user_session
 from service.auth import get_user_details, handle_new_user
 from service.mongo import store_user_conversation_m, update_user_token_usage
-from service.redis import append_conversation_redis, get_user_detail_r, update_token_usage_redis
+from prompt_engine.conversation import ASSISTANT, make_turn, turns_from_batch
+from service.redis import append_conversation_redis, get_conversation_turns, get_remaining_tokens
+from utils.config import speculation, token_quota
 
 logger = logging.getLogger("handlers")
 
@@ -14,6 +18,7 @@ def extract_payload(payload):
     """Main handler for incoming WhatsApp messages."""
     msg = payload.get("message", {})
     user_id = msg.get("from")
+    message_id = msg.get("id")
     type_ = msg.get("type")
     text = msg.get("text", {}).get("body", "").strip() if type_ == "text" else None
 
@@ -37,41 +42,89 @@ def extract_payload(payload):
                 or ctx.get("is_forwarded") \
                 or (ctx.get("forwarding_score", 0) > 0)
     
-    return user_id, text, is_forwarded
+    return user_id, text, is_forwarded, message_id
 
-def post_prompt_tasks(total_tokens, ws_id, response):
+def claim_low_token_warning(session):
+    """Set the session's low-token flag if the warning is due and unsent; True if this turn sends it."""
+    user_data = session.fields()
+    remaining = get_remaining_tokens(user_data)
+    limit = int(user_data.get('token_limit') or 0)
+    if remaining is None or remaining >= limit * token_quota["low_token_ratio"] or user_data.get('low_token_warned'):
+        return False
+    session.set("low_token_warned", 1)
+    return True
+
+def post_prompt_tasks(total_tokens, ws_id, response, warn_low_tokens=False):
     """Tasks to run after prompting LLM."""
     
-    # Store the response in MongoDB and Redis    
-    append_conversation_redis(ws_id, f"<bot> {response}", ttl_seconds=3600)
-    update_token_usage_redis(ws_id, total_tokens)
+    # Store the response in MongoDB and Redis (Redis usage is settled by prompt_LLM).
+    # The over-quota notice is a system message, not part of the conversation.
+    if response != OVER_QUOTA_REPLY:
+        append_conversation_redis(ws_id, [make_turn(ASSISTANT, response)])
     update_user_token_usage(ws_id,  total_tokens)
 
-    response = get_user_detail_r(ws_id)
-    if response.get('token_used') and response.get('token_limit') and int(response.get('token_limit')) < 20:
+    if warn_low_tokens:
         send_text_reply(ws_id, "Warning: You are running low on tokens. Please consider upgrading your plan.")
     
 
 def process_message(ws_id, combined, convo_str):
-    """Process the combined message after debouncing."""
-    store_user_conversation_m(ws_id, combined)
+    """
+    Process the combined message after debouncing.
+    Each step is checkpointed under the batch hash, so a retry never repeats
+    a finished step (in particular the paid LLM call and token accounting).
+    The user's metadata hash is read once for the turn and written once, before
+    the LLM step is checkpointed: stage, token settlement and the warning flag.
+    """
+    checkpoint = TurnCheckpoint(ws_id, batch_hash(ws_id, combined, convo_str))
+    if checkpoint.done("send"):
+        logger.info(f"Batch {checkpoint.batch_id} for user {ws_id} already answered; skipping")
+        return
+
+    if not checkpoint.done("persist"):
+        store_user_conversation_m(ws_id, combined)
 
-    logger.info(f"Store message in temp_collection for user {ws_id}")
+        logger.info(f"Store message in temp_collection for user {ws_id}")
 
-    # Append to Redis conversation with TTL
-    updated_convo = append_conversation_redis(ws_id, convo_str)
+        # Append the batch as turn records to the Redis conversation
+        append_conversation_redis(ws_id, turns_from_batch(combined))
+        checkpoint.mark("persist")
+    turns = get_conversation_turns(ws_id)
 
-    response, total_tokens = prompt_LLM(ws_id, updated_convo, convo_str)
+    session = UserSession.load(ws_id)
+    answered = checkpoint.done("llm")
+    bookkeeping = not checkpoint.done("bookkeeping")
+    try:
+        if answered:
+            response, total_tokens = checkpoint.get("response"), int(checkpoint.get("total_tokens", 0))
+        else:
+            response, total_tokens = prompt_LLM(ws_id, turns, convo_str, session=session)
+        warn_low_tokens = bookkeeping and claim_low_token_warning(session)
+    finally:
+        # The turn's one write (or whatever a failed step had changed). A retry skips
+        # prompt_LLM, so this lands before the step counts as done.
+        session.flush()
+    if not answered and total_tokens:
+        # Only billed completions are worth keeping; fallbacks get retried
+        checkpoint.mark("llm", response=response, total_tokens=total_tokens)
 
     logger.info(f"Response tokens used: {total_tokens} for user {ws_id}")
 
-    post_prompt_tasks(total_tokens, ws_id, response)
+    if bookkeeping:
+        post_prompt_tasks(total_tokens, ws_id, response, warn_low_tokens)
+        checkpoint.mark("bookkeeping")
+
     send_text_reply(ws_id, response)
+    checkpoint.mark("send")
+
+def on_debounce_update(ws_id, convo_str):
+    """A message joined the batch: a reply speculated for the shorter batch is wasted."""
+    discard_speculation(ws_id)
+    prefetch_context(ws_id, convo_str)
 
 def on_message(payload: dict):
     try:
         """Main handler for incoming WhatsApp messages."""
-        user_id, text, is_forwarded = extract_payload(payload)
+        user_id, text, is_forwarded, message_id = extract_payload(payload)
 
         if "PROMO_FLANK" in text:
             # Add new user to DB
@@ -82,7 +135,9 @@ def on_message(payload: dict):
         get_user_details(user_id)
         
         # Debounce and process message
-        debouncer_message(user_id, text, process_message, is_forwarded)
+        debouncer_message(user_id, text, process_message, is_forwarded, message_id,
+                          on_update=on_debounce_update,
+                          speculate=speculate_reply if speculation["enabled"] else None)
     except RuntimeError as re:
         msg = payload.get("message", {})
         user_id = msg.get("from")
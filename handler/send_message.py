@@ -2,25 +2,59 @@ import os
 import logging
 import requests
 import re
+from urllib3.exceptions import NewConnectionError
+
+from utils.resilience import call_with_resilience, status_of
 
 logger = logging.getLogger("handlers")
 
 # ---------------- WhatsApp API config ----------------
-WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
-PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 GRAPH_URL = "https://graph.facebook.com/v23.0"
+# (connect, read) seconds; the breaker stops slow outages from stalling every turn
+GRAPH_TIMEOUT = (3.05, 10)
+
+
+class GraphAPIError(RuntimeError):
+    """Non-2xx reply from the Graph API; carries status and headers for retry decisions."""
+
+    def __init__(self, status_code, text, headers=None):
+        super().__init__(f"Graph reply error {status_code}: {text}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
 
 def clean_text(text: str) -> str:
     clean = re.sub(r'<bot>\s*', '', re.sub(r'\[tool_name=[^\]]*\]\s*', '', text))
     return clean.strip()
 
+def _post_message(url, headers, payload):
+    r = requests.post(url, headers=headers, json=payload, timeout=GRAPH_TIMEOUT)
+    if r.status_code >= 400:
+        raise GraphAPIError(r.status_code, r.text, getattr(r, "headers", None))
+    return r.json()
+
+def _not_delivered(exc) -> bool:
+    """
+    True only when the Graph API cannot have accepted the message, so sending it
+    again cannot duplicate it: the connection never opened, or the send was throttled.
+    A read timeout or a 5xx may follow a delivered message and is not retried.
+    """
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], "reason", exc.args[0]) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+    return status_of(exc) == 429
+
 def send_text_reply(to: str, text: str):
-    if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
+    whatsapp_token = os.getenv("WHATSAPP_TOKEN")
+    phone_number_id = os.getenv("PHONE_NUMBER_ID")
+    if not whatsapp_token or not phone_number_id:
         raise RuntimeError("Missing WHATSAPP_TOKEN or PHONE_NUMBER_ID")
 
-    url = f"{GRAPH_URL}/{PHONE_NUMBER_ID}/messages"
+    url = f"{GRAPH_URL}/{phone_number_id}/messages"
     headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+        "Authorization": f"Bearer {whatsapp_token}",
         "Content-Type": "application/json",
     }
 
@@ -31,7 +65,5 @@ def send_text_reply(to: str, text: str):
         "type": "text",
         "text": {"body": text},
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=10)
-    if r.status_code >= 400:
-        raise RuntimeError(f"Graph reply error {r.status_code}: {r.text}")
-    return r.json()
+    return call_with_resilience("whatsapp-graph", _post_message, url, headers, payload,
+                                retry_if=_not_delivered)
@@ -0,0 +1,104 @@
+import logging
+
+from service.auth import reload_user_details
+from service.redis import flush_user_metadata_r, get_user_detail_r, has_token_limit, reserve_tokens_r
+from utils.metrics import metrics
+
+logger = logging.getLogger("handlers")
+
+
+class UserSession:
+    """
+    One turn's view of the user's metadata hash: read with a single HGETALL,
+    changed fields and counter deltas kept in memory, written back by flush()
+    in one WATCHed MULTI/EXEC. Reads see the turn's own changes.
+    """
+
+    def __init__(self, user_id, fields=None):
+        self.user_id = user_id
+        self._stored = dict(fields or {})
+        self._changed = {}
+        self._increments = {}
+
+    @classmethod
+    def load(cls, user_id):
+        """
+        The user's hash; one without a token limit (expired, or recreated by a stray
+        write) is reloaded from MongoDB first, so the quota never reads it as unlimited.
+        """
+        fields = get_user_detail_r(user_id)
+        if not has_token_limit(fields):
+            reloaded = reload_user_details(user_id)
+            if reloaded is not None:
+                metrics.incr("session.reloads")
+                logger.info(f"User {user_id} metadata hash was missing its limit; reloaded from MongoDB")
+                fields = reloaded
+        return cls(user_id, fields)
+
+    def get(self, field, default=None):
+        if field in self._changed:
+            return self._changed[field]
+        value = self._stored.get(field)
+        if self._increments.get(field):
+            value = str(int(value or 0) + self._increments[field])
+        return default if value is None else value
+
+    def fields(self) -> dict:
+        """The hash as this turn sees it."""
+        return {field: self.get(field) for field in {*self._stored, *self._changed, *self._increments}}
+
+    def set(self, field, value):
+        self._changed[field] = str(value)
+
+    def update(self, mapping):
+        for field, value in mapping.items():
+            self.set(field, value)
+
+    def incr(self, field, amount):
+        self._increments[field] = self._increments.get(field, 0) + int(amount)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._changed) or any(self._increments.values())
+
+    def reserve_tokens(self, prompt_tokens, max_tokens, min_completion_tokens=20):
+        """reserve_tokens_r against this turn's snapshot; the reservation is written immediately."""
+        granted = reserve_tokens_r(self.user_id, prompt_tokens, max_tokens, min_completion_tokens,
+                                   user_data=self.fields())
+        if granted:
+            self._stored["token_reserved"] = str(int(self._stored.get("token_reserved") or 0)
+                                                 + prompt_tokens + granted)
+        return granted
+
+    def settle_tokens(self, reserved, tokens_used):
+        """Release a reservation and record the tokens actually used, at flush."""
+        self.incr("token_reserved", -reserved)
+        self.incr("token_usage", tokens_used)
+
+    def flush(self):
+        """
+        Write the turn's changes back. A field another writer changed since load()
+        keeps their value (logged); counter deltas always apply. If the hash expired
+        during the turn nothing is written: the next turn reloads it from MongoDB.
+        Returns the fields skipped as conflicting (all of them when expired).
+        """
+        if not self.dirty:
+            return []
+        expected = {field: self._stored.get(field) for field in self._changed}
+        stale = flush_user_metadata_r(self.user_id, self._changed, expected, self._increments)
+        if stale is None:
+            metrics.incr("session.expired_flushes")
+            logger.warning(f"User {self.user_id} metadata expired during the turn; dropped its changes")
+            skipped = sorted({*self._changed, *self._increments})
+            self._stored, self._changed, self._increments = {}, {}, {}
+            return skipped
+        for field in stale:
+            metrics.incr("session.conflicts", field=field)
+        if stale:
+            logger.warning(f"User {self.user_id} metadata changed during the turn; kept newer {stale}")
+
+        self._stored = self.fields()
+        for field in stale:
+            self._stored.pop(field, None)
+        self._changed, self._increments = {}, {}
+        return stale
@@ -0,0 +1,219 @@
+"""
+Session-expiry processor: summarizes a user's session once their metadata expires.
+
+cache_user_detail_r records each session's deadline in a sorted set. Every
+process may run a SessionExpiryProcessor, but only the one holding the leader
+lease claims due sessions, and each claim is atomic, so a session is summarized
+once even if two processes briefly both think they lead. Summaries run on a
+bounded pool and the leader never claims more than it has free workers. A claim
+whose worker died is retried after `claim_timeout_seconds`. Deadlines live in
+Redis, so sessions that expired while nothing was running are picked up on start.
+
+Expired-key events only wake the leader early; nothing depends on receiving them.
+
+    python -m handler.session_expiry    # run the processor on its own
+
+Hosts without a long-running process (Vercel) call run_expiry_sweep() instead,
+from the GET /tasks/session-expiry cron request in app.py.
+
+Metrics: session_expiry.claimed / completed / failed / reclaimed, and the
+session_expiry.leader gauge (1 in the process holding the lease).
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from handler.summarize_user import summarize_user_session
+from service.redis import (
+    claim_due_sessions_r, delete_user_conversation_redis, finish_session_claim_r, hold_lease_r,
+    reclaim_stale_sessions_r, release_lease_r, retry_session_r,
+)
+from utils.config import session_expiry as expiry_config
+from utils.metrics import metrics
+from utils.redis_client import RedisClient
+
+logger = logging.getLogger("handlers")
+
+LEADER_KEY = "sessions:expiry:leader"
+
+
+def expire_session(user_id):
+    """What happens when a session ends: summarize it, then drop the Redis conversation."""
+    summarize_user_session(user_id)
+    delete_user_conversation_redis(user_id)
+
+
+class SessionExpiryProcessor:
+    def __init__(self, handle=expire_session, settings=None):
+        self.handle = handle
+        self.settings = {**expiry_config, **(settings or {})}
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._pool = ThreadPoolExecutor(max_workers=max(1, self.settings["workers"]),
+                                        thread_name_prefix="session-expiry")
+        self._lock = threading.Lock()
+        self._running = set()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._loop, name="session-expiry-leader", daemon=True)]
+        if self.settings["pubsub_hint"]:
+            self._threads.append(threading.Thread(target=self._listen, name="session-expiry-hint", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=self.settings["poll_seconds"] + 1)
+        if self.is_leader:
+            release_lease_r(LEADER_KEY, self.token)
+            self._set_leader(False)
+        # A summary cut short by the process exiting is retried once its claim lapses
+        self._pool.shutdown(wait=wait)
+
+    def wake(self):
+        self._wake.set()
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return len(self._running)
+
+    def tick(self):
+        """One leader step: renew the lease, retry lapsed claims, claim due sessions up to free workers."""
+        self._set_leader(hold_lease_r(LEADER_KEY, self.token, self.settings["lease_seconds"]))
+        if not self.is_leader:
+            return []
+
+        reclaimed = reclaim_stale_sessions_r()
+        if reclaimed:
+            metrics.incr("session_expiry.reclaimed", len(reclaimed))
+            logger.warning(f"Retrying lapsed session-expiry claims: {reclaimed}")
+
+        free = self.settings["workers"] - self.running
+        if free <= 0:
+            return []
+        claimed = claim_due_sessions_r(free, self.settings["claim_timeout_seconds"])
+        for user_id in claimed:
+            with self._lock:
+                self._running.add(user_id)
+            metrics.incr("session_expiry.claimed")
+            self._pool.submit(self._run, user_id)
+        return claimed
+
+    def _set_leader(self, leader):
+        if leader != self.is_leader:
+            logger.info(f"Session expiry: {self.token} {'took' if leader else 'lost'} the leader lease")
+        self.is_leader = leader
+        metrics.gauge("session_expiry.leader", 1 if leader else 0)
+
+    def _run(self, user_id):
+        try:
+            logger.info(f"Session for user {user_id} expired; summarizing.")
+            self.handle(user_id)
+            finish_session_claim_r(user_id)
+            metrics.incr("session_expiry.completed")
+        except Exception as e:
+            logger.exception(f"Session expiry for user {user_id} failed: {e}")
+            metrics.incr("session_expiry.failed")
+            try:
+                retry_session_r(user_id, self.settings["retry_seconds"])
+            except Exception as e:
+                # The claim lapses and is retried after claim_timeout_seconds
+                logger.error(f"Could not reschedule session expiry for user {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+            # A worker is free again
+            self._wake.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Session expiry sweep failed: {e}")
+                self._set_leader(False)
+            self._wake.wait(self.settings["poll_seconds"])
+            self._wake.clear()
+
+    def _listen(self):
+        """Wake on expired metadata keys; a lost subscription is reopened, a missed event costs one poll."""
+        client = RedisClient().get_client()
+        db = client.connection_pool.connection_kwargs.get("db", 0)
+        while not self._stopped.is_set():
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(f"__keyevent@{db}__:expired")
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=self.settings["poll_seconds"])
+                    if not message:
+                        continue
+                    key = message["data"]
+                    if isinstance(key, bytes):
+                        key = key.decode()
+                    if key.startswith("user:") and key.endswith(":metadata") and self.is_leader:
+                        self.wake()
+            except Exception as e:
+                logger.warning(f"Expiry notifications unavailable, polling only: {e}")
+                self._stopped.wait(self.settings["poll_seconds"])
+            finally:
+                pubsub.close()
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def start_session_expiry():
+    """Start this process's processor once (gunicorn post_fork); None when disabled."""
+    global _processor
+    if not expiry_config["enabled"]:
+        return None
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = SessionExpiryProcessor().start()
+    return _processor
+
+
+def run_expiry_sweep(handle=expire_session):
+    """
+    One synchronous sweep: take the lease if free, claim due sessions and
+    summarize them before returning. Returns the user ids handled.
+    """
+    if not expiry_config["enabled"]:
+        return []
+    processor = SessionExpiryProcessor(handle)
+    try:
+        return processor.tick()
+    finally:
+        # Waits for the summaries and hands the lease back
+        processor.stop()
+
+
+def stop_session_expiry():
+    global _processor
+    with _processor_lock:
+        processor, _processor = _processor, None
+    if processor is not None:
+        processor.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    processor = SessionExpiryProcessor().start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        processor.stop()
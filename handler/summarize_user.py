@@ -2,16 +2,22 @@ import datetime
 import logging
 
 import openai
+from prompt_engine.embedders import get_embedder
+from prompt_engine.memory import remember
+from utils.config import long_term_memory
+from utils.resilience import OPENAI_TRANSIENT, call_with_resilience
 from service.mongo import delete_user_conversation_m, get_user_conversation, get_user_detail_m, update_user_summary_m
 
 logger = logging.getLogger("handlers")
 
 def summarize_with_llm(prompt,summary_limit, user_id):
-    response = openai.chat.completions.create(
+    response = call_with_resilience(
+        "openai-chat", openai.chat.completions.create,
         model="gpt-4o-mini",
         messages=[{"role": "system", "content": "You are Flank, a supportive coach."},
                   {"role": "user", "content": prompt}],
-        max_tokens= summary_limit * 50
+        max_tokens= summary_limit * 50,
+        retry_on=OPENAI_TRANSIENT,
     )
     return response.choices[0].message.content.strip() # type: ignore
 
@@ -52,13 +58,24 @@ def summarize_user_session(user_id):
 
         # Call your LLM (if available)
         summary = summarize_with_llm(summary_prompt,summary_limit, user_id=user_id)
+        memorable = True
 
     except Exception as e:
         logger.error(f"❌ LLM summarization failed for {user_id}: {e}")
         # Fallback: generate basic text summary
         summary = f"Summary of conversation for user {user_id}: {conversation[:200]}..."
+        memorable = False
 
     # 3. Store summary back in MongoDB
     update_user_summary_m(user_id, summary)
+
+    # 4. Keep real summaries as long-term memories later sessions can recall
+    if memorable and long_term_memory["enabled"]:
+        try:
+            embedder = get_embedder()
+            remember(user_id, summary, embedder.embed, embedder.name)
+        except Exception as e:
+            logger.error(f"❌ Storing long-term memory failed for {user_id}: {e}")
+
     delete_user_conversation_m(user_id)
     logger.info(f"✅ Stored summary for user {user_id}.")
@@ -0,0 +1,95 @@
+"""
+FAISS index factory for the knowledge base.
+
+OpenAI embeddings are unit length, so vectors are L2-normalised and searched by
+inner product (cosine). Trained index types (IVF*) size their lists from the
+corpus and fall back to an exact index when there is too little data to train.
+"""
+import logging
+import math
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger("handlers")
+
+INDEX_KINDS = ("flat", "ivf_flat", "hnsw", "ivf_sq", "ivf_pq")
+# FAISS warns below ~39 training points per centroid
+MIN_POINTS_PER_LIST = 39
+PQ_NBITS = 8
+
+
+def default_nlist(n: int) -> int:
+    return max(1, int(4 * math.sqrt(n)))
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _pq_m(dim: int, pq_m: int) -> int:
+    """Largest sub-quantizer count <= pq_m that divides dim."""
+    for m in range(min(pq_m, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_ann_index(vectors, kind: str = "flat", nlist: int = None, hnsw_m: int = 32,
+                    ef_construction: int = 80, pq_m: int = 64, **_search_params):
+    """Train (when needed) and fill an inner-product index of `kind` with normalised `vectors`."""
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown index kind {kind!r}; expected one of {INDEX_KINDS}")
+    vectors = normalize(vectors)
+    n, dim = vectors.shape
+
+    if kind.startswith("ivf"):
+        nlist = min(nlist or default_nlist(n), n // MIN_POINTS_PER_LIST)
+        if kind == "ivf_pq" and n < MIN_POINTS_PER_LIST * (1 << PQ_NBITS):
+            logger.info("Too few vectors (%d) to train PQ codebooks; using ivf_sq", n)
+            kind = "ivf_sq"
+        if nlist < 2:
+            logger.info("Too few vectors (%d) to train %s; using flat", n, kind)
+            kind = "flat"
+
+    if kind == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        quantizer = faiss.IndexFlatIP(dim)
+        if kind == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        elif kind == "ivf_sq":
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit,
+                                                  faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m(dim, pq_m), PQ_NBITS,
+                                     faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+
+    index.add(vectors)
+    return index
+
+
+def apply_search_params(index, nprobe: int = 8, ef_search: int = 64, **_build_params):
+    """Set query-time knobs; they are not persisted with the index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def prepare_query(index, vectors) -> np.ndarray:
+    """Queries against an inner-product index are normalised like the corpus."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, index.d)
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return normalize(vectors)
+    return vectors
@@ -0,0 +1,102 @@
+"""
+In-memory BM25 over short knowledge texts, and reciprocal-rank fusion.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+STOPWORDS = frozenset(
+    "a an and are at be but by do for from how i i'm in is it me my of on or so that the their them they "
+    "this to was what when with you your".split()
+)
+
+
+def tokenize(text: str) -> list:
+    """Lowercased words minus stopwords, with a crude plural/gerund strip."""
+    tokens = []
+    for word in _TOKEN_RE.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        for suffix in ("ing", "ed", "s"):
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[: -len(suffix)]
+                break
+        tokens.append(word)
+    return tokens
+
+
+class BM25Index:
+    """
+    Inverted index of term -> (doc ids, term frequencies) as NumPy arrays,
+    so a query costs one vectorised accumulation per query term.
+    """
+
+    def __init__(self, texts, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        docs = [tokenize(t) for t in texts]
+        self.n_docs = len(docs)
+        self.doc_len = np.array([len(d) for d in docs], dtype=np.float32)
+        self.avg_len = float(self.doc_len.mean()) if self.n_docs else 0.0
+
+        postings = defaultdict(lambda: ([], []))
+        for doc_id, tokens in enumerate(docs):
+            for term, tf in Counter(tokens).items():
+                postings[term][0].append(doc_id)
+                postings[term][1].append(tf)
+        self.postings = {
+            term: (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32))
+            for term, (ids, tfs) in postings.items()
+        }
+        self.idf = {
+            term: math.log(1.0 + (self.n_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            for term, (ids, _) in self.postings.items()
+        }
+        # Best achievable score per doc (the doc queried with its own terms): normalises confidence
+        self.self_score = np.zeros(self.n_docs, dtype=np.float32)
+        for term, (ids, tfs) in self.postings.items():
+            self.self_score[ids] += self._term_scores(term, ids, tfs)
+
+    def _score_terms(self, terms) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs = posting
+            scores[ids] += self._term_scores(term, ids, tfs)
+        return scores
+
+    def _term_scores(self, term, ids, tfs) -> np.ndarray:
+        norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[ids] / self.avg_len)
+        return self.idf[term] * tfs * (self.k1 + 1.0) / (tfs + norm)
+
+    def search(self, query: str, top_k: int = 10, mask=None):
+        """
+        [(doc id, score, confidence)] best first. Confidence is the score over the
+        doc's self-score: ~1.0 when the query covers everything the doc says.
+        A boolean `mask` keeps only the docs where it is True.
+        """
+        if not self.n_docs:
+            return []
+        scores = self._score_terms(set(tokenize(query)))
+        if mask is not None:
+            scores[~mask] = 0.0
+        hits = np.flatnonzero(scores > 0)
+        if not len(hits):
+            return []
+        top = hits[np.argsort(-scores[hits], kind="stable")[:top_k]]
+        return [(int(i), float(scores[i]), float(min(1.0, scores[i] / self.self_score[i]))) for i in top]
+
+
+def reciprocal_rank_fusion(rankings, k: int = 60, top_k: int = None) -> list:
+    """Fuse ranked id lists: score(d) = sum 1 / (k + rank). Ties keep first-seen order."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores, key=scores.get, reverse=True)
+    return fused[:top_k] if top_k else fused
@@ -0,0 +1,133 @@
+import json
+import time
+
+from utils.tokens import count_tokens
+
+# Turn roles: the user, the other person in a forwarded exchange, and the bot
+USER, THIRD, ASSISTANT = "user", "third", "assistant"
+
+# Debouncer roles -> (turn role, forwarded)
+BATCH_ROLES = {
+    "user": (USER, False),
+    "user-forwarded": (USER, True),
+    "third-forwarded": (THIRD, True),
+}
+
+# Line prefixes of the plain-text record kept before turn records, longest first
+LEGACY_PREFIXES = (
+    ("third-forwarded:", THIRD, True),
+    ("user-forwarded:", USER, True),
+    ("user:", USER, False),
+    ("<bot>", ASSISTANT, False),
+)
+
+# Prompt history is trimmed to the newest turns that fit this budget
+HISTORY_TOKEN_BUDGET = 1500
+
+
+def make_turn(role, text, forwarded=False, ts=None) -> dict:
+    """A conversation record; its token count is computed once, here."""
+    return {
+        "role": role,
+        "text": text,
+        "ts": int(ts if ts is not None else time.time()),
+        "forwarded": bool(forwarded),
+        "tokens": count_tokens(text),
+    }
+
+
+def turns_from_batch(combined) -> list:
+    """Turn records for a debounced batch (see handler.debouncer.sequence_message)."""
+    turns = []
+    for item in combined:
+        role, forwarded = BATCH_ROLES.get(item.get("role"), (USER, False))
+        turns.append(make_turn(role, item.get("message", ""), forwarded))
+    return turns
+
+
+def encode_turns(turns) -> str:
+    # ASCII-only JSON so a byte-range read can never split a UTF-8 character
+    return "".join(json.dumps(t) + "\n" for t in turns)
+
+
+def decode_turns(blob) -> list:
+    """Parse JSON-lines records, skipping a partial first line from a windowed read."""
+    turns = []
+    for line in (blob or "").splitlines():
+        try:
+            turn = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(turn, dict):
+            turns.append(turn)
+    return turns
+
+
+def parse_legacy_conversation(blob) -> list:
+    """
+    Turn records from a string conversation record: JSON lines as they are, and the
+    older plain text ("user: ..." batches, "<bot> ..." replies) by line prefix. A line
+    without a known prefix continues the previous turn, since replies could span lines.
+    """
+    turns = []
+    for line in (blob or "").splitlines():
+        if not line.strip():
+            continue
+        try:
+            turn = json.loads(line)
+        except ValueError:
+            turn = None
+        if isinstance(turn, dict):
+            turns.append(turn)
+            continue
+        for prefix, role, forwarded in LEGACY_PREFIXES:
+            if line.startswith(prefix):
+                turns.append(make_turn(role, line[len(prefix):].strip(), forwarded))
+                break
+        else:
+            if turns:
+                previous = turns[-1]
+                turns[-1] = make_turn(previous["role"], f"{previous['text']}\n{line}",
+                                      previous.get("forwarded", False), previous.get("ts"))
+            else:
+                turns.append(make_turn(USER, line.strip()))
+    return turns
+
+
+def _user_content(turn) -> str:
+    if turn["role"] == THIRD:
+        return f"Forwarded message from the other person: {turn['text']}"
+    if turn.get("forwarded"):
+        return f"Forwarded message I sent them: {turn['text']}"
+    return turn["text"]
+
+
+def trim_turns(turns, token_budget=HISTORY_TOKEN_BUDGET) -> list:
+    """Newest turns whose cached token counts fit the budget (always keeps the last turn)."""
+    kept, used = [], 0
+    for turn in reversed(turns):
+        tokens = turn.get("tokens") or count_tokens(turn.get("text", ""))
+        if kept and used + tokens > token_budget:
+            break
+        kept.append(turn)
+        used += tokens
+    kept.reverse()
+    return kept
+
+
+def turns_to_messages(turns, token_budget=HISTORY_TOKEN_BUDGET) -> list:
+    """
+    Alternating chat messages: consecutive user/forwarded turns are merged into
+    one user message, bot turns become assistant messages.
+    """
+    messages = []
+    for turn in trim_turns(turns, token_budget):
+        if turn["role"] == ASSISTANT:
+            messages.append({"role": "assistant", "content": turn["text"]})
+            continue
+        content = _user_content(turn)
+        if messages and messages[-1]["role"] == "user":
+            messages[-1]["content"] += "\n" + content
+        else:
+            messages.append({"role": "user", "content": content})
+    return messages
@@ -0,0 +1,166 @@
+"""
+Embedding backends behind one interface.
+
+- OpenAIEmbedder: text-embedding-3-* over the network (batched, resilient).
+- LocalHashEmbedder: hashed word / bigram / char-trigram features, optionally
+  randomly projected to a dense vector. Pure NumPy, no network, deterministic
+  across processes, so tests and benchmarks can exercise retrieval offline.
+
+The backend is chosen by utils.config.embedder. Vectors from different
+backends live in different spaces: `name` keys caches and index manifests.
+"""
+import logging
+import re
+import threading
+import zlib
+
+import numpy as np
+import openai
+
+from utils.config import embedder as embedder_config
+from utils.resilience import OPENAI_TRANSIENT, call_with_resilience
+
+logger = logging.getLogger("handlers")
+
+FEATURE_DIM = 4096
+PROJECTION_SEED = 20240601
+# Above this many texts a dense matmul beats gathering projection rows
+SPARSE_BATCH_MAX = 16
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+def _features(text: str):
+    words = _WORD_RE.findall(text.lower())
+    feats = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for w in words:
+        padded = f" {w} "
+        feats.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return feats
+
+
+def hashed_ngram_weights(texts, dim: int = FEATURE_DIM):
+    """
+    Sparse hashed features for a batch as (rows, cols, weights), sorted by row:
+    log1p counts of words, word bigrams and char 3-grams, L2-normalised per row.
+    crc32 keeps hashes stable across processes (unlike hash()).
+    """
+    keys = []
+    for r, text in enumerate(texts):
+        keys.extend(r * dim + zlib.crc32(f.encode("utf-8")) % dim for f in _features(text))
+    keys, counts = np.unique(np.asarray(keys, dtype=np.int64), return_counts=True)
+    rows, cols = np.divmod(keys, dim)
+    weights = np.log1p(counts).astype(np.float32)
+    norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(texts)))
+    weights /= norms[rows]
+    return rows, cols, weights
+
+
+def hashed_ngram_matrix(texts, dim: int = FEATURE_DIM) -> np.ndarray:
+    """Dense (len(texts), dim) hashed features; empty texts give zero rows."""
+    rows, cols, weights = hashed_ngram_weights(texts, dim)
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    out[rows, cols] = weights
+    return out
+
+
+class OpenAIEmbedder:
+    remote = True
+
+    def __init__(self, model: str = "text-embedding-3-small"):
+        self.model = model
+        self.name = model
+
+    def embed(self, texts) -> np.ndarray:
+        """Embed a batch of texts in one request (order preserved)."""
+        response = call_with_resilience(
+            "openai-embeddings", openai.embeddings.create,
+            model=self.model, input=list(texts), retry_on=OPENAI_TRANSIENT,
+        )
+        data = sorted(response.data, key=lambda d: d.index)
+        return np.asarray([d.embedding for d in data], dtype=np.float32)
+
+
+class LocalHashEmbedder:
+    """
+    Hashed n-gram features, randomly projected to `dim` (a fixed Gaussian
+    matrix, i.e. Johnson-Lindenstrauss) and renormalised.
+    With dim == feature_dim the raw hashed features are returned unprojected.
+    """
+    remote = False
+
+    def __init__(self, dim: int = 384, feature_dim: int = FEATURE_DIM, seed: int = PROJECTION_SEED):
+        self.dim = dim
+        self.feature_dim = feature_dim
+        self.name = f"local-hash-{feature_dim}" + (f"-rp{dim}-{seed}" if dim != feature_dim else "")
+        self.projection = None
+        if dim != feature_dim:
+            rng = np.random.default_rng(seed)
+            self.projection = (rng.standard_normal((feature_dim, dim), dtype=np.float32) / np.sqrt(dim))
+
+    def embed(self, texts) -> np.ndarray:
+        if self.projection is None:
+            return hashed_ngram_matrix(texts, self.feature_dim)
+        if len(texts) > SPARSE_BATCH_MAX:
+            out = hashed_ngram_matrix(texts, self.feature_dim) @ self.projection
+        else:
+            # Small batches (queries): gather only the active features' projection rows
+            rows, cols, weights = hashed_ngram_weights(texts, self.feature_dim)
+            out = np.zeros((len(texts), self.dim), dtype=np.float32)
+            if len(rows):
+                starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+                out[rows[starts]] = np.add.reduceat(self.projection[cols] * weights[:, None], starts, axis=0)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        np.divide(out, norms, out=out, where=norms > 0)
+        return out
+
+
+def make_embedder(backend: str = "openai", model: str = "text-embedding-3-small", local_dim: int = 384):
+    if backend == "openai":
+        return OpenAIEmbedder(model)
+    if backend == "local":
+        return LocalHashEmbedder(local_dim)
+    raise ValueError(f"Unknown embedder backend {backend!r}; expected 'openai' or 'local'")
+
+
+_LOCAL_NAME_RE = re.compile(r"local-hash-(\d+)(?:-rp(\d+)-(\d+))?$")
+
+
+def make_embedder_for_model(name: str):
+    """The embedder whose `name` is `name` (as recorded in an index manifest)."""
+    match = _LOCAL_NAME_RE.match(name)
+    if match is None:
+        return OpenAIEmbedder(name)
+    feature_dim, dim, seed = match.groups()
+    return LocalHashEmbedder(int(dim or feature_dim), int(feature_dim), int(seed or PROJECTION_SEED))
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+_by_model = {}
+
+
+def get_embedder():
+    """Process-wide embedder selected by config."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = make_embedder(**embedder_config)
+                logger.info("Embedder: %s", _embedder.name)
+    return _embedder
+
+
+def embedder_for_model(name: str):
+    """
+    Shared embedder for a model name: the configured one if it matches, else one
+    built for it. Lets queries follow the index version being served while an
+    embedding-model migration is rolling out.
+    """
+    configured = get_embedder()
+    if configured.name == name:
+        return configured
+    with _embedder_lock:
+        if name not in _by_model:
+            _by_model[name] = make_embedder_for_model(name)
+        return _by_model[name]
@@ -0,0 +1,410 @@
+"""
+Incremental knowledge-base indexer.
+
+Embeds the JSONL knowledge records and docs/ chunks in large batches with
+bounded concurrency. A manifest of content hashes lets unchanged items reuse
+their stored vectors, so a rebuild only pays for what changed.
+
+Every build that changes anything writes a new version directory (staged under
+a .tmp- name and renamed when complete), then flips the CURRENT pointer. Serving
+processes pick it up on their own; old versions are removed after `--keep`.
+
+    python -m prompt_engine.indexer [--docs docs] [--batch-size 128] [--concurrency 4] [--force]
+    python -m prompt_engine.indexer --no-activate      # build only; flip later with --activate
+    python -m prompt_engine.indexer --activate VERSION  # switch (or roll back) to a built version
+    python -m prompt_engine.indexer --list
+    python -m prompt_engine.indexer --adopt faiss_index.bin knowledge_meta.bin  # pre-versioning artifacts
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from prompt_engine import knowledge_index as ki
+from prompt_engine.ann_index import INDEX_KINDS, build_ann_index
+from prompt_engine.metadata_store import MetadataStore, write_store
+from utils.config import (
+    knowledge_index as index_config, knowledge_partitions as partition_config, knowledge_versions as version_config
+)
+
+logger = logging.getLogger("handlers")
+
+DOCS_DIR = "docs"
+BATCH_SIZE = 128
+CONCURRENCY = 4
+# A staging directory this old belongs to a build that died
+STALE_STAGING_SECONDS = 3600
+# Doc chunking (the sizes the old utils/embed.py script used)
+CHUNK_WORDS = 500
+CHUNK_OVERLAP = 50
+# docs/ files that are indexed; anything else there (subdirectories, editor files) is skipped
+DOC_EXTENSIONS = (".txt", ".md")
+
+
+def content_hash(model: str, text: str) -> str:
+    """Same text under a different embedding model is different content."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def get_chunks(text, chunk_size=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    words = text.split()
+    for i in range(0, len(words), chunk_size - overlap):
+        yield " ".join(words[i:i + chunk_size])
+
+
+def load_items(jsonl_path=None, docs_dir=DOCS_DIR):
+    """(text to embed, record) pairs in index order: JSONL records, then docs/ chunks."""
+    jsonl_path = jsonl_path or ki.JSONL_PATH
+    if not os.path.exists(jsonl_path):
+        raise FileNotFoundError(f"{jsonl_path} not found. Add your JSONL RAG knowledge.")
+
+    items = []
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                obj = json.loads(line)
+                items.append((f"{obj['situation']} - {obj['response']}", obj))
+
+    if docs_dir and os.path.isdir(docs_dir):
+        for name in sorted(os.listdir(docs_dir)):
+            path = os.path.join(docs_dir, name)
+            if name.startswith(".") or not name.lower().endswith(DOC_EXTENSIONS) or not os.path.isfile(path):
+                logger.info("Skipping %s: not an indexable doc", path)
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for chunk in get_chunks(f.read()):
+                    items.append((chunk, {"situation": name, "tone": "reference", "response": chunk, "source": name}))
+    return items
+
+
+def _atomic_write(path, write):
+    """Write through a temp file in the same directory and rename it over `path`."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-" + os.path.basename(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def build_digest(model, index_params, hashes, records) -> str:
+    """Hash of everything a version is built from: same digest, same artifacts."""
+    digest = hashlib.sha256(json.dumps([model, index_params, partition_config["field"]], sort_keys=True,
+                                       default=str).encode("utf-8"))
+    for h, record in zip(hashes, records):
+        digest.update(h.encode("utf-8"))
+        digest.update(json.dumps(record, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _load_previous(model, path):
+    """(stored vectors by content hash, manifest) of the version at `path`; empty if unusable."""
+    embeddings_path = os.path.join(path, ki.EMBEDDINGS_FILE) if path else None
+    if not (embeddings_path and os.path.exists(embeddings_path)):
+        return {}, {}
+    manifest = ki.read_manifest(path)
+    if manifest.get("model") != model:
+        return {}, {}
+    vectors = np.load(embeddings_path, mmap_mode="r")
+    return {h: vectors[row] for row, h in enumerate(manifest.get("hashes", []))}, manifest
+
+
+def partition_name(value) -> str:
+    return re.sub(r"[^a-z0-9_-]+", "_", str(value or "none").lower())
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def write_partitions(vectors, records, hashes, index_params, partitions_dir, previous=None, rebuild=(),
+                     previous_dir=None):
+    """
+    One sub-index per value of the partition field (tone), holding global row ids.
+    A partition is rebuilt only if its (row id, content hash) digest changed or it
+    is named in `rebuild`; otherwise its files are hard-linked from `previous_dir`
+    (the previous version), or left alone when that is `partitions_dir` itself.
+    Partitions that no longer exist are removed. Returns (digests by partition, names rebuilt).
+    """
+    previous = previous or {}
+    previous_dir = previous_dir or partitions_dir
+    field = partition_config["field"]
+
+    members = {}
+    for row, record in enumerate(records):
+        members.setdefault(partition_name(record.get(field)), []).append(row)
+
+    digests, rebuilt = {}, []
+    for name, rows in sorted(members.items()):
+        digest = hashlib.sha256("".join(f"{row}:{hashes[row]};" for row in rows).encode("utf-8")).hexdigest()
+        digests[name] = digest
+        index_file, ids_file = ki.partition_paths(name, partitions_dir)
+        old_files = ki.partition_paths(name, previous_dir)
+        fresh = all(os.path.exists(path) for path in old_files)
+        if fresh and previous.get(name) == digest and name not in rebuild:
+            if previous_dir != partitions_dir:
+                os.makedirs(partitions_dir, exist_ok=True)
+                for src, dst in zip(old_files, (index_file, ids_file)):
+                    _link_or_copy(src, dst)
+            continue
+        ids = np.asarray(rows, dtype=np.int64)
+        index = build_ann_index(vectors[ids], **index_params)
+        _atomic_write(index_file, lambda path: faiss.write_index(index, path))
+        _atomic_write(ids_file, lambda path: _save_npy(path, ids))
+        rebuilt.append(name)
+
+    for name in set(previous) - set(members):
+        for path in ki.partition_paths(name, partitions_dir):
+            if os.path.exists(path):
+                os.remove(path)
+    return digests, rebuilt
+
+
+def _save_npy(path, array):
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+def embed_in_batches(embed_batch_fn, texts, batch_size=BATCH_SIZE, concurrency=CONCURRENCY):
+    """Embed texts as batches of `batch_size`, at most `concurrency` requests in flight."""
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        results = list(pool.map(embed_batch_fn, batches))
+    return [np.asarray(v, dtype=np.float32) for batch in results for v in batch]
+
+
+def version_name(digest: str) -> str:
+    """UTC build time (sorts chronologically) plus a digest prefix."""
+    now = time.time()
+    return time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{int(now * 1000) % 1000:03d}Z-{digest[:8]}"
+
+
+def list_versions(knowledge_dir=None) -> list:
+    """Completed versions, oldest first."""
+    knowledge_dir = knowledge_dir or ki.KNOWLEDGE_DIR
+    if not os.path.isdir(knowledge_dir):
+        return []
+    return sorted(name for name in os.listdir(knowledge_dir)
+                  if not name.startswith(".") and os.path.isfile(os.path.join(knowledge_dir, name, ki.MANIFEST_FILE)))
+
+
+def set_current_version(version, knowledge_dir=None):
+    """Atomically point CURRENT at a completed version."""
+    knowledge_dir = knowledge_dir or ki.KNOWLEDGE_DIR
+    if version not in list_versions(knowledge_dir):
+        raise ValueError(f"No built knowledge index version {version!r} in {knowledge_dir}")
+
+    def write_pointer(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(version + "\n")
+
+    _atomic_write(os.path.join(knowledge_dir, ki.CURRENT_FILE), write_pointer)
+    logger.info("Knowledge index version %s is current", version)
+
+
+def collect_versions(knowledge_dir=None, keep=None) -> list:
+    """
+    Remove all but the newest `keep` versions, never the current one, and the
+    staging directories of builds that died. Processes still serving a removed
+    version keep their loaded index until they swap. Returns the names removed.
+    """
+    knowledge_dir = knowledge_dir or ki.KNOWLEDGE_DIR
+    keep = max(1, keep or version_config["keep_versions"])
+    current = ki.current_version(knowledge_dir)
+    versions = list_versions(knowledge_dir)
+    removed = [v for v in versions[:-keep] if v != current]
+    for version in removed:
+        shutil.rmtree(ki.version_dir(version, knowledge_dir), ignore_errors=True)
+
+    cutoff = time.time() - STALE_STAGING_SECONDS
+    for name in os.listdir(knowledge_dir) if os.path.isdir(knowledge_dir) else ():
+        path = os.path.join(knowledge_dir, name)
+        if name.startswith(".tmp-") and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+    if removed:
+        logger.info("Removed knowledge index versions %s", removed)
+    return removed
+
+
+def build_index(embed_batch_fn, model, jsonl_path=None, docs_dir=DOCS_DIR, batch_size=BATCH_SIZE,
+                concurrency=CONCURRENCY, force=False, index_params=None, rebuild_partitions=(),
+                knowledge_dir=None, activate=True, keep_versions=None) -> dict:
+    """
+    Bring the index up to date with the sources and return build stats.
+    An empty corpus raises ValueError. If nothing changed since the current version the build is a no-op. Otherwise
+    a new version is written next to it, vectors of unchanged items and unchanged
+    partition sub-indexes are reused from the current version, and (with
+    `activate`) the pointer is switched to it once it is complete.
+    """
+    knowledge_dir = knowledge_dir or ki.KNOWLEDGE_DIR
+    start = time.perf_counter()
+
+    current = ki.current_version(knowledge_dir)
+    current_path = ki.version_dir(current, knowledge_dir) if current else None
+    items = load_items(jsonl_path, docs_dir)
+    if not items:
+        raise ValueError(f"Nothing to index: {jsonl_path or ki.JSONL_PATH} and {docs_dir} hold no records")
+    hashes = [content_hash(model, text) for text, _ in items]
+    records = [record for _, record in items]
+    index_params = index_params or index_config
+    digest = build_digest(model, index_params, hashes, records)
+
+    stats = {"items": len(items), "embedded": 0, "reused": len(items), "removed": 0, "partitions_rebuilt": []}
+    if not (force or rebuild_partitions) and current and ki.read_manifest(current_path).get("content_hash") == digest:
+        stats.update(version=current, unchanged=True, removed_versions=[],
+                     seconds=round(time.perf_counter() - start, 3))
+        logger.info("Knowledge index unchanged: %s", stats)
+        return stats
+
+    previous, previous_manifest = ({}, {}) if force else _load_previous(model, current_path)
+    todo = [i for i, h in enumerate(hashes) if h not in previous]
+    fresh = embed_in_batches(embed_batch_fn, [items[i][0] for i in todo], batch_size, concurrency)
+    fresh_by_hash = {hashes[i]: vec for i, vec in zip(todo, fresh)}
+    vectors = np.vstack([fresh_by_hash[h] if h in fresh_by_hash else previous[h] for h in hashes])
+    index = build_ann_index(vectors, **index_params)
+
+    version = version_name(digest)
+    staging = os.path.join(knowledge_dir, f".tmp-{version}")
+    os.makedirs(staging)
+    try:
+        partitions, rebuilt = write_partitions(
+            vectors, records, hashes, index_params, os.path.join(staging, ki.PARTITIONS_SUBDIR),
+            previous_manifest.get("partitions"), rebuild_partitions,
+            os.path.join(current_path, ki.PARTITIONS_SUBDIR) if previous_manifest else None,
+        )
+        manifest = {"version": version, "model": model, "dim": int(vectors.shape[1]),
+                    "index": type(index).__name__, "content_hash": digest, "hashes": hashes,
+                    "partitions": partitions, "built_at": int(time.time())}
+        _save_npy(os.path.join(staging, ki.EMBEDDINGS_FILE), vectors)
+        faiss.write_index(index, os.path.join(staging, ki.INDEX_FILE))
+        write_store(records, os.path.join(staging, ki.METADATA_FILE))
+        with open(os.path.join(staging, ki.MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.rename(staging, ki.version_dir(version, knowledge_dir))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    if activate:
+        set_current_version(version, knowledge_dir)
+    stats.update(
+        version=version,
+        activated=activate,
+        embedded=len(todo),
+        reused=len(items) - len(todo),
+        removed=len(set(previous) - set(hashes)),
+        partitions_rebuilt=rebuilt,
+        removed_versions=collect_versions(knowledge_dir, keep_versions),
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    logger.info("Knowledge index built: %s", stats)
+    return stats
+
+
+def record_text(record) -> str:
+    """The text load_items embedded for a stored record (a docs/ chunk, or a JSONL record)."""
+    if record.get("source"):
+        return record.get("response", "")
+    return f"{record.get('situation', '')} - {record.get('response', '')}"
+
+
+def adopt_artifacts(index_path, metadata_path, model, knowledge_dir=None) -> str:
+    """
+    Wrap index / metadata files built before versioning into a version and make it current.
+    When the index can give its vectors back (flat indexes), they are stored with their
+    content hashes and split into partition sub-indexes like a build does, so routed
+    searches work on the adopted version and the next build re-embeds only what changed.
+    Otherwise no partitions are written and routed searches filter the full index.
+    """
+    knowledge_dir = knowledge_dir or ki.KNOWLEDGE_DIR
+    index = faiss.read_index(index_path)
+    with open(index_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    try:
+        vectors = index.reconstruct_n(0, index.ntotal)
+    except RuntimeError as e:
+        logger.warning("Cannot read vectors back from %s (%s); adopting without partitions", index_path, e)
+        vectors = None
+
+    version = version_name(digest)
+    path = ki.version_dir(version, knowledge_dir)
+    os.makedirs(path)
+    shutil.copy2(index_path, os.path.join(path, ki.INDEX_FILE))
+    shutil.copy2(metadata_path, os.path.join(path, ki.METADATA_FILE))
+    hashes, partitions = [], {}
+    if vectors is not None:
+        records = [dict(record) for record in MetadataStore(metadata_path)]
+        hashes = [content_hash(model, record_text(record)) for record in records]
+        partitions, _ = write_partitions(vectors, records, hashes, index_config,
+                                         os.path.join(path, ki.PARTITIONS_SUBDIR))
+        _save_npy(os.path.join(path, ki.EMBEDDINGS_FILE), vectors)
+    with open(os.path.join(path, ki.MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"version": version, "model": model, "dim": int(index.d), "index": type(index).__name__,
+                   "content_hash": None, "hashes": hashes, "partitions": partitions,
+                   "built_at": int(time.time())}, f)
+    set_current_version(version, knowledge_dir)
+    return version
+
+
+def main(argv=None):
+    from prompt_engine.embedders import get_embedder
+
+    parser = argparse.ArgumentParser(description="Incrementally rebuild the knowledge index")
+    parser.add_argument("--jsonl", default=None)
+    parser.add_argument("--docs", default=DOCS_DIR)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--index", choices=INDEX_KINDS, default=index_config["kind"])
+    parser.add_argument("--force", action="store_true", help="re-embed everything")
+    parser.add_argument("--partition", action="append", default=[],
+                        help="rebuild this partition even if unchanged (repeatable)")
+    parser.add_argument("--no-activate", action="store_true", help="build a version without switching to it")
+    parser.add_argument("--activate", metavar="VERSION", help="switch to an already built version and exit")
+    parser.add_argument("--keep", type=int, default=None, help="versions to keep (default from config)")
+    parser.add_argument("--list", action="store_true", help="list built versions and exit")
+    parser.add_argument("--adopt", nargs=2, metavar=("INDEX", "METADATA"),
+                        help="make an unversioned index + metadata pair (built by the configured model) current")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.list:
+        current = ki.current_version()
+        for version in list_versions():
+            manifest = ki.read_manifest(ki.version_dir(version))
+            print(f"{'*' if version == current else ' '} {version}  {manifest.get('model')}  dim={manifest.get('dim')}")
+        return
+    if args.activate:
+        set_current_version(args.activate)
+        return
+
+    embedder = get_embedder()
+    if args.adopt:
+        print(adopt_artifacts(*args.adopt, embedder.name))
+        return
+    stats = build_index(embedder.embed, embedder.name, args.jsonl, args.docs, args.batch_size,
+                        args.concurrency, args.force, index_params={**index_config, "kind": args.index},
+                        rebuild_partitions=[partition_name(p) for p in args.partition],
+                        activate=not args.no_activate, keep_versions=args.keep)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
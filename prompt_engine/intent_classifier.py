@@ -0,0 +1,104 @@
+import json
+import logging
+import threading
+
+import numpy as np
+
+from prompt_engine.embedders import FEATURE_DIM, LocalHashEmbedder, hashed_ngram_matrix
+
+logger = logging.getLogger("handlers")
+
+EXAMPLES_PATH = "prompt_engine/intent_examples.jsonl"
+# Below this cosine similarity to every centroid the batch is "other"
+MIN_SIMILARITY = 0.25
+# Stricter floors for intents that end a stage early
+INTENT_MIN_SIMILARITY = {"done": 0.3, "decline": 0.3}
+# How far an intent must outscore "other"; both sides score the better of their centroid
+# and their closest example
+MIN_MARGIN = 0.0
+
+
+def hashed_ngram_vector(text: str, dim: int = FEATURE_DIM) -> np.ndarray:
+    """L2-normalised bag of hashed features: words, word bigrams and char 3-grams."""
+    return hashed_ngram_matrix([text], dim)[0]
+
+
+class IntentClassifier:
+    """
+    Nearest-centroid classifier over the local embedder's raw hashed n-gram features.
+    Centroids are the normalised mean of each intent's example vectors,
+    so classification is one small matrix-vector product with no network call.
+    The winning intent must also beat "other" on its closest example: short replies
+    like "what?" or "thanks" sit near an intent's centroid but nearer still to a
+    listed negative.
+    """
+
+    def __init__(self, examples, dim: int = FEATURE_DIM, min_similarity: float = MIN_SIMILARITY,
+                 intent_min_similarity=None, min_margin: float = MIN_MARGIN):
+        self.dim = dim
+        self.min_similarity = min_similarity
+        self.intent_min_similarity = INTENT_MIN_SIMILARITY if intent_min_similarity is None else intent_min_similarity
+        self.min_margin = min_margin
+        self.embedder = LocalHashEmbedder(dim=dim, feature_dim=dim)
+        vectors = self.embedder.embed([ex["text"] for ex in examples])
+        by_intent = {}
+        for ex, vec in zip(examples, vectors):
+            by_intent.setdefault(ex["intent"], []).append(vec)
+
+        self.intents = sorted(by_intent)
+        centroids = np.vstack([np.mean(by_intent[i], axis=0) for i in self.intents])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = centroids.astype(np.float32)
+        self.examples = np.asarray(vectors, dtype=np.float32)
+        self.labels = np.array([ex["intent"] for ex in examples])
+
+    @classmethod
+    def from_jsonl(cls, path: str = EXAMPLES_PATH, **kwargs):
+        with open(path, "r", encoding="utf-8") as f:
+            examples = [json.loads(line) for line in f if line.strip()]
+        return cls(examples, **kwargs)
+
+    def classify(self, text: str):
+        """
+        Return (intent, similarity); "other" when the best intent is under its floor
+        or doesn't beat "other" by `min_margin`.
+        """
+        vec = self.embedder.embed([text])[0]
+        if not vec.any():
+            return "other", 0.0
+        scores = self.centroids @ vec
+        nearest = self.examples @ vec
+        other = 0.0
+        if "other" in self.intents:
+            i = self.intents.index("other")
+            other = max(float(scores[i]), float(nearest[self.labels == "other"].max()))
+            scores[i] = -1.0
+        best = int(np.argmax(scores))
+        intent, score = self.intents[best], float(scores[best])
+        support = max(score, float(nearest[self.labels == intent].max()))
+        if score < self.intent_min_similarity.get(intent, self.min_similarity) or support - other <= self.min_margin:
+            return "other", max(score, other)
+        return intent, score
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_intent_classifier() -> IntentClassifier:
+    """Process-wide classifier, built lazily from the examples file."""
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = IntentClassifier.from_jsonl()
+                logger.info("Intent classifier loaded with intents %s", _classifier.intents)
+    return _classifier
+
+
+def classify_intent(text: str) -> str:
+    try:
+        return get_intent_classifier().classify(text)[0]
+    except (OSError, ValueError) as e:
+        logger.warning("Intent classifier unavailable: %s", e)
+        return "other"
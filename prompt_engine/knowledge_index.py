@@ -0,0 +1,328 @@
+"""
+Process-wide FAISS knowledge index.
+
+The index and its records are loaded once, lazily, and shared by every turn.
+Building is an offline step; a missing index disables retrieval instead of
+rebuilding on the request path:
+
+    python -m prompt_engine.indexer
+
+Each build is an immutable version directory under KNOWLEDGE_DIR (index,
+metadata, embeddings, partitions and a manifest of model / dim / content hash);
+the CURRENT file names the one to serve. Processes poll the pointer, load a new
+version in the background and swap it in; searches already running finish on
+the object they hold.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import faiss
+import numpy as np
+
+from prompt_engine.ann_index import apply_search_params, prepare_query
+from prompt_engine.bm25 import BM25Index, reciprocal_rank_fusion
+from prompt_engine.metadata_store import MetadataStore
+from utils.config import (
+    knowledge_index as index_config, knowledge_partitions as partition_config,
+    knowledge_versions as version_config, retrieval as retrieval_config
+)
+from utils.metrics import metrics
+
+logger = logging.getLogger("handlers")
+
+JSONL_PATH = "prompt_engine/emotional_support_knowledge.jsonl"
+KNOWLEDGE_DIR = "prompt_engine/knowledge"
+# Pointer file in KNOWLEDGE_DIR holding the name of the version to serve
+CURRENT_FILE = "CURRENT"
+# Artifacts inside a version directory
+INDEX_FILE = "index.bin"
+METADATA_FILE = "meta.bin"
+EMBEDDINGS_FILE = "embeddings.npy"
+MANIFEST_FILE = "manifest.json"
+PARTITIONS_SUBDIR = "partitions"
+# Map the index file instead of copying it into RAM (index types that support it)
+READ_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+
+class KnowledgeIndexUnavailable(RuntimeError):
+    """Raised when the index artifacts have not been built."""
+
+
+def version_dir(version: str, knowledge_dir: str = None) -> str:
+    return os.path.join(knowledge_dir or KNOWLEDGE_DIR, version)
+
+
+def current_version(knowledge_dir: str = None):
+    """Name of the version the pointer selects, or None before the first build."""
+    try:
+        with open(os.path.join(knowledge_dir or KNOWLEDGE_DIR, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(path: str) -> dict:
+    """Manifest of the version directory at `path`; empty if it has none."""
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def partition_paths(name: str, partitions_dir: str):
+    """(sub-index file, global row ids file) of one partition."""
+    return os.path.join(partitions_dir, f"{name}.index"), os.path.join(partitions_dir, f"{name}.ids.npy")
+
+
+def partitions_for_stage(stage: str = None):
+    """Partitions worth searching at this stage, or None to search everything."""
+    from prompt_engine.indexer import partition_name
+
+    routes = partition_config["stage_routes"].get(stage)
+    return tuple(partition_name(t) for t in routes) if routes else None
+
+
+class KnowledgeIndex:
+    """A loaded FAISS index plus the knowledge record for each vector id."""
+
+    def __init__(self, index, data, path: str = None, manifest: dict = None):
+        self.index = index
+        self.data = data
+        self.path = path
+        self.manifest = manifest or {}
+        self.version = os.path.basename(path) if path else None
+        # Queries must be embedded by the model that built this version
+        self.model = self.manifest.get("model")
+        self.partitions_dir = os.path.join(path, PARTITIONS_SUBDIR) if path else None
+        self._lexical = None
+        self._lexical_lock = threading.Lock()
+        self._partitions = {}
+        self._masks = {}
+        self._partitions_lock = threading.Lock()
+
+    @property
+    def lexical(self) -> BM25Index:
+        """BM25 over the records' situation phrases, built on first use."""
+        if self._lexical is None:
+            with self._lexical_lock:
+                if self._lexical is None:
+                    self._lexical = BM25Index([record.get("situation", "") for record in self.data])
+        return self._lexical
+
+    def partition(self, name: str):
+        """(sub-index, global row ids) of a partition, loaded on first use; None if not built."""
+        if name not in self._partitions:
+            with self._partitions_lock:
+                if name not in self._partitions:
+                    loaded = None
+                    files = partition_paths(name, self.partitions_dir) if self.partitions_dir else ()
+                    if files and all(os.path.exists(path) for path in files):
+                        index_file, ids_file = files
+                        index = apply_search_params(faiss.read_index(index_file, READ_FLAGS), **index_config)
+                        loaded = (index, np.load(ids_file, mmap_mode="r"))
+                    else:
+                        logger.warning("Knowledge partition %s not built; routed searches filter the full index", name)
+                    self._partitions[name] = loaded
+        return self._partitions[name]
+
+    def partition_mask(self, names) -> np.ndarray:
+        """Boolean row mask of the records whose partition field is in `names`."""
+        from prompt_engine.indexer import partition_name
+
+        key = tuple(sorted(names))
+        if key not in self._masks:
+            field = partition_config["field"]
+            if hasattr(self.data, "codes") and field in self.data.columns:
+                codes, vocab = self.data.codes(field)
+                allowed = np.array([partition_name(v) in key for v in vocab], dtype=bool)
+                mask = allowed[np.asarray(codes)]
+            else:
+                mask = np.array([partition_name(r.get(field)) in key for r in self.data], dtype=bool)
+            self._masks[key] = mask
+        return self._masks[key]
+
+    @classmethod
+    def load(cls, path: str = None):
+        """Load the version directory at `path`, by default the one CURRENT points to."""
+        if path is None:
+            version = current_version()
+            if version is None:
+                raise KnowledgeIndexUnavailable(
+                    f"no {CURRENT_FILE} version in {KNOWLEDGE_DIR}; run `python -m prompt_engine.indexer`"
+                )
+            path = version_dir(version)
+        index_path, metadata_path = os.path.join(path, INDEX_FILE), os.path.join(path, METADATA_FILE)
+        if not (os.path.exists(index_path) and os.path.exists(metadata_path)):
+            raise KnowledgeIndexUnavailable(
+                f"{index_path} / {metadata_path} missing; run `python -m prompt_engine.indexer`"
+            )
+        start = time.perf_counter()
+        index = apply_search_params(faiss.read_index(index_path, READ_FLAGS), **index_config)
+        data = MetadataStore(metadata_path)
+        metrics.observe("rag.index_load_ms", (time.perf_counter() - start) * 1000.0)
+        logger.info("Knowledge index loaded: %d vectors from %s", index.ntotal, path)
+        return cls(index, data, path, read_manifest(path))
+
+    def search_ids(self, query_vector, top_k: int = 3, partitions=None) -> list:
+        """
+        Ids of the top_k nearest vectors, best first. With `partitions`, only those
+        sub-indexes are searched and their hits merged by score. If any of them
+        isn't built (counted in rag.partition_missing), the full index is searched
+        and its hits filtered by partition_mask instead, the same filter the
+        lexical ranking uses, so a routed stage never silently loses results.
+        """
+        query = prepare_query(self.index, query_vector) if len(query_vector) == self.index.d else None
+        if query is None:
+            raise KnowledgeIndexUnavailable(
+                f"index has dim {self.index.d}, query has {len(query_vector)}; rebuild after switching embedders"
+            )
+        if not partitions:
+            _, ids = self.index.search(query, top_k)
+            return [int(i) for i in ids[0] if i >= 0]
+
+        loaded = [self.partition(name) for name in partitions]
+        missing = [name for name, part in zip(partitions, loaded) if part is None]
+        if missing:
+            for name in missing:
+                metrics.incr("rag.partition_missing", partition=name)
+            return self._search_masked(query, top_k, self.partition_mask(partitions))
+
+        hits = []
+        for index, row_ids in loaded:
+            scores, ids = index.search(query, min(top_k, index.ntotal))
+            hits.extend((float(s), int(row_ids[i])) for s, i in zip(scores[0], ids[0]) if i >= 0)
+        # Inner-product scores: higher is closer
+        hits.sort(key=lambda hit: -hit[0])
+        return [row for _, row in hits[:top_k]]
+
+    def _search_masked(self, query, top_k: int, mask) -> list:
+        """Full-index search keeping rows in `mask`; widens k until enough of them turn up."""
+        wanted = min(top_k, int(mask.sum()))
+        k = min(self.index.ntotal, top_k * 4)
+        while True:
+            _, ids = self.index.search(query, k)
+            hits = [int(i) for i in ids[0] if i >= 0 and mask[i]]
+            if len(hits) >= wanted or k >= self.index.ntotal:
+                return hits[:top_k]
+            k = min(self.index.ntotal, k * 4)
+
+    def search(self, query_vector, top_k: int = 3, partitions=None):
+        """Return the records of the top_k nearest vectors."""
+        return [self.data[i] for i in self.search_ids(query_vector, top_k, partitions)]
+
+    def retrieve_ids(self, query: str, embed_fn, top_k: int = 3, mode: str = None, stage: str = None) -> list:
+        """
+        Ids for a text query. `embed_fn` is only called when the vector ranking is needed:
+        - lexical: BM25 only.
+        - vector: nearest embeddings only.
+        - hybrid: a confident BM25 hit short-circuits; otherwise BM25 and vector
+          candidates are fused with reciprocal-rank fusion.
+        A `stage` restricts both rankings to the partitions routed for that stage.
+        """
+        mode = mode or retrieval_config["mode"]
+        candidates = max(top_k, retrieval_config["candidates"])
+        partitions = partitions_for_stage(stage)
+        start = time.perf_counter()
+
+        mask = self.partition_mask(partitions) if partitions and mode != "vector" else None
+        lexical = [] if mode == "vector" else self.lexical.search(query, candidates, mask)
+        if mode == "lexical" or (lexical and lexical[0][2] >= retrieval_config["lexical_short_circuit"]):
+            path, ids = "lexical", [doc_id for doc_id, _, _ in lexical[:top_k]]
+        elif mode == "vector" or not lexical:
+            path, ids = "vector", self.search_ids(
+                embed_fn(query), top_k if mode == "vector" else candidates, partitions)[:top_k]
+        else:
+            vector = self.search_ids(embed_fn(query), candidates, partitions)
+            path = "fused"
+            ids = reciprocal_rank_fusion([[doc_id for doc_id, _, _ in lexical], vector],
+                                         retrieval_config["rrf_k"], top_k)
+
+        metrics.incr("rag.retrievals", mode=mode, path=path, partitioned=bool(partitions))
+        metrics.observe("rag.retrieve_ms", (time.perf_counter() - start) * 1000.0, mode=mode, path=path)
+        return ids
+
+    def retrieve(self, query: str, embed_fn, top_k: int = 3, mode: str = None, stage: str = None):
+        return [self.data[i] for i in self.retrieve_ids(query, embed_fn, top_k, mode, stage)]
+
+
+_knowledge_index = None
+_knowledge_lock = threading.Lock()
+_next_pointer_check = 0.0
+_swapping = None
+
+
+def get_knowledge_index() -> KnowledgeIndex:
+    """The shared index, loaded on first use; never rebuilds."""
+    global _knowledge_index
+    if _knowledge_index is None:
+        with _knowledge_lock:
+            if _knowledge_index is None:
+                _knowledge_index = KnowledgeIndex.load()
+    else:
+        _check_pointer()
+    return _knowledge_index
+
+
+def _check_pointer():
+    """At most every refresh_seconds: if CURRENT moved, load that version in the background."""
+    global _next_pointer_check, _swapping
+    now = time.monotonic()
+    if now < _next_pointer_check:
+        return
+    with _knowledge_lock:
+        if now < _next_pointer_check:
+            return
+        _next_pointer_check = now + version_config["refresh_seconds"]
+        version = current_version()
+        if version is None or version == _knowledge_index.version or _swapping is not None:
+            return
+        _swapping = threading.Thread(target=_swap_to, args=(version,), name="knowledge-swap", daemon=True)
+        _swapping.start()
+
+
+def _warm(knowledge: KnowledgeIndex) -> KnowledgeIndex:
+    from prompt_engine.indexer import partition_name
+
+    knowledge.lexical
+    routed = {partition_name(t) for tones in partition_config["stage_routes"].values() for t in tones}
+    for name in sorted(routed):
+        knowledge.partition(name)
+    return knowledge
+
+
+def _swap_to(version: str):
+    """Load and warm `version` off the request path, then publish it."""
+    global _knowledge_index, _swapping
+    try:
+        fresh = _warm(KnowledgeIndex.load(version_dir(version)))
+        with _knowledge_lock:
+            previous, _knowledge_index = _knowledge_index, fresh
+        metrics.incr("rag.index_swaps")
+        logger.info("Knowledge index switched from %s to %s", previous and previous.version, version)
+    except Exception as e:
+        metrics.incr("rag.index_swap_failures")
+        logger.error("Knowledge index %s not loaded; still serving the previous version: %s", version, e)
+    finally:
+        _swapping = None
+
+
+def warm_knowledge_index() -> KnowledgeIndex:
+    """
+    Load the shared index and build its lazy parts (BM25, routed partitions) now.
+    Called in a preloading gunicorn master, so every worker inherits them
+    copy-on-write instead of building its own.
+    """
+    return _warm(get_knowledge_index())
+
+
+def reload_knowledge_index() -> KnowledgeIndex:
+    """Load the current version now and swap it in; searches already running keep the old object."""
+    global _knowledge_index
+    fresh = KnowledgeIndex.load()
+    with _knowledge_lock:
+        _knowledge_index = fresh
+    return fresh
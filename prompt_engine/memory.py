@@ -0,0 +1,114 @@
+"""
+Per-user long-term memory over past session summaries.
+
+Each summary is embedded once, when the session ends, and kept as float16
+bytes in the user's `user_memories` document (newest `max_memories`). A turn
+ranks them against the current batch and keeps the best few that fit a fixed
+token budget, so returning users get continuity without the prompt growing
+with their history.
+"""
+import logging
+import time
+
+import numpy as np
+
+from service.mongo import append_user_memory_m, get_user_memories_m, replace_user_memories_m
+from utils.config import long_term_memory as memory_config
+from utils.metrics import metrics
+from utils.tokens import count_tokens
+
+logger = logging.getLogger("handlers")
+
+STORE_DTYPE = np.float16
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def make_memory(text: str, vector, ts=None) -> dict:
+    return {
+        "text": text,
+        "tokens": count_tokens(text),
+        "ts": int(ts if ts is not None else time.time()),
+        "vector": _unit(vector).astype(STORE_DTYPE).tobytes(),
+    }
+
+
+def remember(user_id, text: str, embed_batch_fn, model: str, max_memories: int = None) -> int:
+    """
+    Embed and store one session summary. Memories embedded by another model are
+    re-embedded from their text first, so one user's vectors are always comparable.
+    Returns the number of memories embedded.
+    """
+    max_memories = max_memories or memory_config["max_memories"]
+    doc = get_user_memories_m(user_id) or {}
+    previous = doc.get("memories") or []
+    if previous and doc.get("model") != model:
+        kept = previous[-(max_memories - 1):] if max_memories > 1 else []
+        texts = [m["text"] for m in kept] + [text]
+        vectors = embed_batch_fn(texts)
+        memories = [make_memory(m["text"], v, m.get("ts")) for m, v in zip(kept, vectors)]
+        replace_user_memories_m(user_id, memories + [make_memory(text, vectors[-1])], model)
+        logger.info(f"Re-embedded {len(kept)} memories for user {user_id} with {model}")
+        return len(texts)
+
+    append_user_memory_m(user_id, make_memory(text, embed_batch_fn([text])[0]), model, max_memories)
+    return 1
+
+
+def rank_memories(memories, query_vector, top_k: int, token_budget: int, min_score: float) -> list:
+    """Best-scoring memories that fit the budget, returned oldest first."""
+    matrix = np.frombuffer(b"".join(m["vector"] for m in memories), dtype=STORE_DTYPE)
+    matrix = matrix.reshape(len(memories), -1).astype(np.float32)
+    query = _unit(query_vector)
+    if matrix.shape[1] != len(query):
+        return []
+    scores = matrix @ query
+
+    chosen, used = [], 0
+    for i in np.argsort(-scores, kind="stable"):
+        if scores[i] < min_score or len(chosen) >= top_k:
+            break
+        tokens = int(memories[i].get("tokens") or count_tokens(memories[i]["text"]))
+        if used + tokens > token_budget:
+            continue
+        chosen.append(int(i))
+        used += tokens
+    return [memories[i] for i in sorted(chosen, key=lambda i: memories[i].get("ts", 0))]
+
+
+def recall(user_id, query: str, embed_fn, model: str, top_k: int = None, token_budget: int = None,
+           min_score: float = None) -> list:
+    """
+    Texts of the user's memories most relevant to `query`, within the token budget.
+    `embed_fn(text)` is only called when the user has memories for this model.
+    """
+    doc = get_user_memories_m(user_id)
+    memories = (doc or {}).get("memories") or []
+    if not memories:
+        return []
+    if doc.get("model") != model:
+        metrics.incr("memory.skipped", reason="model")
+        return []
+    chosen = rank_memories(
+        memories, embed_fn(query),
+        top_k or memory_config["top_k"],
+        token_budget or memory_config["token_budget"],
+        memory_config["min_score"] if min_score is None else min_score,
+    )
+    metrics.observe("memory.recalled", len(chosen))
+    return [m["text"] for m in chosen]
+
+
+def memory_message(texts) -> dict:
+    """System message carrying recalled memories, or None when there are none."""
+    if not texts:
+        return None
+    return {
+        "role": "system",
+        "content": "What you remember about this user from earlier sessions (oldest first):\n"
+                   + "\n".join(f"- {t}" for t in texts),
+    }
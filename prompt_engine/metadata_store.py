@@ -0,0 +1,189 @@
+"""
+Columnar, memory-mapped store for knowledge records (replaces vectors.pkl).
+
+One file: a JSON header followed by 8-byte aligned sections. Text columns are a
+UTF-8 blob plus an int64 offsets array; low-cardinality columns (tone) are
+small integer codes plus a vocabulary in the header. A column some records
+lack also gets a presence bitmap, so a missing field and "" stay distinct.
+Values must be str. Opening the store maps the
+file and reads only the header, so startup cost doesn't grow with the corpus,
+and `store[i]["response"]` decodes just that one field.
+
+    python -m prompt_engine.metadata_store migrate [vectors.pkl] [knowledge_meta.bin]
+
+(then `python -m prompt_engine.indexer --adopt faiss_index.bin knowledge_meta.bin`
+wraps the pair into a knowledge index version.)
+"""
+import json
+import struct
+import sys
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+MAGIC = b"KMS1"
+_HEADER_LEN = struct.Struct("<4sQ")
+ALIGN = 8
+# Stored as codes + vocabulary rather than text
+CATEGORY_COLUMNS = ("tone",)
+
+
+def _pad(n: int) -> int:
+    return (-n) % ALIGN
+
+
+def _code_dtype(vocab_size: int):
+    return np.uint8 if vocab_size <= 256 else np.uint16 if vocab_size <= 65536 else np.uint32
+
+
+def encode_store(records) -> bytes:
+    """Serialize a list of flat str-valued records into the store format; other values raise TypeError."""
+    columns = []
+    for i, r in enumerate(records):
+        for k, v in r.items():
+            if not isinstance(v, str):
+                raise TypeError(f"record {i} field {k!r} is {type(v).__name__}; the metadata store holds str values only")
+            if k not in columns:
+                columns.append(k)
+
+    sections, schema, offset = [], {}, 0
+
+    def add(array):
+        nonlocal offset
+        raw = np.ascontiguousarray(array).tobytes()
+        start = offset
+        sections.append(raw + b"\0" * _pad(len(raw)))
+        offset += len(raw) + _pad(len(raw))
+        return [start, len(raw)]
+
+    for name in columns:
+        values = [r.get(name, "") for r in records]
+        if name in CATEGORY_COLUMNS:
+            vocab = sorted(set(values))
+            lookup = {v: i for i, v in enumerate(vocab)}
+            dtype = _code_dtype(len(vocab))
+            codes = np.fromiter((lookup[v] for v in values), dtype=dtype, count=len(values))
+            schema[name] = {"kind": "category", "vocab": vocab, "dtype": np.dtype(dtype).name, "codes": add(codes)}
+        else:
+            encoded = [v.encode("utf-8") for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            schema[name] = {"kind": "text", "offsets": add(offsets), "blob": add(blob)}
+        present = np.fromiter((name in r for r in records), dtype=bool, count=len(records))
+        if not present.all():
+            schema[name]["present"] = add(np.packbits(present))
+
+    header = json.dumps({"count": len(records), "columns": schema, "presence": True}).encode("utf-8")
+    header += b" " * _pad(_HEADER_LEN.size + len(header))
+    return _HEADER_LEN.pack(MAGIC, len(header)) + header + b"".join(sections)
+
+
+def write_store(records, path: str):
+    with open(path, "wb") as f:
+        f.write(encode_store(records))
+
+
+class _Record(Mapping):
+    """A lazy view of one row; each field is decoded on access."""
+    __slots__ = ("_store", "_i")
+
+    def __init__(self, store, i):
+        self._store = store
+        self._i = i
+
+    def __getitem__(self, name):
+        if not self._store.has(self._i, name):
+            raise KeyError(name)
+        return self._store.value(self._i, name)
+
+    def __iter__(self):
+        return (name for name in self._store.columns if self._store.has(self._i, name))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MetadataStore(Sequence):
+    """Read-only, memory-mapped view over a store file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._buf = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, header_len = _HEADER_LEN.unpack(bytes(self._buf[:_HEADER_LEN.size]))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a knowledge metadata store")
+        body = _HEADER_LEN.size + header_len
+        header = json.loads(bytes(self._buf[_HEADER_LEN.size:body]))
+        self._count = header["count"]
+        self.columns = list(header["columns"])
+        # Stores written before presence bitmaps used "" for a missing field
+        self._legacy = not header.get("presence")
+
+        def view(section, dtype):
+            start, length = section
+            return self._buf[body + start: body + start + length].view(dtype)
+
+        self._text, self._category, self._present = {}, {}, {}
+        for name, spec in header["columns"].items():
+            if "present" in spec:
+                self._present[name] = view(spec["present"], np.uint8)
+            if spec["kind"] == "text":
+                self._text[name] = (view(spec["offsets"], np.int64), view(spec["blob"], np.uint8))
+            else:
+                self._category[name] = (view(spec["codes"], np.dtype(spec["dtype"])), spec["vocab"])
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return _Record(self, i)
+
+    def has(self, i: int, name: str) -> bool:
+        """Whether record i has the field (possibly as "")."""
+        if name in self._present:
+            return bool(self._present[name][i >> 3] & (0x80 >> (i & 7)))
+        if self._legacy:
+            return self.value(i, name) != ""
+        return name in self.columns
+
+    def value(self, i: int, name: str) -> str:
+        if name in self._text:
+            offsets, blob = self._text[name]
+            return bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+        if name in self._category:
+            codes, vocab = self._category[name]
+            return vocab[int(codes[i])]
+        return ""
+
+    def codes(self, name: str):
+        """(codes array, vocabulary) of a category column, for vectorized filtering."""
+        return self._category[name]
+
+
+def migrate_pickle(pickle_path: str, store_path: str) -> int:
+    """One-off conversion of a trusted legacy vectors.pkl (a list of dicts)."""
+    import pickle
+    from prompt_engine.indexer import _atomic_write
+
+    with open(pickle_path, "rb") as f:
+        records = pickle.load(f)
+    _atomic_write(store_path, lambda path: write_store(records, path))
+    return len(records)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        sys.exit(__doc__)
+    src = sys.argv[2] if len(sys.argv) > 2 else "prompt_engine/vectors.pkl"
+    dst = sys.argv[3] if len(sys.argv) > 3 else "prompt_engine/knowledge_meta.bin"
+    print(f"migrated {migrate_pickle(src, dst)} records from {src} to {dst}")
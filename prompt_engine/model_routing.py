@@ -0,0 +1,19 @@
+from utils.config import plan_model_routing, stage_model_routing
+
+
+def get_stage_route(stage, plan=None) -> dict:
+    """
+    Resolve model, max_tokens and temperature for a stage and subscription plan.
+    Unknown stages use the "default" row; unknown plans get no overrides.
+    """
+    route = dict(stage_model_routing["default"])
+    route.update(stage_model_routing.get(stage, {}))
+
+    overrides = plan_model_routing.get(plan or "", {})
+    route.update(overrides.get("*", {}))
+    route.update(overrides.get(stage, {}))
+
+    cap = route.pop("max_tokens_cap", None)
+    if cap is not None:
+        route["max_tokens"] = min(route["max_tokens"], cap)
+    return route
@@ -1,5 +1,11 @@
 import re
-from service.redis import get_tools_r, get_user_stage_r, get_user_stage_step_r, set_user_stage_r, set_user_stage_step_r
+from dataclasses import dataclass, replace
+from typing import NamedTuple, Optional
+from prompt_engine.conversation import turns_to_messages
+from prompt_engine.intent_classifier import classify_intent
+from prompt_engine.memory import memory_message
+from utils.token_profile import SEGMENT_HISTORY, SEGMENT_MEMORY, SEGMENT_RAG, SEGMENT_STAGE, SEGMENT_TOOL
+from service.redis import get_stage_state_r, set_stage_state_r
 
 
 STAGES = {
@@ -74,86 +80,163 @@ STAGE_PROMPTS = {
         """
 }
 
+# Phrases that mean "give me something practical" — triggers the Tools stage
+TOOLS_TRIGGERS = (
+    "what should i do",
+    "what do i do",
+    "what can i do",
+    "how can i fix",
+    "how do i handle",
+    "any advice",
+    "what advice do you have",
+    "can you help me decide",
+    "what would you suggest",
+    "what would you recommend",
+    "how should i approach",
+    "what are my options",
+    "i dont know",
+    "i'm stuck",
+    "tool",
+    "something practical",
+)
+
+# One precompiled alternation instead of a search per phrase
+TOOLS_TRIGGER_RE = re.compile(r"\b(?:%s)\b" % "|".join(re.escape(p) for p in TOOLS_TRIGGERS))
+# The whole batch is a greeting ("hi", "hey again!", "hello there :)"), not a sentence starting with one
+GREETING_RE = re.compile(r"^(?:hel+o+|hi+|hey+)(?:\s+(?:there|again|you|all|everyone))?[\s!.,?:;)(-]*$", re.IGNORECASE)
+TOOL_NAME_RE = re.compile(r"\[tool_name=(.*?)\]")
+# "user: ", "user-forwarded: ", "third-forwarded: " line prefixes from the debouncer
+ROLE_PREFIX_RE = re.compile(r"^[a-z-]+:\s*", re.MULTILINE)
+
+def is_greeting(text: str) -> bool:
+    """True when the batch, role prefixes aside, is just a greeting."""
+    return GREETING_RE.match(" ".join(ROLE_PREFIX_RE.sub("", text).split())) is not None
+
 def detect_tools_trigger(user_message: str) -> bool:
     """
     Detects if the user is asking for advice, guidance, or solutions — triggers Tools stage.
     """
-    text = user_message.lower().strip()
-
-    # Broader set of triggers (covers question variants)
-    patterns = [
-        r"\bwhat should i do\b",
-        r"\bwhat do i do\b",
-        r"\bwhat can i do\b",
-        r"\bhow can i fix\b",
-        r"\bhow do i handle\b",
-        r"\bany advice\b",
-        r"\bwhat advice do you have\b",
-        r"\bcan you help me decide\b",
-        r"\bwhat would you suggest\b",
-        r"\bwhat would you recommend\b",
-        r"\bhow should i approach\b",
-        r"\bwhat are my options\b",
-        r"\bi dont know\b",
-        r"\bi'm stuck\b",
-        r"\btool\b",
-        r"\bsomething practical\b",
-    ]
-
-    return any(re.search(p, text) for p in patterns)
-    
-def get_user_stage(user_id):
-    """Retrieve the user's current stage from Redis."""
-    stage = get_user_stage_r(user_id)
-    if stage is None:
-        set_user_stage_r(user_id, STAGES['GREETING'][0])
-    return stage
-
-def advance_stage(user_id: str):
-    """Move the user to the next stage in the conversation flow."""
-    current = get_user_stage(user_id)
-
-    user_stages = STAGES[current][1] if current in STAGES else STAGES['GREETING'][0]
-
-    if user_stages:
-        set_user_stage_r(user_id, user_stages)
-
-def find_stage(user_id, current_stage, text):
-    """Find the current stage of the user."""
-    if current_stage == "initial":
-        return STAGES["GREETING"][0], 1
-    
-    if current_stage == STAGES["GREETING"][0]:
-        return STAGES["GREETING"][1], 1
-    
-    if current_stage == STAGES["VALIDATION"][0]:
-        return STAGES["VALIDATION"][1], 1
-    
-    if detect_tools_trigger(text) and current_stage in ["Reflection", "Next Steps"]:
-        return STAGES["TOOLS"][0], 1
-    
-    stage_step = int(get_user_stage_step_r(user_id))
-    if current_stage == STAGES["REFLECTION"][0] and stage_step > max_step[current_stage]:
-        return STAGES["TOOLS"][0], 1
-    
-    if current_stage == STAGES["TOOLS"][0] and stage_step > max_step[current_stage]:
-        return STAGES["NEXT_STEPS"], 1
-    
-    stage_step += 1
-
-    return current_stage, stage_step
-
-def build_messages(conversation, curr_stage, stage_step,user_id) -> list:
+    return TOOLS_TRIGGER_RE.search(user_message.lower().strip()) is not None
+
+def parse_tool_name(reply: str):
+    """Return the tool tagged in an LLM reply as [tool_name=...], if any."""
+    match = TOOL_NAME_RE.search(reply)
+    return match.group(1) if match else None
+
+
+@dataclass
+class StageState:
+    """Snapshot of the stage fields of user:{id}:metadata, loaded once per turn."""
+    stage: str = "initial"
+    stage_step: int = 0
+    tool_name: str = "None"
+    plan: Optional[str] = None
+
+
+class Transition(NamedTuple):
+    source: tuple   # stages the rule applies to
+    when: str       # predicate name in PREDICATES
+    target: str     # stage to move to (step resets to 1)
+
+
+PREDICATES = {
+    "always": lambda state, text, intent: True,
+    # Resets the whole flow, so only the explicit regex may trigger it, never the classifier
+    "greeting": lambda state, text, intent: is_greeting(text),
+    # Only the batch carrying the marker restarts the flow; before turn records this looked
+    # at the whole history, so every later turn of the session restarted it again
+    "friend_forwarded": lambda state, text, intent: "<1>" in text,
+    "wants_tool": lambda state, text, intent: intent == "wants_tool" or detect_tools_trigger(text),
+    "steps_done": lambda state, text, intent: state.stage_step > max_step.get(state.stage, float("inf")),
+    "tool_finished": lambda state, text, intent: intent == "done"
+        or (intent == "decline" and state.tool_name != "None"),
+}
+
+# Checked first, in order: the first match restarts the flow from `target`
+STAGE_RESETS = (
+    Transition(("*",), "greeting", "initial"),
+    Transition(("*",), "friend_forwarded", STAGES["GREETING"][0]),
+)
+
+# First matching row wins; no match keeps the stage and bumps the step
+TRANSITIONS = (
+    Transition(("initial",), "always", STAGES["GREETING"][0]),
+    Transition((STAGES["GREETING"][0],), "always", STAGES["GREETING"][1]),
+    Transition((STAGES["VALIDATION"][0],), "always", STAGES["VALIDATION"][1]),
+    Transition((STAGES["REFLECTION"][0], STAGES["NEXT_STEPS"]), "wants_tool", STAGES["TOOLS"][0]),
+    Transition((STAGES["REFLECTION"][0],), "steps_done", STAGES["REFLECTION"][1]),
+    Transition((STAGES["TOOLS"][0],), "tool_finished", STAGES["TOOLS"][1]),
+    Transition((STAGES["TOOLS"][0],), "steps_done", STAGES["TOOLS"][1]),
+)
+
+def load_stage_state(user_id, session=None) -> StageState:
+    """Read every stage field the turn needs in a single round trip (none with the turn's session)."""
+    raw = session.fields() if session is not None else get_stage_state_r(user_id)
+    return StageState(
+        stage=raw.get("stage") or "initial",
+        stage_step=int(raw.get("stage_step") or 0),
+        tool_name=raw.get("tool_name") or "None",
+        plan=raw.get("subscription_plan"),
+    )
+
+def _matches(rule, state, text, intent):
+    return ("*" in rule.source or state.stage in rule.source) \
+        and PREDICATES[rule.when](state, text, intent)
+
+def find_stage(state: StageState, text, intent=None):
     """
-    Build the structured OpenAI chat message list for the conversation.
+    Evaluate the reset and transition tables against the state snapshot.
+    `intent` comes from the local classifier (computed here when not given).
+    """
+    if intent is None:
+        intent = classify_intent(ROLE_PREFIX_RE.sub("", text))
+
+    for rule in STAGE_RESETS:
+        if _matches(rule, state, text, intent):
+            state = replace(state, stage=rule.target, stage_step=1)
+            break
+
+    for rule in TRANSITIONS:
+        if _matches(rule, state, text, intent):
+            return rule.target, 1
+
+    return state.stage, state.stage_step + 1
+
+def save_stage_state(user_id, state: StageState, curr_stage, stage_step, reply="", session=None):
+    """
+    Persist the turn's resulting stage (and any tool the reply introduced) in one write,
+    or record it on the turn's session to be flushed with its other changes.
+    A newly suggested tool restarts the step counter.
+    """
+    fields = {"stage": curr_stage, "stage_step": stage_step}
+    tool_name = parse_tool_name(reply)
+    if tool_name and tool_name != state.tool_name:
+        fields["tool_name"] = tool_name
+        fields["stage_step"] = 1
+    if session is not None:
+        session.update(fields)
+    else:
+        set_stage_state_r(user_id, fields)
+    return fields
+
+def build_message_segments(turns, curr_stage, stage_step, curr_tool="None", memories=(), context="") -> list:
+    """
+    Build the structured OpenAI chat message list for the conversation, as
+    (segment, message) pairs so the token profiler can attribute prompt cost.
+    - Starts with recalled long-term memories from earlier sessions, if any.
     - Includes forwarded messages.
-    - Includes previous assistant reply to avoid repetition.
+    - Adds retrieved knowledge-base `context` after the conversation, if any.
+    - Includes previous assistant replies as assistant turns to avoid repetition.
     - Passes reflection turn info so LLM knows how many times reflection has occurred.
     """
-    messages = []
-    messages.append({"role": "user", "content": conversation})
-
-    
+    memory = memory_message(memories)
+    segments = [(SEGMENT_MEMORY, memory)] if memory else []
+    segments += [(SEGMENT_HISTORY, m) for m in turns_to_messages(turns)]
+    if context:
+        segments.append((SEGMENT_RAG, {
+            "role": "system",
+            "content": f"Relevant emotional context from knowledge base:\n{context}",
+        }))
 
     stage_prompt = STAGE_PROMPTS.get(curr_stage, "")
 
@@ -171,12 +254,11 @@ def build_messages(conversation, curr_stage, stage_step,user_id) -> list:
             "Build upon what the user has already shared."
         )
     elif curr_stage == "Tools":
-        curr_tool = get_tools_r(user_id)
-        messages.append({"role": "system", "content": stage_prompt})
+        segments.append((SEGMENT_STAGE, {"role": "system", "content": stage_prompt}))
         # if stage_step == 1:
         if curr_tool == "None":
             
-            messages.append({
+            segments.append((SEGMENT_TOOL, {
                         "role": "system",
                         "content": (
                             "You are in the Tools stage. Suggest ONE practical, evidence-based therapeutic tool "
@@ -185,18 +267,23 @@ def build_messages(conversation, curr_stage, stage_step,user_id) -> list:
                             "If the user declines, end this stage gracefully with a warm acknowledgment."
                             "IMPORTANT: Add the following format at the last [tool_name=<tool_name>]. If user declines approach, suggest new tool with the format [tool_name=<tool_name>]."
                         )
-                    })
+                    }))
         else:
             print("Current tool detected:", curr_tool)
-            messages.append({
+            segments.append((SEGMENT_TOOL, {
                 "role": "system",
                 "content": (f"The user is currently practicing '{curr_tool}'. "
                             "Do NOT suggest a new tool unless user reject the tool. Only guide them interactively through the next step. "
                             "Keep instructions short and supportive.")
-                })
+                }))
 
     if curr_stage != "Tools":
-        messages.append({"role": "system", "content": stage_prompt})
+        segments.append((SEGMENT_STAGE, {"role": "system", "content": stage_prompt}))
+
+    return segments
 
+def build_messages(turns, curr_stage, stage_step, curr_tool="None") -> list:
+    """Build the OpenAI chat message list for the conversation (see build_message_segments)."""
+    messages = [m for _, m in build_message_segments(turns, curr_stage, stage_step, curr_tool)]
     print(f"Built messages for stage {curr_stage} step {stage_step}:", messages)
-    return messages
\ No newline at end of file
+    return messages
@@ -48,10 +48,24 @@ def get_user_details(user_id):
     if user_doc:
         logger.info(f"Found user {user_id} in MongoDB")
         # Cache in Redis for future requests
-        ttl_limit = subscription_plan[user_doc.get("subscription_plan", {})].get("ttl", 300)
-        cache_user_detail_r(user_id, user_doc, ttl_limit)
+        _cache_user(user_id, user_doc)
 
         return user_doc
     
     # --- User not found ---
-    raise RuntimeError("Please register to use the service.")
\ No newline at end of file
+    raise RuntimeError("Please register to use the service.")
+
+def _cache_user(user_id, user_doc):
+    ttl_limit = subscription_plan.get(user_doc.get("subscription_plan"), {}).get("ttl", 300)
+    cache_user_detail_r(user_id, user_doc, ttl_limit)
+
+def reload_user_details(user_id):
+    """
+    Re-cache the user's metadata from MongoDB, replacing whatever the Redis hash holds.
+    Returns the fresh hash, or None if the user isn't in MongoDB.
+    """
+    user_doc = get_user_detail_m(user_id)
+    if not user_doc:
+        return None
+    _cache_user(user_id, user_doc)
+    return get_user_detail_r(user_id)
\ No newline at end of file
@@ -6,6 +6,9 @@ logger = logging.getLogger("handlers")
 
 user_meta_collection = "user_meta"
 user_chat_collection ="temp_user_chats"
+user_memory_collection = "user_memories"
+# Debouncer bookkeeping used to checkpoint a batch; not part of the stored chat
+BATCH_ONLY_FIELDS = ("message_id", "batch_nonce")
 
 def get_user_detail_m(user_id):
     """
@@ -46,6 +49,10 @@ def store_user_conversation_m(user_id, chat_entry):
     """
     db = MongoDB.get_db()
     chat_collection = db[user_chat_collection]
+    chat_entry = [
+        {k: v for k, v in m.items() if k not in BATCH_ONLY_FIELDS} if isinstance(m, dict) else m
+        for m in chat_entry
+    ]
 
     print(f"Storing chat entry for user_id: {user_id}: {chat_entry}")
     # Append message to the user's document, create document if it doesn't exist
@@ -131,6 +138,36 @@ def update_user_summary_m(user_id, summary_text):
         logger.warning(f"⚠️ No user found with user_id {user_id} to update summary.")
 
 
+def append_user_memory_m(user_id, memory, model, max_memories=50):
+    """
+    Append one memory ({text, tokens, ts, vector bytes}) to the user's memory
+    document, keeping only the newest `max_memories`.
+    """
+    db = MongoDB.get_db()
+    memory_collection = db[user_memory_collection]
+
+    memory_collection.update_one(
+        {"user_id": user_id},
+        {"$set": {"model": model},
+         "$push": {"memories": {"$each": [memory], "$slice": -max_memories}}},
+        upsert=True
+    )
+    logger.info(f"Stored memory for user {user_id}.")
+
+def replace_user_memories_m(user_id, memories, model):
+    """Overwrite the user's memories, e.g. after re-embedding them with a new model."""
+    db = MongoDB.get_db()
+    db[user_memory_collection].update_one(
+        {"user_id": user_id},
+        {"$set": {"model": model, "memories": memories}},
+        upsert=True
+    )
+
+def get_user_memories_m(user_id):
+    """The user's memory document ({model, memories}), or None."""
+    db = MongoDB.get_db()
+    return db[user_memory_collection].find_one({"user_id": user_id}, {"_id": 0, "model": 1, "memories": 1})
+
 def delete_user_conversation_m(user_id):
     """
     Delete all chat messages belonging to a user from user_chat_collection.
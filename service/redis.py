@@ -1,14 +1,22 @@
 from datetime import datetime
+import json
 import logging
 import re
-import threading 
-from handler.summarize_user import summarize_user_session
+import time
+from redis.exceptions import ResponseError
+from utils.config import conversation_store, subscription_plan
 from utils.redis_client import RedisClient
 from bson import ObjectId
+from prompt_engine.conversation import ASSISTANT, USER, decode_turns, make_turn, parse_legacy_conversation
 
 
 logger = logging.getLogger("handlers")
 
+# Sorted sets of user ids: metadata expiry deadlines, and sessions claimed for
+# summarizing (scored by when the claim lapses)
+SESSION_DEADLINES_KEY = "sessions:deadlines"
+SESSION_CLAIMS_KEY = "sessions:claimed"
+
 def get_user_detail_r(user_id):
     redis_client = RedisClient().get_client()
     redis_key = f"user:{user_id}:metadata"
@@ -47,35 +55,89 @@ def sanitize_for_redis(data):
     return sanitized
 
 def cache_user_detail_r(user_id, user_doc, ttl=300):
+    """Cache the user's metadata for `ttl` seconds and record when the session expires."""
     redis_client = RedisClient().get_client()
     redis_key = f"user:{user_id}:metadata"
 
     user_data = sanitize_for_redis(user_doc)
 
-    redis_client.hset(redis_key, mapping=user_data)
+    def _replace(pipe):
+        # A turn between reserve and settle still holds its reservation and settles against it.
+        # A hash without a limit is what a write after expiry left behind; nothing there is kept.
+        reserved, limit = pipe.hmget(redis_key, ["token_reserved", "token_limit"])
+        if limit is None or int(reserved or 0) <= 0:
+            reserved = None
+        pipe.multi()
+        # Replace, never merge: other counters left on a stale hash are not part of this snapshot
+        pipe.delete(redis_key)
+        pipe.hset(redis_key, mapping=user_data if reserved is None else {**user_data, "token_reserved": reserved})
+        pipe.expire(redis_key, ttl)
+        pipe.zadd(SESSION_DEADLINES_KEY, {user_id: time.time() + ttl})
+
+    redis_client.transaction(_replace, redis_key)
+
+def _is_wrongtype(error):
+    return "WRONGTYPE" in str(error)
 
-    # Set an expiration time of 5 minutes
-    redis_client.expire(redis_key, ttl)
+def _convert_conversation_string(redis_client, redis_key):
+    """Turn a string record (JSON lines, or the plain text before them) into a list, once."""
+    def _convert(pipe):
+        if pipe.type(redis_key) != "string":
+            return
+        turns = parse_legacy_conversation(pipe.get(redis_key))[-conversation_store["max_turns"]:]
+        pipe.multi()
+        pipe.delete(redis_key)
+        if turns:
+            pipe.rpush(redis_key, *(json.dumps(t) for t in turns))
+            pipe.expire(redis_key, conversation_store["ttl_seconds"])
 
-def append_conversation_redis(user_id, new_convo_str,ttl_seconds = 3600):
+    redis_client.transaction(_convert, redis_key)
+    logger.info(f"Converted {redis_key} from a string to a list")
+
+def append_conversation_redis(user_id, turns, ttl_seconds=None):
     """
-    Append a new conversation string to existing conversation in Redis with TTL.
+    Append conversation turns to the user's capped Redis list, one JSON record per
+    item: RPUSH, LTRIM to the newest `max_turns` and an EXPIRE refresh in one
+    MULTI/EXEC, so a turn costs the same bytes however long the conversation is.
+    A plain string is stored as one turn ("<bot> " marks a bot reply).
     """
     redis_client = RedisClient().get_client()
     redis_key = f"user:{user_id}:conversation"
 
-    # Get existing conversation if any
-    existing_convo = redis_client.get(redis_key)
-    if existing_convo:
-        updated_convo = existing_convo + "\n" + new_convo_str # type: ignore
-    else:
-        updated_convo = new_convo_str
-        
-    # Store back in Redis with TTL
-    redis_client.set(redis_key, updated_convo)
-    print(f"Appended conversation for user {user_id} in Redis")
+    if isinstance(turns, str):
+        if turns.startswith("<bot>"):
+            turns = [make_turn(ASSISTANT, turns[len("<bot>"):].strip())]
+        else:
+            turns = [make_turn(USER, turns)]
+
+    pipe = redis_client.pipeline()
+    pipe.rpush(redis_key, *(json.dumps(t) for t in turns))
+    pipe.ltrim(redis_key, -conversation_store["max_turns"], -1)
+    pipe.expire(redis_key, ttl_seconds or conversation_store["ttl_seconds"])
+    try:
+        pipe.execute()
+    except ResponseError as e:
+        if not _is_wrongtype(e):
+            raise
+        _convert_conversation_string(redis_client, redis_key)
+        return append_conversation_redis(user_id, turns, ttl_seconds)
+    logger.info(f"Appended {len(turns)} turns to the conversation of user {user_id}")
+
+    return turns
+
+def get_conversation_turns(user_id, max_turns=None):
+    """Read the newest turns: only the last `max_turns` records cross the network."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:conversation"
 
-    return updated_convo
+    try:
+        items = redis_client.lrange(redis_key, -(max_turns or conversation_store["window_turns"]), -1)
+    except ResponseError as e:
+        if not _is_wrongtype(e):
+            raise
+        _convert_conversation_string(redis_client, redis_key)
+        return get_conversation_turns(user_id, max_turns)
+    return decode_turns("\n".join(items))
 
 def update_token_usage_redis(user_id, tokens_used):
     """
@@ -87,6 +149,159 @@ def update_token_usage_redis(user_id, tokens_used):
     # Increment token usage
     redis_client.hincrby(redis_key, "token_usage", tokens_used)
 
+def has_token_limit(user_data):
+    return bool(user_data) and user_data.get("token_limit") not in (None, "")
+
+def get_remaining_tokens(user_data):
+    """
+    Tokens left for a cached metadata hash. None only when the user's plan has no
+    token limit; a hash missing its limit (expired, partial) has nothing left.
+    """
+    if not has_token_limit(user_data):
+        plan = subscription_plan.get((user_data or {}).get("subscription_plan") or "")
+        return None if plan is not None and plan.get("tokens") is None else 0
+    return (int(user_data["token_limit"])
+            - int(user_data.get("token_used") or 0)    # Mongo total when the hash was cached
+            - int(user_data.get("token_usage") or 0)   # spent since it was cached
+            - int(user_data.get("token_reserved") or 0))  # held by in-flight turns
+
+QUOTA_FIELDS = ("token_limit", "token_used", "token_usage", "token_reserved")
+
+def reserve_tokens_r(user_id, prompt_tokens, max_tokens, min_completion_tokens=20, user_data=None):
+    """
+    Atomically reserve prompt_tokens plus a completion allowance against the user's quota.
+    Returns the granted max_tokens (clamped to what's left), None if the user's plan
+    has no limit, or 0 if the turn doesn't fit (or the hash has no limit) and must be rejected.
+    With `user_data` (the turn's snapshot of the hash) the grant is computed from it
+    and applied in one round trip; only if someone spent in between is it undone
+    and redone against the stored values.
+    """
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+
+    if user_data is not None:
+        remaining = get_remaining_tokens(user_data)
+        if remaining is None:
+            return None
+        granted = min(max_tokens, remaining - prompt_tokens)
+        if granted < min_completion_tokens:
+            return 0
+        pipe = redis_client.pipeline()
+        pipe.hincrby(redis_key, "token_reserved", prompt_tokens + granted)
+        pipe.hmget(redis_key, QUOTA_FIELDS)
+        _, values = pipe.execute()
+        stored = dict(zip(QUOTA_FIELDS, values))
+        if not has_token_limit(stored):
+            # The hash expired since the snapshot and HINCRBY recreated it holding only the counter
+            redis_client.delete(redis_key)
+            return 0
+        if get_remaining_tokens(stored) >= 0:
+            return granted
+        redis_client.hincrby(redis_key, "token_reserved", -(prompt_tokens + granted))
+
+    def _reserve(pipe):
+        fields = QUOTA_FIELDS
+        remaining = get_remaining_tokens(dict(zip(fields, pipe.hmget(redis_key, fields))))
+        if remaining is None:
+            return None
+        granted = min(max_tokens, remaining - prompt_tokens)
+        if granted < min_completion_tokens:
+            return 0
+        pipe.multi()
+        pipe.hincrby(redis_key, "token_reserved", prompt_tokens + granted)
+        return granted
+
+    return redis_client.transaction(_reserve, redis_key, value_from_callable=True)
+
+def settle_tokens_r(user_id, reserved, tokens_used):
+    """Release a reservation and record the tokens actually used, in one round trip."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+
+    pipe = redis_client.pipeline()
+    if reserved:
+        pipe.hincrby(redis_key, "token_reserved", -reserved)
+    if tokens_used:
+        pipe.hincrby(redis_key, "token_usage", tokens_used)
+    pipe.execute()
+
+# KEYS[1]: the metadata hash. ARGV: the field count, then per field its name, "1" plus the
+# expected value (or "0" and "" when the turn read none) and the new value, then counter/delta pairs.
+# Nothing runs between the EXISTS and the writes, so the hash keeps its TTL and is never recreated.
+FLUSH_METADATA_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local stale, writes = {}, {}
+local i = 2
+for _ = 1, tonumber(ARGV[1]) do
+    local field, read, expected, value = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3]
+    local stored = redis.call('HGET', KEYS[1], field)
+    if stored == value or (stored == false and read == '0') or (read == '1' and stored == expected) then
+        writes[#writes + 1] = field
+        writes[#writes + 1] = value
+    else
+        stale[#stale + 1] = field
+    end
+    i = i + 4
+end
+if #writes > 0 then
+    redis.call('HSET', KEYS[1], unpack(writes))
+end
+for j = i, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[j], ARGV[j + 1])
+end
+return stale
+"""
+
+def flush_user_metadata_r(user_id, fields, expected, increments):
+    """
+    Write one turn's metadata changes with a single script call (one round trip).
+    A field in `fields` is only written if its stored value still equals `expected`
+    (what the turn read): a value another writer changed meanwhile is kept.
+    `increments` are HINCRBY deltas, which never conflict. The hash keeps its TTL.
+    Returns the skipped fields, or None when the hash has expired: nothing is
+    written then, so a stray write can't recreate it without its limit and TTL.
+    """
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+    increments = {k: int(n) for k, n in increments.items() if n}
+    if not (fields or increments):
+        return []
+
+    args = [len(fields)]
+    for field, value in fields.items():
+        read = expected.get(field)
+        args += [field, "0" if read is None else "1", "" if read is None else str(read), str(value)]
+    for field, amount in increments.items():
+        args += [field, amount]
+    return redis_client.register_script(FLUSH_METADATA_LUA)(keys=[redis_key], args=args)
+
+def mark_low_token_warned_r(user_id):
+    """Remember that the low-token warning was sent for this session."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+
+    redis_client.hset(redis_key, "low_token_warned", 1)
+
+def _speculation_waste_key(plan):
+    return f"speculation:waste:{plan or 'default'}:{datetime.utcnow():%Y%m%d}"
+
+def add_speculation_waste_r(plan, tokens, ttl_seconds=2 * 24 * 3600):
+    """Count tokens of a discarded speculative reply against the plan's daily total."""
+    redis_client = RedisClient().get_client()
+    redis_key = _speculation_waste_key(plan)
+
+    pipe = redis_client.pipeline()
+    pipe.incrby(redis_key, int(tokens))
+    pipe.expire(redis_key, ttl_seconds)
+    return pipe.execute()[0]
+
+def get_speculation_waste_r(plan):
+    """Tokens wasted on speculation today by users of this plan."""
+    redis_client = RedisClient().get_client()
+    return int(redis_client.get(_speculation_waste_key(plan)) or 0)
+
 def delete_user_conversation_redis(user_id):
     """
     Delete the Redis conversation key for a user.
@@ -104,6 +319,23 @@ def delete_user_conversation_redis(user_id):
     except Exception as e:
         logger.error(f"❌ Error deleting Redis conversation key for user {user_id}: {e}")
 
+def get_turn_checkpoint_r(user_id, batch_id):
+    """Fetch the checkpoint hash of a flushed batch."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"turn:{user_id}:{batch_id}"
+
+    return redis_client.hgetall(redis_key)
+
+def set_turn_checkpoint_r(user_id, batch_id, fields, ttl=3600):
+    """Merge fields into a batch checkpoint and refresh its TTL in one round trip."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"turn:{user_id}:{batch_id}"
+
+    pipe = redis_client.pipeline()
+    pipe.hset(redis_key, mapping={k: str(v) for k, v in fields.items()})
+    pipe.expire(redis_key, ttl)
+    pipe.execute()
+
 def get_user_stage_r(user_id):
     """Retrieve the user's current stage from Redis."""
     redis_client = RedisClient().get_client()
@@ -139,6 +371,23 @@ def set_user_stage_r(user_id, stage, stage_step=1):
     redis_client.hset(redis_key, "stage", stage)
     redis_client.hset(redis_key, "stage_step", str(stage_step))
 
+STAGE_STATE_FIELDS = ("stage", "stage_step", "tool_name", "subscription_plan")
+
+def get_stage_state_r(user_id):
+    """Fetch all stage-related metadata fields with a single HMGET."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+
+    values = redis_client.hmget(redis_key, STAGE_STATE_FIELDS)
+    return {k: v for k, v in zip(STAGE_STATE_FIELDS, values) if v is not None}
+
+def set_stage_state_r(user_id, fields):
+    """Write the turn's resulting stage fields with a single HSET."""
+    redis_client = RedisClient().get_client()
+    redis_key = f"user:{user_id}:metadata"
+
+    redis_client.hset(redis_key, mapping={k: str(v) for k, v in fields.items()})
+
 def detect_tools_r(text,user_id):
     match = re.search(r"\[tool_name=(.*?)\]", text)
     tool_name = match.group(1) if match else None
@@ -162,23 +411,107 @@ def get_tools_r(user_id):
         return tool_name
     return None
 
-def listen_for_expiry():
-    client = RedisClient().get_client()
-    pubsub = client.pubsub()
-    pubsub.psubscribe("__keyevent@0__:expired")  # DB 0
-    
-    print("🔔 Listening for key expiry events...")
-    for message in pubsub.listen():
-        if message['type'] == 'pmessage':
-            expired_key = message["data"]
-            print("Expired key:", expired_key)
-            if expired_key.startswith("user:") and expired_key.endswith(":metadata"):
-                user_id = expired_key.split(":")[1]
-                logger.info(f"Metadata for user {user_id} has expired in Redis.")
-                # Handle expiry event as needed
-                summarize_user_session(user_id)
-                # Remove the conversation from Redis
-                delete_user_conversation_redis(user_id)
-
-# Run in background
-threading.Thread(target=listen_for_expiry, daemon=True).start()
\ No newline at end of file
+def hold_lease_r(lease_key, token, ttl_seconds):
+    """Take the lease, or renew it if `token` already holds it. True while `token` holds it."""
+    redis_client = RedisClient().get_client()
+    ttl_ms = int(ttl_seconds * 1000)
+    if redis_client.set(lease_key, token, nx=True, px=ttl_ms):
+        return True
+
+    def _renew(pipe):
+        held = pipe.get(lease_key) == token
+        pipe.multi()
+        if held:
+            pipe.pexpire(lease_key, ttl_ms)
+        return held
+
+    return redis_client.transaction(_renew, lease_key, value_from_callable=True)
+
+def release_lease_r(lease_key, token):
+    """Give the lease up if `token` holds it."""
+    redis_client = RedisClient().get_client()
+
+    def _release(pipe):
+        held = pipe.get(lease_key) == token
+        pipe.multi()
+        if held:
+            pipe.delete(lease_key)
+
+    redis_client.transaction(_release, lease_key)
+
+def claim_due_sessions_r(limit, claim_timeout, now=None):
+    """
+    Claim up to `limit` sessions whose deadline has passed. Each due session is
+    moved with ZADD NX into the claims set plus ZREM from the deadlines set in one
+    MULTI; it is claimed only if both took effect, so two callers never both own it.
+    Nothing is WATCHed: every cache_user_detail_r writes the deadlines set, and
+    watching it would retry the claim constantly under load. A session whose
+    metadata is live again (the user came back) is rescheduled to its new expiry
+    instead. Returns the claimed user ids.
+    """
+    redis_client = RedisClient().get_client()
+    now = time.time() if now is None else now
+
+    due = redis_client.zrangebyscore(SESSION_DEADLINES_KEY, "-inf", now, start=0, num=limit, withscores=True)
+    if not due:
+        return []
+    pipe = redis_client.pipeline()
+    for user_id, _ in due:
+        pipe.zadd(SESSION_CLAIMS_KEY, {user_id: now + claim_timeout}, nx=True)
+        pipe.zrem(SESSION_DEADLINES_KEY, user_id)
+    results = pipe.execute()
+
+    won, undo = [], redis_client.pipeline()
+    for (user_id, deadline), added, removed in zip(due, results[0::2], results[1::2]):
+        if added and removed:
+            won.append(user_id)
+        elif added:
+            # Another caller claimed and finished it first: drop the claim just added
+            undo.zrem(SESSION_CLAIMS_KEY, user_id)
+        elif removed:
+            # Already claimed, and due again meanwhile: keep that deadline
+            undo.zadd(SESSION_DEADLINES_KEY, {user_id: deadline})
+
+    # Checked after the claim: a user who came back before it has a live hash by now
+    ttls = redis_client.pipeline(transaction=False)
+    for user_id in won:
+        ttls.pttl(f"user:{user_id}:metadata")
+    claimed = []
+    for user_id, ttl_ms in zip(won, ttls.execute()):
+        if ttl_ms > 0:
+            undo.zrem(SESSION_CLAIMS_KEY, user_id)
+            undo.zadd(SESSION_DEADLINES_KEY, {user_id: now + ttl_ms / 1000})
+        else:
+            claimed.append(user_id)
+    if len(undo):
+        undo.execute()
+    return claimed
+
+def finish_session_claim_r(user_id):
+    """The claimed session was handled."""
+    redis_client = RedisClient().get_client()
+    return bool(redis_client.zrem(SESSION_CLAIMS_KEY, user_id))
+
+def retry_session_r(user_id, delay_seconds):
+    """Drop the claim and put the session back, due after `delay_seconds`."""
+    redis_client = RedisClient().get_client()
+
+    pipe = redis_client.pipeline()
+    pipe.zrem(SESSION_CLAIMS_KEY, user_id)
+    pipe.zadd(SESSION_DEADLINES_KEY, {user_id: time.time() + delay_seconds})
+    pipe.execute()
+
+def reclaim_stale_sessions_r(now=None):
+    """Put claims that lapsed (their claimer died or hung) back as due. Returns the user ids."""
+    redis_client = RedisClient().get_client()
+    now = time.time() if now is None else now
+
+    def _reclaim(pipe):
+        stale = pipe.zrangebyscore(SESSION_CLAIMS_KEY, "-inf", now)
+        pipe.multi()
+        if stale:
+            pipe.zrem(SESSION_CLAIMS_KEY, *stale)
+            pipe.zadd(SESSION_DEADLINES_KEY, {user_id: now for user_id in stale})
+        return stale
+
+    return redis_client.transaction(_reclaim, SESSION_CLAIMS_KEY, value_from_callable=True)
@@ -0,0 +1,26 @@
+import faiss
+import numpy as np
+import pytest
+
+from prompt_engine.ann_index import INDEX_KINDS, apply_search_params, build_ann_index, prepare_query
+
+def _corpus(n, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((n, dim), dtype=np.float32)
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+def test_every_kind_finds_an_exact_match(kind):
+    corpus = _corpus(10000)
+    index = apply_search_params(build_ann_index(corpus, kind), nprobe=16)
+    assert index.metric_type == faiss.METRIC_INNER_PRODUCT
+    # Scale does not matter: queries are normalised like the corpus
+    _, ids = index.search(prepare_query(index, corpus[7] * 5.0), 1)
+    assert ids[0][0] == 7
+
+def test_small_corpus_falls_back_to_exact():
+    index = build_ann_index(_corpus(20), "ivf_pq")
+    assert isinstance(index, faiss.IndexFlatIP)
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        build_ann_index(_corpus(5), "annoy")
@@ -0,0 +1,106 @@
+import pytest
+from handler import receive_message as rm
+from handler import session as session_module
+from handler.checkpoint import batch_hash
+from service.redis import cache_user_detail_r, get_user_detail_r
+
+def test_batch_hash_prefers_message_ids():
+    a = batch_hash("u", [{"message": "ok", "message_id": "wamid.1"}], "user: ok\n")
+    b = batch_hash("u", [{"message": "ok", "message_id": "wamid.2"}], "user: ok\n")
+    c = batch_hash("u", [{"message": "ok", "message_id": None}], "user: ok\n")
+    assert a != b and len(c) == 32
+
+def test_retry_resumes_without_repeating_llm(fake_redis, monkeypatch):
+    calls = {"llm": 0, "post": 0, "send": 0}
+
+    def fake_llm(ws_id, convo, convo_str, session=None):
+        calls["llm"] += 1
+        return "Reply", 42
+
+    def fake_post(total_tokens, ws_id, response, warn_low_tokens=False):
+        calls["post"] += 1
+
+    def flaky_send(ws_id, text):
+        calls["send"] += 1
+        if calls["send"] == 1:
+            raise RuntimeError("Graph down")
+
+    monkeypatch.setattr(rm, "prompt_LLM", fake_llm)
+    monkeypatch.setattr(rm, "post_prompt_tasks", fake_post)
+    monkeypatch.setattr(rm, "send_text_reply", flaky_send)
+    monkeypatch.setattr(rm, "store_user_conversation_m", lambda *a: None)
+
+    combined = [{"message": "hello", "role": "user", "message_id": "wamid.ck1"}]
+    with pytest.raises(RuntimeError):
+        rm.process_message("ck-user", combined, "user: hello\n")
+    rm.process_message("ck-user", combined, "user: hello\n")
+    rm.process_message("ck-user", combined, "user: hello\n")  # already sent: no-op
+
+    assert calls == {"llm": 1, "post": 1, "send": 2}
+
+def test_llm_step_is_settled_before_it_is_checkpointed(fake_redis, monkeypatch):
+    calls = {"llm": 0, "flush": 0}
+    flush = session_module.flush_user_metadata_r
+
+    def fake_llm(ws_id, convo, convo_str, session=None):
+        calls["llm"] += 1
+        session.set("stage", "Tools")
+        session.settle_tokens(0, 42)
+        return "Reply", 42
+
+    def flaky_flush(*args):
+        calls["flush"] += 1
+        # Redis is unreachable for the whole first attempt
+        if calls["flush"] == 1:
+            raise ConnectionError("redis down")
+        return flush(*args)
+
+    monkeypatch.setattr(rm, "prompt_LLM", fake_llm)
+    monkeypatch.setattr(rm, "post_prompt_tasks", lambda *a, **k: None)
+    monkeypatch.setattr(rm, "send_text_reply", lambda ws_id, text: None)
+    monkeypatch.setattr(rm, "store_user_conversation_m", lambda *a: None)
+    monkeypatch.setattr(session_module, "flush_user_metadata_r", flaky_flush)
+    cache_user_detail_r("ck-settle", {"stage": "Reflection", "token_limit": 1000}, 60)
+
+    combined = [{"message": "hello", "role": "user", "message_id": "wamid.ck2"}]
+    with pytest.raises(ConnectionError):
+        rm.process_message("ck-settle", combined, "user: hello\n")
+    # The unsettled LLM step is not checkpointed, so the retry runs (and settles) it
+    rm.process_message("ck-settle", combined, "user: hello\n")
+
+    stored = get_user_detail_r("ck-settle")
+    assert calls["llm"] == 2
+    assert (stored["stage"], stored["token_usage"]) == ("Tools", "42")
+
+def test_turn_writes_metadata_once_with_the_warning_flag(fake_redis, monkeypatch):
+    flushes, sent = [0], []
+    flush = session_module.flush_user_metadata_r
+
+    def fake_llm(ws_id, convo, convo_str, session=None):
+        session.settle_tokens(0, 950)
+        return "Reply", 950
+
+    def counting_flush(*args):
+        flushes[0] += 1
+        return flush(*args)
+
+    monkeypatch.setattr(rm, "prompt_LLM", fake_llm)
+    monkeypatch.setattr(rm, "send_text_reply", lambda ws_id, text: sent.append(text))
+    monkeypatch.setattr(rm, "store_user_conversation_m", lambda *a: None)
+    monkeypatch.setattr(rm, "update_user_token_usage", lambda *a: None)
+    monkeypatch.setattr(session_module, "flush_user_metadata_r", counting_flush)
+    cache_user_detail_r("ck-warn", {"stage": "Reflection", "token_limit": 1000}, 60)
+
+    combined = [{"message": "hello", "role": "user", "message_id": "wamid.ck3"}]
+    rm.process_message("ck-warn", combined, "user: hello\n")
+
+    stored = get_user_detail_r("ck-warn")
+    assert flushes[0] == 1
+    assert (stored["token_usage"], stored["low_token_warned"]) == ("950", "1")
+    assert sent[0].startswith("Warning") and sent[1] == "Reply"
+
+def test_batch_without_ids_is_told_apart_from_a_repeat():
+    first = [{"message": "ok", "message_id": None, "batch_nonce": "a"}]
+    repeat = [{"message": "ok", "message_id": None, "batch_nonce": "b"}]
+    assert batch_hash("u", first, "user: ok\n") == batch_hash("u", first, "user: ok\n")
+    assert batch_hash("u", first, "user: ok\n") != batch_hash("u", repeat, "user: ok\n")
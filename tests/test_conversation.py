@@ -0,0 +1,42 @@
+from prompt_engine.conversation import (
+    ASSISTANT, THIRD, USER, decode_turns, encode_turns, make_turn, trim_turns, turns_from_batch, turns_to_messages
+)
+from service.redis import append_conversation_redis, get_conversation_turns
+
+def test_turns_round_trip_through_redis(fake_redis):
+    user = "conv1"
+    append_conversation_redis(user, turns_from_batch([{"message": "I feel stuck", "role": "user"}]))
+    append_conversation_redis(user, [make_turn(ASSISTANT, "That sounds heavy.")])
+    turns = get_conversation_turns(user)
+    assert [(t["role"], t["text"]) for t in turns] == [(USER, "I feel stuck"), (ASSISTANT, "That sounds heavy.")]
+
+def test_windowed_read_returns_newest_turns(fake_redis):
+    user = "conv2"
+    for i in range(50):
+        append_conversation_redis(user, [make_turn(USER, f"message number {i}")])
+    turns = get_conversation_turns(user, max_turns=5)
+    assert [t["text"] for t in turns] == [f"message number {i}" for i in range(45, 50)]
+
+def test_decode_ignores_garbage():
+    blob = 'ole": "user"}\n' + encode_turns([make_turn(USER, "héllo")])
+    assert blob.isascii()
+    assert [t["text"] for t in decode_turns(blob)] == ["héllo"]
+
+def test_messages_alternate_and_label_forwards():
+    turns = turns_from_batch([
+        {"message": "why are you ignoring me", "role": "third-forwarded"},
+        {"message": "I was busy", "role": "user-forwarded"},
+    ]) + [make_turn(ASSISTANT, "How did that feel?"), make_turn(USER, "bad")]
+    assert turns[0]["role"] == THIRD
+    messages = turns_to_messages(turns)
+    assert [m["role"] for m in messages] == ["user", "assistant", "user"]
+    assert messages[0]["content"] == (
+        "Forwarded message from the other person: why are you ignoring me\n"
+        "Forwarded message I sent them: I was busy"
+    )
+
+def test_trim_keeps_newest_turns_within_budget():
+    turns = [make_turn(USER, "word " * 100) for _ in range(5)] + [make_turn(USER, "latest")]
+    kept = trim_turns(turns, token_budget=150)
+    assert kept[-1]["text"] == "latest"
+    assert sum(t["tokens"] for t in kept) <= 150
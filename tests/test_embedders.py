@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.embedders import LocalHashEmbedder, make_embedder
+
+def test_local_embedder_is_deterministic_and_batched():
+    a, b = LocalHashEmbedder(dim=64), LocalHashEmbedder(dim=64)
+    texts = ["my friend seems distant", "I am angry at my brother", ""]
+    batch = a.embed(texts)
+    assert batch.shape == (3, 64)
+    assert np.allclose(batch[0], b.embed([texts[0]])[0])
+    assert np.allclose(np.linalg.norm(batch[:2], axis=1), 1.0)
+    assert not batch[2].any()
+
+def test_local_embedder_ranks_overlapping_text_higher():
+    e = LocalHashEmbedder()
+    q, near, far = e.embed(["friend is distant lately", "friend seems distant", "angry at family member"])
+    assert q @ near > q @ far
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        make_embedder("word2vec")
+
+def test_offline_retrieval_end_to_end(tmp_path, monkeypatch):
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    knowledge = ki.KnowledgeIndex.load()
+    top = knowledge.search(e.embed(["I think my friend seems distant"])[0], top_k=1)[0]
+    assert top["situation"] == "friend seems distant"
+    with pytest.raises(ki.KnowledgeIndexUnavailable):
+        knowledge.search(np.ones(7, dtype=np.float32))
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from utils.embedding_cache import EmbeddingCache
+
+class _Embedder:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    def __call__(self, text):
+        self.calls += 1
+        time.sleep(self.delay)
+        return [len(text), 0.5, -1.0]
+
+def test_memory_then_redis_tier(fake_redis):
+    embed = _Embedder()
+    cache = EmbeddingCache(embed, "m1", max_items=1)
+    first = cache.get("I don't know")
+    assert cache.get("  i DON'T   know ").tolist() == first.tolist()
+    assert embed.calls == 1 and cache.hits["memory"] == 1
+
+    raw = fake_redis.execute_command("STRLEN", cache.key("I don't know"))
+    assert raw == 3 * 2  # float16 bytes
+
+    cache.get("something else")  # evicts the first key from the 1-item LRU
+    assert np.allclose(cache.get("I don't know"), first)
+    assert embed.calls == 2 and cache.hits["redis"] == 1
+    assert cache.stats()["hit_rate"] == pytest.approx(0.5)
+
+def test_concurrent_misses_share_one_call(fake_redis):
+    embed = _Embedder(delay=0.05)
+    cache = EmbeddingCache(embed, "m2", use_redis=False)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("what should i do"))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert embed.calls == 1
+    assert len(results) == 8 and cache.coalesced == 7
+
+def test_errors_are_not_cached(fake_redis):
+    calls = []
+    def flaky(text):
+        calls.append(text)
+        if len(calls) == 1:
+            raise TimeoutError("upstream")
+        return [1.0, 2.0]
+    cache = EmbeddingCache(flaky, "m3", use_redis=False)
+    with pytest.raises(TimeoutError):
+        cache.get("hi")
+    assert cache.get("hi").tolist() == [1.0, 2.0]
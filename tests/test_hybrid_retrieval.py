@@ -0,0 +1,36 @@
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+from prompt_engine.embedders import LocalHashEmbedder
+
+def test_tokenize_drops_stopwords_and_suffixes():
+    assert tokenize("I feel unheard and my friends are ignoring me") == ["feel", "unheard", "friend", "ignor"]
+
+def test_bm25_ranks_and_scores_confidence():
+    bm25 = BM25Index(["friend seems distant", "user feels guilty", "friend gives harsh feedback"])
+    hits = bm25.search("my friend seems distant lately")
+    assert hits[0][0] == 0 and hits[0][2] == pytest.approx(1.0)
+    assert hits[1][0] == 2 and hits[1][2] < 0.5
+    assert bm25.search("hello") == []
+
+def test_rrf_rewards_agreement():
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]], k=60, top_k=2) == [1, 3]
+
+@pytest.fixture
+def knowledge(tmp_path, monkeypatch):
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    return ki.KnowledgeIndex.load(), e
+
+def test_confident_lexical_hit_skips_embedding(knowledge):
+    index, e = knowledge
+    calls = []
+    embed = lambda text: calls.append(text) or e.embed([text])[0]
+
+    top = index.retrieve("I feel so guilty", embed, top_k=3, mode="hybrid")
+    assert top[0]["situation"] == "user feels guilty" and calls == []
+
+    index.retrieve("everything is falling apart", embed, top_k=3, mode="hybrid")
+    assert calls == ["everything is falling apart"]
@@ -0,0 +1,89 @@
+import json
+import shutil
+import time
+
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.embedders import LocalHashEmbedder, embedder_for_model
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    monkeypatch.setattr(ki, "_knowledge_index", None)
+    monkeypatch.setattr(ki, "_next_pointer_check", 0.0)
+    monkeypatch.setitem(ki.version_config, "refresh_seconds", 0)
+    return tmp_path
+
+def _write_kb(path, n, suffix=""):
+    path.write_text("\n".join(json.dumps({"situation": f"user situation {i}", "tone": "calming",
+                                          "response": f"r{i}{suffix}"}) for i in range(n)))
+
+def test_builds_are_versioned_and_unchanged_builds_are_noops(kb):
+    jsonl = kb / "kb.jsonl"
+    e = LocalHashEmbedder()
+    _write_kb(jsonl, 4)
+    first = indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)
+    again = indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)
+    assert again["unchanged"] and again["version"] == first["version"] == ki.current_version()
+    assert indexer.list_versions() == [first["version"]]
+
+    manifest = ki.read_manifest(ki.version_dir(first["version"]))
+    assert (manifest["model"], manifest["dim"], len(manifest["content_hash"])) == (e.name, e.dim, 64)
+
+    _write_kb(jsonl, 4, "!")
+    staged = indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None, activate=False)
+    assert ki.current_version() == first["version"] and staged["version"] in indexer.list_versions()
+    indexer.set_current_version(staged["version"])
+    assert ki.KnowledgeIndex.load().data[0]["response"] == "r0!"
+    with pytest.raises(ValueError):
+        indexer.set_current_version("no-such-version")
+
+def test_old_versions_are_collected_but_never_the_current_one(kb):
+    jsonl = kb / "kb.jsonl"
+    e = LocalHashEmbedder()
+    built = []
+    for i in range(4):
+        _write_kb(jsonl, 3, "!" * i)
+        built.append(indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None, keep_versions=2)["version"])
+    assert indexer.list_versions() == built[-2:]
+
+    indexer.set_current_version(built[2])
+    _write_kb(jsonl, 3, "?")
+    stats = indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None, activate=False, keep_versions=1)
+    assert stats["removed_versions"] == [built[3]]
+    assert indexer.list_versions() == [built[2], stats["version"]]
+
+def test_readers_swap_in_the_background_and_in_flight_searches_finish(kb):
+    jsonl = kb / "kb.jsonl"
+    e = LocalHashEmbedder()
+    _write_kb(jsonl, 5)
+    indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)
+    old = ki.get_knowledge_index()
+
+    _write_kb(jsonl, 6)
+    stats = indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)
+    deadline = time.time() + 5
+    while ki.get_knowledge_index() is old and time.time() < deadline:
+        time.sleep(0.01)
+    fresh = ki.get_knowledge_index()
+    assert fresh.version == stats["version"] and fresh.index.ntotal == 6 and fresh._lexical is not None
+
+    # A search holding the old object still completes after its files are gone
+    shutil.rmtree(old.path)
+    query = e.embed(["user situation 3"])[0]
+    assert old.search(query, top_k=1)[0]["response"] == "r3"
+
+def test_model_migration_builds_a_new_version_queries_can_follow(kb):
+    jsonl = kb / "kb.jsonl"
+    _write_kb(jsonl, 3)
+    small = LocalHashEmbedder(dim=64)
+    indexer.build_index(small.embed, small.name, str(jsonl), docs_dir=None)
+    large = LocalHashEmbedder(dim=128)
+    stats = indexer.build_index(large.embed, large.name, str(jsonl), docs_dir=None)
+    assert stats["embedded"] == 3
+
+    knowledge = ki.KnowledgeIndex.load()
+    assert (knowledge.model, knowledge.index.d) == (large.name, 128)
+    follower = embedder_for_model(knowledge.model)
+    assert follower.name == large.name and knowledge.search(follower.embed(["user situation 1"])[0], 1)
@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+
+class _BatchEmbedder:
+    def __init__(self):
+        self.texts = []
+        self.in_flight = self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self.lock:
+            self.texts.extend(texts)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return [[float(len(t)), 1.0, 0.0, 0.0] for t in texts]
+
+def _write_kb(path, n, changed=()):
+    rows = [{"situation": f"s{i}", "tone": "calming", "response": f"r{i}{'!' if i in changed else ''}"}
+            for i in range(n)]
+    path.write_text("\n".join(json.dumps(r) for r in rows))
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    return tmp_path
+
+def test_rebuild_embeds_only_the_delta(kb):
+    jsonl = kb / "kb.jsonl"
+    _write_kb(jsonl, 10)
+    embed = _BatchEmbedder()
+    stats = indexer.build_index(embed, "m", str(jsonl), docs_dir=None, batch_size=3, concurrency=2)
+    assert stats["embedded"] == 10 and embed.peak <= 2
+
+    _write_kb(jsonl, 12, changed={4})
+    embed = _BatchEmbedder()
+    stats = indexer.build_index(embed, "m", str(jsonl), docs_dir=None)
+    assert (stats["items"], stats["embedded"], stats["reused"], stats["removed"]) == (12, 3, 9, 1)
+    assert sorted(embed.texts) == ["s10 - r10", "s11 - r11", "s4 - r4!"]
+
+    loaded = ki.KnowledgeIndex.load()
+    assert loaded.index.ntotal == 12 and loaded.data[4]["response"] == "r4!"
+    assert not [p for p in (kb / "knowledge").iterdir() if p.name.startswith(".tmp-")]
+
+def test_model_change_reembeds_everything(kb):
+    jsonl = kb / "kb.jsonl"
+    _write_kb(jsonl, 4)
+    indexer.build_index(_BatchEmbedder(), "m", str(jsonl), docs_dir=None)
+    assert indexer.build_index(_BatchEmbedder(), "m2", str(jsonl), docs_dir=None)["embedded"] == 4
+
+def test_docs_are_chunked_into_the_index(kb):
+    jsonl = kb / "kb.jsonl"
+    _write_kb(jsonl, 1)
+    docs = kb / "docs"
+    docs.mkdir()
+    (docs / "guide.txt").write_text("word " * 600)
+    stats = indexer.build_index(_BatchEmbedder(), "m", str(jsonl), docs_dir=str(docs))
+    assert stats["items"] == 1 + 2
+    assert ki.KnowledgeIndex.load().data[1]["source"] == "guide.txt"
+
+def test_only_doc_files_are_read(kb):
+    jsonl = kb / "kb.jsonl"
+    _write_kb(jsonl, 1)
+    docs = kb / "docs"
+    (docs / "drafts").mkdir(parents=True)
+    (docs / "guide.md").write_text("word " * 10)
+    (docs / ".guide.md.swp").write_text("junk")
+    (docs / "logo.png").write_bytes(b"\x89PNG")
+    assert [r.get("source") for _, r in indexer.load_items(str(jsonl), str(docs))] == [None, "guide.md"]
+
+def test_empty_corpus_is_a_clear_error(kb):
+    jsonl = kb / "kb.jsonl"
+    jsonl.write_text("\n")
+    with pytest.raises(ValueError, match="Nothing to index"):
+        indexer.build_index(_BatchEmbedder(), "m", str(jsonl), docs_dir=None)
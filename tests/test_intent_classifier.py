@@ -0,0 +1,23 @@
+from benchmarks.intent_classifier import training_overlap
+from prompt_engine.intent_classifier import IntentClassifier, hashed_ngram_vector
+
+def test_features_are_normalised_and_stable():
+    a = hashed_ngram_vector("What should I do?")
+    b = hashed_ngram_vector("what should i do")
+    assert abs(float(a @ a) - 1.0) < 1e-5
+    assert float(a @ b) > 0.99
+    assert not hashed_ngram_vector("!!!").any()
+
+def test_classifies_examples():
+    clf = IntentClassifier.from_jsonl()
+    assert clf.classify("hey there")[0] == "greeting"
+    assert clf.classify("what should i do about my brother")[0] == "wants_tool"
+    assert clf.classify("thanks, bye")[0] == "done"
+
+def test_short_replies_are_not_intents():
+    clf = IntentClassifier.from_jsonl()
+    for text in ("what do you mean", "what?", "i think so", "thanks", "hey so about that"):
+        assert clf.classify(text)[0] == "other", text
+
+def test_eval_set_is_held_out():
+    assert training_overlap() == []
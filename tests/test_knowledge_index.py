@@ -0,0 +1,54 @@
+import json
+import threading
+
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.embedders import LocalHashEmbedder
+
+# Seeded hashed n-gram features: the same vectors in every process, no network
+EMBEDDER = LocalHashEmbedder(dim=64)
+
+def _embed(text):
+    return EMBEDDER.embed([text])[0]
+
+def _build():
+    indexer.build_index(EMBEDDER.embed, EMBEDDER.name, docs_dir=None)
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    jsonl = tmp_path / "kb.jsonl"
+    jsonl.write_text("\n".join(json.dumps({"situation": f"s{i}", "tone": "calming", "response": f"r{i}"})
+                               for i in range(5)))
+    monkeypatch.setattr(ki, "JSONL_PATH", str(jsonl))
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    monkeypatch.setattr(ki, "_knowledge_index", None)
+    return tmp_path
+
+def test_missing_artifacts_do_not_trigger_a_rebuild(paths):
+    with pytest.raises(ki.KnowledgeIndexUnavailable):
+        ki.get_knowledge_index()
+
+def test_loaded_once_and_shared_across_threads(paths):
+    _build()
+    seen = []
+    threads = [threading.Thread(target=lambda: seen.append(ki.get_knowledge_index())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(k) for k in seen}) == 1
+    assert seen[0].search(_embed("s2 - r2"), top_k=1)[0]["response"] == "r2"
+
+def test_reload_swaps_instance(paths):
+    _build()
+    first = ki.get_knowledge_index()
+    assert ki.reload_knowledge_index() is not first
+    assert ki.get_knowledge_index() is not first
+
+def test_warm_builds_lazy_parts_up_front(paths):
+    _build()
+    knowledge = ki.warm_knowledge_index()
+    assert knowledge is ki.get_knowledge_index()
+    assert knowledge._lexical is not None
+    assert knowledge.partition("calming") is not None
@@ -0,0 +1,60 @@
+from handler import summarize_user as su
+from prompt_engine.conversation import USER, make_turn
+from prompt_engine.embedders import LocalHashEmbedder
+from prompt_engine.memory import recall, remember
+from prompt_engine.user_stage import build_message_segments
+from service.mongo import add_new_user, get_user_memories_m, store_user_conversation_m
+from utils.token_profile import SEGMENT_HISTORY, SEGMENT_MEMORY
+
+SUMMARIES = [
+    "The user argued with their sister about caring for their mother and felt unappreciated.",
+    "The user was anxious about asking their manager for a raise and practised what to say.",
+    "The user's roommate keeps leaving dishes in the sink; they agreed to try a calm request.",
+]
+
+def _embedder():
+    e = LocalHashEmbedder()
+    return e, lambda text: e.embed([text])[0]
+
+def test_recall_ranks_and_respects_budget(fake_mongo):
+    e, embed = _embedder()
+    for text in SUMMARIES:
+        remember("mem1", text, e.embed, e.name)
+
+    top = recall("mem1", "my sister and I fought about mother again", embed, e.name, top_k=1, min_score=0.0)
+    assert top == [SUMMARIES[0]]
+
+    both = recall("mem1", "sister mother manager raise", embed, e.name, top_k=2, min_score=0.0)
+    assert both == [SUMMARIES[0], SUMMARIES[1]]  # oldest first
+    assert recall("mem1", "sister mother manager raise", embed, e.name, top_k=2, token_budget=25,
+                  min_score=0.0) in ([SUMMARIES[0]], [SUMMARIES[1]])
+    assert recall("nobody", "anything", embed, e.name) == []
+
+def test_store_is_capped_and_migrates_models(fake_mongo):
+    e, embed = _embedder()
+    for text in SUMMARIES:
+        remember("mem2", text, e.embed, e.name, max_memories=2)
+    assert [m["text"] for m in get_user_memories_m("mem2")["memories"]] == SUMMARIES[1:]
+
+    other = LocalHashEmbedder(dim=128)
+    assert recall("mem2", "manager raise", lambda t: other.embed([t])[0], other.name) == []
+    assert remember("mem2", "The user set a boundary with their roommate.", other.embed, other.name,
+                    max_memories=2) == 2
+    doc = get_user_memories_m("mem2")
+    assert doc["model"] == other.name and len(doc["memories"]) == 2
+    assert len(doc["memories"][0]["vector"]) == 128 * 2
+
+def test_memories_lead_the_prompt():
+    segments = build_message_segments([make_turn(USER, "hi again")], "Greeting", 1, memories=["Argued with sister."])
+    assert [s for s, _ in segments][:2] == [SEGMENT_MEMORY, SEGMENT_HISTORY]
+    assert "Argued with sister." in segments[0][1]["content"]
+
+def test_session_summary_becomes_a_memory(fake_mongo, monkeypatch):
+    add_new_user("mem3", {"is_registered": True})
+    store_user_conversation_m("mem3", [{"message": "my sister ignores me", "role": "user"}])
+    monkeypatch.setattr(su, "summarize_with_llm", lambda prompt, limit, user_id: SUMMARIES[0])
+    e = LocalHashEmbedder()
+    monkeypatch.setattr(su, "get_embedder", lambda: e)
+
+    su.summarize_user_session("mem3")
+    assert [m["text"] for m in get_user_memories_m("mem3")["memories"]] == [SUMMARIES[0]]
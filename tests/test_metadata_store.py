@@ -0,0 +1,53 @@
+import pickle
+
+import pytest
+
+from prompt_engine.metadata_store import MetadataStore, migrate_pickle, write_store
+
+RECORDS = [
+    {"situation": "friend seems distant", "tone": "empathetic", "response": "That must have felt strange."},
+    {"situation": "user is angry", "tone": "calming", "response": "Take a moment to breathe — it’s valid."},
+    {"situation": "guide.txt", "tone": "reference", "response": "chunk", "source": "guide.txt"},
+]
+
+def test_round_trip_is_lazy_and_exact(tmp_path):
+    path = str(tmp_path / "meta.bin")
+    write_store(RECORDS, path)
+    store = MetadataStore(path)
+    assert len(store) == 3
+    assert store[1]["response"] == RECORDS[1]["response"]
+    assert [dict(r) for r in store] == RECORDS
+    assert "source" not in store[0] and store[-1]["source"] == "guide.txt"
+    with pytest.raises(IndexError):
+        store[3]
+
+def test_empty_string_is_not_a_missing_field(tmp_path):
+    path = str(tmp_path / "meta.bin")
+    records = [{"x": "", "tone": ""}, {"tone": "calming"}, {"x": "y", "tone": "calming"}]
+    write_store(records, path)
+    store = MetadataStore(path)
+    assert store[0]["x"] == "" and "x" not in store[1]
+    assert [dict(r) for r in store] == records
+
+def test_non_string_values_are_rejected(tmp_path):
+    with pytest.raises(TypeError, match="'n' is int"):
+        write_store([{"n": 1}], str(tmp_path / "meta.bin"))
+
+def test_tone_is_a_small_code_column(tmp_path):
+    path = str(tmp_path / "meta.bin")
+    write_store(RECORDS, path)
+    codes, vocab = MetadataStore(path).codes("tone")
+    assert codes.dtype.itemsize == 1
+    assert [vocab[c] for c in codes] == ["empathetic", "calming", "reference"]
+
+def test_migrate_from_pickle(tmp_path):
+    src, dst = tmp_path / "vectors.pkl", str(tmp_path / "meta.bin")
+    src.write_bytes(pickle.dumps(RECORDS))
+    assert migrate_pickle(str(src), dst) == 3
+    assert [dict(r) for r in MetadataStore(dst)] == RECORDS
+
+def test_rejects_other_files(tmp_path):
+    bad = tmp_path / "bad.bin"
+    bad.write_bytes(b"not a store at all")
+    with pytest.raises(ValueError):
+        MetadataStore(str(bad))
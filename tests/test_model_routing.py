@@ -0,0 +1,13 @@
+from prompt_engine.model_routing import get_stage_route
+
+def test_short_stage_is_cheaper_than_default():
+    greeting = get_stage_route("Greeting")
+    default = get_stage_route("Unknown stage")
+    assert greeting["max_tokens"] < default["max_tokens"]
+    assert default == {"model": "gpt-4o-mini", "max_tokens": 300, "temperature": 0.8}
+
+def test_plan_overrides():
+    assert get_stage_route("Tools", "PROMO_FLANK_PRO")["model"] == "gpt-4o"
+    assert get_stage_route("Tools", "PROMO_FLANK_TRIAL")["max_tokens"] == 150
+    # Cap never raises a stage's own limit
+    assert get_stage_route("Greeting", "PROMO_FLANK_TRIAL")["max_tokens"] == 80
@@ -40,4 +40,10 @@ def test_token_usage(fake_mongo):
     add_new_user(user, {"is_registered": True})
     update_user_token_usage(user, 25)
     doc = get_user_detail_m(user)
-    assert doc.get("token_used") in (25, "25")
\ No newline at end of file
+    assert doc.get("token_used") in (25, "25")
+def test_chat_docs_keep_their_shape(fake_mongo):
+    user = "556"
+    batch = [{"message": "hi", "role": "user", "message_id": "wamid.1", "batch_nonce": "abc"}]
+    store_user_conversation_m(user, batch)
+    assert get_user_conversation(user) == [{"message": "hi", "role": "user"}]
+    assert batch[0]["batch_nonce"] == "abc"  # the checkpoint still hashes the batch as it was
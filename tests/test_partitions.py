@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from prompt_engine import indexer, knowledge_index as ki
+from prompt_engine.embedders import LocalHashEmbedder
+from utils.config import knowledge_partitions
+from utils.metrics import metrics
+
+def test_router_maps_stages_to_partitions():
+    assert ki.partitions_for_stage("Tools") == ("guiding", "calming", "encouraging")
+    assert ki.partitions_for_stage("Unknown stage") is None
+    assert ki.partitions_for_stage(None) is None
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    monkeypatch.setattr(ki, "KNOWLEDGE_DIR", str(tmp_path / "knowledge"))
+    return tmp_path
+
+def _write_kb(path, rows):
+    path.write_text("\n".join(json.dumps({"situation": s, "tone": t, "response": r}) for s, t, r in rows))
+
+def test_only_changed_partitions_are_rebuilt(kb):
+    jsonl = kb / "kb.jsonl"
+    e = LocalHashEmbedder()
+    rows = [("user feels guilty", "empathetic", "a"), ("user is angry", "calming", "b"),
+            ("user wants a plan", "guiding", "c")]
+    _write_kb(jsonl, rows)
+    assert sorted(indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)["partitions_rebuilt"]) == [
+        "calming", "empathetic", "guiding"]
+
+    _write_kb(jsonl, rows[:2] + [("user wants a plan", "guiding", "c, revised")])
+    assert indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)["partitions_rebuilt"] == ["guiding"]
+    assert indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None,
+                               rebuild_partitions=["calming"])["partitions_rebuilt"] == ["calming"]
+
+    _write_kb(jsonl, rows[:2])
+    indexer.build_index(e.embed, e.name, str(jsonl), docs_dir=None)
+    partitions_dir = ki.version_dir(ki.current_version(), str(kb / "knowledge")) + "/partitions"
+    assert sorted(os.listdir(partitions_dir)) == [
+        "calming.ids.npy", "calming.index", "empathetic.ids.npy", "empathetic.index"]
+
+def test_stage_restricts_retrieval_to_routed_tones(kb):
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    knowledge = ki.KnowledgeIndex.load()
+    embed = lambda text: e.embed([text])[0]
+    allowed = set(ki.partitions_for_stage("Next Steps"))
+
+    for mode in ("vector", "lexical", "hybrid"):
+        records = knowledge.retrieve("I feel guilty about the conflict with my friend", embed, top_k=3,
+                                     mode=mode, stage="Next Steps")
+        assert records and {r["tone"] for r in records} <= allowed
+
+    unrouted = knowledge.retrieve("I feel so guilty", embed, top_k=1, mode="lexical")
+    assert unrouted[0]["situation"] == "user feels guilty"
+
+def test_missing_partition_filters_the_full_index(kb):
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    knowledge = ki.KnowledgeIndex.load()
+    for path in ki.partition_paths("guiding", knowledge.partitions_dir):
+        os.remove(path)
+    before = metrics.snapshot()["counters"].get("rag.partition_missing{partition=guiding}", 0)
+    ids = knowledge.search_ids(e.embed(["guilty"])[0], top_k=4, partitions=("guiding", "encouraging"))
+    assert len(ids) == 4 and {knowledge.data[i]["tone"] for i in ids} == {"guiding", "encouraging"}
+    assert metrics.snapshot()["counters"]["rag.partition_missing{partition=guiding}"] == before + 1
+
+def test_routed_search_without_any_partitions(kb):
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    knowledge = ki.KnowledgeIndex.load()
+    shutil.rmtree(knowledge.partitions_dir)
+    embed = lambda text: e.embed([text])[0]
+    allowed = set(ki.partitions_for_stage("Greeting"))
+    records = knowledge.retrieve("I feel guilty about my friend", embed, top_k=3, mode="vector", stage="Greeting")
+    assert len(records) == 3 and {r["tone"] for r in records} <= allowed
+
+def test_served_version_answers_routed_vector_queries():
+    knowledge = ki.KnowledgeIndex.load()
+    query = np.load(os.path.join(knowledge.path, ki.EMBEDDINGS_FILE), mmap_mode="r")[0]
+    assert all(knowledge.partition(name) is not None for name in ki.partitions_for_stage("Greeting"))
+    for stage in knowledge_partitions["stage_routes"]:
+        assert len(knowledge.search_ids(query, 3, ki.partitions_for_stage(stage))) == 3, stage
+
+def test_adopted_flat_index_is_partitioned(kb):
+    e = LocalHashEmbedder()
+    indexer.build_index(e.embed, e.name, docs_dir=None)
+    built = ki.KnowledgeIndex.load()
+    legacy = kb / "legacy.index"
+    flat = indexer.faiss.IndexFlatL2(built.index.d)
+    flat.add(np.load(os.path.join(built.path, ki.EMBEDDINGS_FILE)))
+    indexer.faiss.write_index(flat, str(legacy))
+
+    version = indexer.adopt_artifacts(str(legacy), os.path.join(built.path, ki.METADATA_FILE), e.name)
+    adopted = ki.KnowledgeIndex.load()
+    assert adopted.version == version and adopted.manifest["partitions"]
+    assert adopted.manifest["hashes"] == built.manifest["hashes"]
+    records = adopted.retrieve("I feel guilty about my friend", lambda t: e.embed([t])[0], top_k=2,
+                               mode="vector", stage="Greeting")
+    assert len(records) == 2 and {r["tone"] for r in records} <= set(ki.partitions_for_stage("Greeting"))
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from handler import debouncer
+from utils.prefetch import Prefetcher
+
+def test_newer_input_supersedes_and_take_matches_key():
+    release = threading.Event()
+    calls = []
+
+    def slow(key):
+        calls.append(key)
+        release.wait(2)
+        return key.upper()
+
+    p = Prefetcher(slow, "test", workers=1, wait_seconds=2)
+    p.submit("u1", "hi")
+    p.submit("u1", "hi")  # unchanged input: no new work
+    p.submit("u1", "hi there")
+    release.set()
+    assert p.take("u1", "hi there") == "HI THERE"
+    assert calls.count("hi") <= 1 and calls.count("hi there") == 1
+    assert p.pending() == 0
+
+def test_take_misses_on_stale_or_absent_key():
+    p = Prefetcher(lambda key: key, "test", workers=1)
+    p.submit("u1", "draft")
+    assert p.take("u1", "final text") is None
+    assert p.take("u1", "draft") is None  # claimed by the previous take
+
+def test_failures_and_timeouts_fall_back_to_inline():
+    def boom(key):
+        raise RuntimeError("down")
+
+    p = Prefetcher(boom, "test", workers=1)
+    p.submit("u1", "x")
+    assert p.take("u1", "x") is None
+
+    p = Prefetcher(lambda key: threading.Event().wait(1), "test", workers=1, wait_seconds=0.01)
+    p.submit("u2", "x")
+    assert p.take("u2", "x") is None
+
+def test_unclaimed_entries_expire_and_are_reported():
+    discarded = []
+    p = Prefetcher(lambda key: key.upper(), "test", workers=1, ttl_seconds=0.05,
+                   on_discard=lambda result, reason: discarded.append((result, reason)))
+    p.submit("u1", "never flushed")
+    p._entries["u1"].future.result(timeout=2)
+    time.sleep(0.06)
+    assert p.pending() == 0
+    assert discarded == [("NEVER FLUSHED", "expired")]
+    assert p.take("u1", "never flushed") is None
+
+def test_debouncer_reports_batch_so_far(monkeypatch):
+    monkeypatch.setattr(debouncer, "schedule_processing", lambda ws_id, process, speculate=None: None)
+    seen = []
+    on_update = lambda ws_id, convo_str: seen.append(convo_str)
+    debouncer.debouncer_message("pf1", "I feel  stuck", None, on_update=on_update)
+    debouncer.debouncer_message("pf1", "again", None, on_update=on_update)
+    assert seen == ["user: I feel stuck\n", "user: I feel stuck again\n"]
+    combined, convo_str = debouncer.combine_buffer("pf1")
+    assert convo_str == seen[-1] and [c["message"] for c in combined] == ["I feel stuck", "again"]
+    debouncer.message_buffer.pop("pf1"), debouncer.is_forwared_buffer.pop("pf1"), debouncer.message_id_buffer.pop("pf1")
@@ -0,0 +1,50 @@
+import importlib.util
+import os
+
+import fakeredis
+import pytest
+from redis.exceptions import ConnectionError
+
+from utils.metrics import metrics
+
+# conftest swaps utils.redis_client for a fakeredis stub; load the real module by path
+_spec = importlib.util.spec_from_file_location(
+    "real_redis_client", os.path.join(os.path.dirname(__file__), os.pardir, "utils", "redis_client.py"))
+rc = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(rc)
+FAKE_CONNECTION = getattr(fakeredis, "FakeRedisConnection", fakeredis.FakeConnection)
+
+def _client(**settings):
+    return rc.make_client(settings=settings, connection_class=FAKE_CONNECTION,
+                          server=fakeredis.FakeServer())
+
+def test_construction_opens_no_connection():
+    client = rc.make_client("redis.invalid", 1, settings={"max_connections": 4})
+    assert client.connection_pool.stats() == {"max_connections": 4, "created": 0, "in_use": 0, "peak_in_use": 0}
+
+def test_commands_are_timed_by_name_and_connections_returned():
+    client = _client(max_connections=2)
+    before = metrics.snapshot()["summaries"]
+    client.set("k", "v")
+    assert client.get("k") == "v"
+    pipe = client.pipeline()
+    pipe.incr("n").expire("n", 60)
+    assert pipe.execute() == [1, True]
+    client.transaction(lambda p: (p.get("n"), p.multi(), p.incr("n")), "n")
+
+    summaries = metrics.snapshot()["summaries"]
+    for command in ("SET", "GET", "MULTI", "WATCH"):
+        key = f"redis.command_ms{{command={command}}}"
+        assert summaries[key]["count"] > before.get(key, {}).get("count", 0)
+    stats = client.connection_pool.stats()
+    assert stats["in_use"] == 0 and stats["peak_in_use"] == 1 and stats["created"] == 1
+
+def test_exhausted_pool_fails_fast_and_is_counted():
+    client = _client(max_connections=1, pool_timeout=0.05)
+    held = client.connection_pool.get_connection()
+    exhausted = metrics.snapshot()["counters"].get("redis.pool_exhausted", 0)
+    with pytest.raises(ConnectionError):
+        client.get("k")
+    assert metrics.snapshot()["counters"]["redis.pool_exhausted"] == exhausted + 1
+    client.connection_pool.release(held)
+    assert client.get("k") is None and client.connection_pool.in_use == 0
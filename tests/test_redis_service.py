@@ -1,9 +1,11 @@
 import json
 import time
+from prompt_engine.conversation import USER, encode_turns, make_turn
 from service.redis import (
-    cache_user_detail_r, get_user_detail_r, append_conversation_redis,
+    cache_user_detail_r, get_user_detail_r, append_conversation_redis, get_conversation_turns,
     update_token_usage_redis, detect_tools_r, get_tools_r, set_user_stage_r, get_user_stage_r
 )
+from utils import config
 
 def test_cache_and_get_metadata(fake_redis):
     user = "555"
@@ -16,12 +18,41 @@ def test_append_conversation(fake_redis):
     user = "555"
     append_conversation_redis(user, "Hello")
     append_conversation_redis(user, "World")
-    # Raw read to confirm
+    # Raw read to confirm: one JSON turn per list item, with a TTL
     key = f"user:{user}:conversation"
-    val = fake_redis.get(key)
-    # some implementations may store conversation differently; if present, validate contents
-    if val is not None:
-        assert "Hello" in val and "World" in val
+    items = fake_redis.lrange(key, 0, -1)
+    assert [json.loads(i)["text"] for i in items] == ["Hello", "World"]
+    assert fake_redis.ttl(key) > 0
+
+def test_conversation_is_capped_and_read_as_a_window(fake_redis, monkeypatch):
+    monkeypatch.setitem(config.conversation_store, "max_turns", 5)
+    user = "556"
+    for i in range(4):
+        append_conversation_redis(user, [make_turn(USER, f"m{2 * i}"), make_turn(USER, f"m{2 * i + 1}")])
+    assert fake_redis.llen(f"user:{user}:conversation") == 5
+    assert [t["text"] for t in get_conversation_turns(user)] == ["m3", "m4", "m5", "m6", "m7"]
+    assert [t["text"] for t in get_conversation_turns(user, max_turns=2)] == ["m6", "m7"]
+
+def test_string_record_is_converted_to_a_list(fake_redis):
+    user = "557"
+    fake_redis.set(f"user:{user}:conversation", encode_turns([make_turn(USER, "before")]))
+    assert [t["text"] for t in get_conversation_turns(user)] == ["before"]
+    fake_redis.set(f"user:{user}:conversation", encode_turns([make_turn(USER, "old")]))
+    append_conversation_redis(user, "new")
+    assert [t["text"] for t in get_conversation_turns(user)] == ["old", "new"]
+
+def test_plain_text_record_is_migrated(fake_redis):
+    user = "558"
+    legacy = "user: my sister took my charger\n<bot> That sounds frustrating.\nWhat happened next?\n" \
+             "user-forwarded: give it back\nthird-forwarded: no"
+    fake_redis.set(f"user:{user}:conversation", legacy)
+    turns = get_conversation_turns(user)
+    assert [(t["role"], t["text"], t["forwarded"]) for t in turns] == [
+        ("user", "my sister took my charger", False),
+        ("assistant", "That sounds frustrating.\nWhat happened next?", False),
+        ("user", "give it back", True),
+        ("third", "no", True),
+    ]
 
 def test_token_usage_and_stage(fake_redis):
     user = "555"
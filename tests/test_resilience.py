@@ -0,0 +1,94 @@
+import pytest
+from utils import resilience
+from utils.resilience import (
+    CircuitBreaker, CircuitOpenError, RetryPolicy, call_with_resilience, parse_retry_after, reset_breakers
+)
+
+class _HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+@pytest.fixture(autouse=True)
+def _no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(resilience.time, "sleep", lambda s: sleeps.append(s))
+    reset_breakers()
+    yield sleeps
+    reset_breakers()
+
+def test_retries_transient_then_succeeds(_no_sleep):
+    calls = []
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _HTTPError(503)
+        return "ok"
+    assert call_with_resilience("dep", flaky, policy=RetryPolicy(max_attempts=3)) == "ok"
+    assert len(calls) == 3 and len(_no_sleep) == 2
+
+def test_non_transient_is_not_retried():
+    calls = []
+    def bad():
+        calls.append(1)
+        raise _HTTPError(400)
+    with pytest.raises(_HTTPError):
+        call_with_resilience("dep", bad)
+    assert len(calls) == 1
+
+def test_retry_after_is_honoured(_no_sleep):
+    calls = []
+    def throttled():
+        calls.append(1)
+        if len(calls) == 1:
+            raise _HTTPError(429, {"Retry-After": "2"})
+        return "ok"
+    assert call_with_resilience("dep", throttled, policy=RetryPolicy(max_delay=0.1)) == "ok"
+    assert _no_sleep == [2.0]
+    assert parse_retry_after(_HTTPError(429, {"retry-after-ms": "1500"})) == 1.5
+
+def test_breaker_opens_and_fails_fast():
+    def down():
+        raise _HTTPError(502)
+    policy = RetryPolicy(max_attempts=1)
+    for _ in range(5):
+        with pytest.raises(_HTTPError):
+            call_with_resilience("dep", down, policy=policy)
+    with pytest.raises(CircuitOpenError):
+        call_with_resilience("dep", lambda: "never called", policy=policy)
+    assert resilience.breaker_states()["dep"]["state"] == CircuitBreaker.OPEN
+
+def test_half_open_probe_closes_breaker(monkeypatch):
+    b = CircuitBreaker("probe", failure_threshold=1, reset_timeout=10)
+    clock = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: clock[0])
+    b.record_failure()
+    assert b.allow() is False
+    clock[0] += 11
+    assert b.allow() is True       # single probe
+    assert b.allow() is False      # second probe rejected
+    b.record_success()
+    assert b.state == CircuitBreaker.CLOSED
+
+def test_retry_if_limits_retries_but_failures_still_count():
+    calls = []
+    def timed_out():
+        calls.append(1)
+        raise _HTTPError(504)
+    with pytest.raises(_HTTPError):
+        call_with_resilience("dep", timed_out, retry_if=lambda e: False)
+    assert len(calls) == 1 and resilience.breaker_states()["dep"]["consecutive_failures"] == 1
+
+def test_bad_request_neither_closes_nor_resets_the_breaker(monkeypatch):
+    b = CircuitBreaker("neutral", failure_threshold=2, reset_timeout=10)
+    clock = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: clock[0])
+    b.record_failure()
+    b.record_neutral()
+    b.record_failure()
+    assert b.state == CircuitBreaker.OPEN
+    clock[0] += 11
+    assert b.allow() is True
+    b.record_neutral()             # probe slot given back, still half-open
+    assert b.state == CircuitBreaker.HALF_OPEN and b.allow() is True
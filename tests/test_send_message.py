@@ -1,7 +1,10 @@
 import os
 import importlib
 import pytest
+import requests
+from urllib3.exceptions import NewConnectionError
 from handler import send_message as sm
+from utils import resilience
 
 def test_send_message_happy(mock_graph_post, monkeypatch):
     monkeypatch.setenv("WHATSAPP_TOKEN", "token")
@@ -14,4 +17,28 @@ def test_send_message_missing_env(monkeypatch):
     monkeypatch.delenv("WHATSAPP_TOKEN", raising=False)
     monkeypatch.delenv("PHONE_NUMBER_ID", raising=False)
     with pytest.raises(RuntimeError):
-        sm.send_text_reply("555", "Hello")
\ No newline at end of file
+        sm.send_text_reply("555", "Hello")
+
+def test_send_is_only_retried_when_it_cannot_have_arrived(monkeypatch):
+    monkeypatch.setenv("WHATSAPP_TOKEN", "token")
+    monkeypatch.setenv("PHONE_NUMBER_ID", "pnid")
+    monkeypatch.setattr(resilience.time, "sleep", lambda s: None)
+    resilience.reset_breakers()
+    attempts = []
+
+    def post(url, headers=None, json=None, timeout=None):
+        attempts.append(1)
+        raise failure
+
+    monkeypatch.setattr(requests, "post", post)
+    failure = requests.exceptions.ReadTimeout("read timed out")
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        sm.send_text_reply("555", "Hello")
+    assert len(attempts) == 1
+
+    attempts.clear()
+    failure = requests.exceptions.ConnectionError(NewConnectionError(None, "connection refused"))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        sm.send_text_reply("555", "Hello")
+    assert len(attempts) == 3
+    resilience.reset_breakers()
@@ -0,0 +1,88 @@
+from handler.session import UserSession
+from prompt_engine.user_stage import load_stage_state, save_stage_state
+from service.redis import FLUSH_METADATA_LUA, cache_user_detail_r, get_remaining_tokens, get_user_detail_r
+
+def _count_round_trips(client, monkeypatch):
+    """Count packed command writes on the fakeredis connection class (one per round trip)."""
+    conn_cls = client.connection_pool.connection_class
+    send = conn_cls.send_packed_command
+    trips = [0]
+
+    def counting(self, *args, **kwargs):
+        trips[0] += 1
+        return send(self, *args, **kwargs)
+
+    monkeypatch.setattr(conn_cls, "send_packed_command", counting)
+    return trips
+
+def test_turn_reads_once_and_writes_once(fake_redis, monkeypatch):
+    user = "sess1"
+    cache_user_detail_r(user, {"stage": "Reflection", "stage_step": 1, "token_limit": 1000, "token_used": 100}, 60)
+    fake_redis.script_load(FLUSH_METADATA_LUA)  # a fresh server costs the first flush a SCRIPT LOAD
+    trips = _count_round_trips(fake_redis, monkeypatch)
+
+    session = UserSession.load(user)
+    state = load_stage_state(user, session)
+    granted = session.reserve_tokens(100, 300)
+    save_stage_state(user, state, "Tools", 1, "Try [tool_name=Box breathing]", session)
+    session.settle_tokens(100 + granted, 250)
+    session.set("low_token_warned", 1)
+    assert session.get("stage") == "Tools" and get_remaining_tokens(session.fields()) == 1000 - 100 - 250
+    assert session.flush() == []
+    # HGETALL, reservation, EVALSHA
+    assert trips[0] == 3
+
+    stored = get_user_detail_r(user)
+    assert (stored["stage"], stored["tool_name"], stored["low_token_warned"]) == ("Tools", "Box breathing", "1")
+    assert (stored["token_usage"], stored["token_reserved"]) == ("250", "0")
+
+def test_flush_keeps_fields_another_writer_changed(fake_redis):
+    user = "sess2"
+    fake_redis.hset(f"user:{user}:metadata", mapping={"stage": "Greeting", "stage_step": 1, "token_usage": 5})
+    session = UserSession.load(user)
+    session.update({"stage": "Validation", "stage_step": 1})
+    session.incr("token_usage", 10)
+
+    fake_redis.hset(f"user:{user}:metadata", mapping={"stage": "Greeting", "stage_step": 2, "token_usage": 7})
+    assert session.flush() == ["stage_step"]
+    assert fake_redis.hgetall(f"user:{user}:metadata") == {"stage": "Validation", "stage_step": "2",
+                                                          "token_usage": "17"}
+    assert not session.dirty and session.flush() == []
+
+def test_flush_neither_recreates_an_expired_hash_nor_clears_its_ttl(fake_redis):
+    user = "sess-exp"
+    cache_user_detail_r(user, {"stage": "Greeting", "token_limit": 1000}, 60)
+    session = UserSession.load(user)
+    session.set("stage", "Validation")
+    session.incr("token_usage", 30)
+    assert session.flush() == []
+    assert 0 < fake_redis.ttl(f"user:{user}:metadata") <= 60
+
+    session.set("stage", "Reflection")
+    session.settle_tokens(50, 40)
+    fake_redis.delete(f"user:{user}:metadata")
+    assert session.flush() == ["stage", "token_reserved", "token_usage"]
+    assert not fake_redis.exists(f"user:{user}:metadata") and not session.dirty
+
+def test_snapshot_reservation_rechecks_concurrent_spend(fake_redis):
+    user = "sess3"
+    cache_user_detail_r(user, {"token_limit": 500, "token_used": 300}, 60)
+    session = UserSession.load(user)
+    # Another turn spends after the snapshot was taken
+    fake_redis.hincrby(f"user:{user}:metadata", "token_usage", 150)
+    assert session.reserve_tokens(120, 300) == 0
+    assert int(get_user_detail_r(user).get("token_reserved") or 0) == 0
+
+    # No hash and no MongoDB record: nothing to spend
+    assert UserSession.load("sess-none").reserve_tokens(10, 300) == 0
+
+def test_hash_without_limit_is_reloaded_from_mongo(fake_redis, fake_mongo):
+    user = "sess4"
+    fake_mongo["user_meta"].insert_one({"user_id": user, "subscription_plan": "PROMO_FLANK_TRIAL",
+                                        "token_limit": 1000, "token_used": 900})
+    # What a write after expiry leaves behind
+    fake_redis.hset(f"user:{user}:metadata", mapping={"token_reserved": "-80", "token_usage": "75"})
+    session = UserSession.load(user)
+    assert session.get("token_limit") == "1000" and session.get("token_usage") is None
+    assert get_remaining_tokens(session.fields()) == 100
+    assert 0 < fake_redis.ttl(f"user:{user}:metadata") <= 300
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from handler.session_expiry import LEADER_KEY, SessionExpiryProcessor, run_expiry_sweep
+from service.redis import (
+    SESSION_CLAIMS_KEY, SESSION_DEADLINES_KEY, cache_user_detail_r, claim_due_sessions_r,
+)
+
+@pytest.fixture(autouse=True)
+def _no_sessions(fake_redis):
+    # Other tests cache users in the same fake server
+    fake_redis.delete(SESSION_DEADLINES_KEY, SESSION_CLAIMS_KEY, LEADER_KEY)
+
+SETTINGS = {"workers": 2, "pubsub_hint": False, "retry_seconds": 60, "claim_timeout_seconds": 300}
+
+def _expire(client, user_id):
+    """What Redis does at the deadline, without waiting for it."""
+    client.delete(f"user:{user_id}:metadata")
+    client.zadd(SESSION_DEADLINES_KEY, {user_id: time.time() - 1})
+
+def test_only_the_leader_claims_and_each_session_runs_once(fake_redis):
+    for user in ("exp1", "exp2", "exp3"):
+        cache_user_detail_r(user, {"stage": "Reflection"}, 60)
+    assert 59 < fake_redis.zscore(SESSION_DEADLINES_KEY, "exp1") - time.time() <= 60
+    _expire(fake_redis, "exp1")
+    _expire(fake_redis, "exp2")
+
+    handled = []
+    leader = SessionExpiryProcessor(handled.append, SETTINGS)
+    follower = SessionExpiryProcessor(handled.append, SETTINGS)
+    assert sorted(leader.tick()) == ["exp1", "exp2"]
+    assert follower.tick() == [] and not follower.is_leader
+    leader.stop()
+    assert sorted(handled) == ["exp1", "exp2"]
+    assert fake_redis.zrange(SESSION_DEADLINES_KEY, 0, -1) == ["exp3"]
+    assert fake_redis.zcard(SESSION_CLAIMS_KEY) == 0
+
+    # Stopping hands the lease over
+    assert fake_redis.get(LEADER_KEY) is None
+    follower.tick()
+    assert follower.is_leader
+    follower.stop()
+
+def test_concurrent_claims_never_overlap(fake_redis):
+    users = [f"race{i}" for i in range(20)]
+    for user in users:
+        _expire(fake_redis, user)
+    claimed = []
+    threads = [threading.Thread(target=lambda: claimed.extend(claim_due_sessions_r(3, 300)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for _ in range(10):
+        claimed.extend(claim_due_sessions_r(3, 300))
+    assert sorted(claimed) == sorted(users)
+
+def test_returning_user_is_rescheduled_instead_of_summarized(fake_redis):
+    cache_user_detail_r("back1", {"stage": "Tools"}, 120)
+    fake_redis.zadd(SESSION_DEADLINES_KEY, {"back1": time.time() - 1})
+    assert claim_due_sessions_r(5, 300) == []
+    assert fake_redis.zscore(SESSION_DEADLINES_KEY, "back1") > time.time() + 100
+
+def test_due_again_while_claimed_keeps_its_deadline(fake_redis):
+    _expire(fake_redis, "twice1")
+    assert claim_due_sessions_r(5, 300) == ["twice1"]
+    # The user came back and left again while the first summary is still running
+    fake_redis.zadd(SESSION_DEADLINES_KEY, {"twice1": time.time() - 1})
+    assert claim_due_sessions_r(5, 300) == []
+    assert fake_redis.zscore(SESSION_DEADLINES_KEY, "twice1") is not None
+
+def test_cron_sweep_finishes_before_returning(fake_redis):
+    handled = []
+    _expire(fake_redis, "cron1")
+    assert run_expiry_sweep(handled.append) == ["cron1"]
+    assert handled == ["cron1"] and fake_redis.zcard(SESSION_CLAIMS_KEY) == 0
+    assert fake_redis.get(LEADER_KEY) is None
+
+def test_failed_and_lapsed_claims_are_retried(fake_redis):
+    calls = []
+
+    def flaky(user_id):
+        calls.append(user_id)
+        if len(calls) == 1:
+            raise RuntimeError("mongo down")
+
+    _expire(fake_redis, "retry1")
+    processor = SessionExpiryProcessor(flaky, SETTINGS)
+    processor.tick()
+    processor.stop()
+    assert fake_redis.zscore(SESSION_DEADLINES_KEY, "retry1") > time.time() + 50
+    assert fake_redis.zcard(SESSION_CLAIMS_KEY) == 0
+
+    # A claimer that died leaves a claim behind; once it lapses the leader runs it again
+    fake_redis.zrem(SESSION_DEADLINES_KEY, "retry1")
+    fake_redis.zadd(SESSION_CLAIMS_KEY, {"retry1": time.time() - 1})
+    processor = SessionExpiryProcessor(flaky, SETTINGS)
+    assert processor.tick() == ["retry1"]
+    processor.stop()
+    assert calls == ["retry1", "retry1"] and fake_redis.zcard(SESSION_CLAIMS_KEY) == 0
@@ -0,0 +1,82 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from handler import prompt as hp
+from prompt_engine.conversation import turns_from_batch
+from service.redis import (
+    add_speculation_waste_r, append_conversation_redis, cache_user_detail_r, get_conversation_turns,
+    get_remaining_tokens, get_speculation_waste_r, get_user_detail_r
+)
+from utils import config
+
+@pytest.fixture
+def llm(fake_redis, monkeypatch):
+    monkeypatch.setitem(config.speculation, "enabled", True)
+    monkeypatch.setitem(config.token_profile, "path", "")
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["messages"][-1]["content"] if kwargs["messages"] else "")
+        usage = SimpleNamespace(total_tokens=30, prompt_tokens=20, completion_tokens=10)
+        choice = SimpleNamespace(message=SimpleNamespace(content=f"reply {len(calls)}"), finish_reason="stop")
+        return SimpleNamespace(usage=usage, choices=[choice])
+
+    monkeypatch.setattr(hp.openai.chat.completions, "create", create, raising=False)
+    return calls
+
+def _batch(text):
+    return [{"message": text, "role": "user", "message_id": None}], f"user: {text}\n"
+
+def _wait_for(predicate):
+    deadline = time.time() + 3
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    assert predicate()
+
+def test_committed_speculation_skips_the_second_call(llm):
+    user = "spec1"
+    cache_user_detail_r(user, {"token_limit": 1000, "token_used": 0, "subscription_plan": "PROMO_FLANK_PRO"}, 60)
+    combined, convo_str = _batch("I had a fight with my sister")
+    committed = hp.speculation_stats["committed"]
+
+    hp.speculate_reply(user, combined, convo_str)
+    append_conversation_redis(user, turns_from_batch(combined))
+    answer, total = hp.prompt_LLM(user, get_conversation_turns(user), convo_str)
+
+    assert (answer, total, len(llm)) == ("reply 1", 30, 1)
+    assert hp.speculation_stats["committed"] == committed + 1
+    assert get_remaining_tokens(get_user_detail_r(user)) == 1000 - 30
+
+def test_typing_discards_without_charging_the_user(llm):
+    user = "spec2"
+    plan = "PROMO_FLANK_BASIC"
+    cache_user_detail_r(user, {"token_limit": 1000, "token_used": 0, "subscription_plan": plan}, 60)
+    wasted = get_speculation_waste_r(plan)
+
+    hp.speculate_reply(user, *_batch("I had a fight"))
+    _wait_for(lambda: len(llm) == 1)
+    hp.discard_speculation(user)
+    _wait_for(lambda: get_speculation_waste_r(plan) == wasted + 30)
+    assert get_remaining_tokens(get_user_detail_r(user)) == 1000
+
+    # A reply speculated for a different batch is stale at the flush
+    hp.speculate_reply(user, *_batch("I had a fight"))
+    _wait_for(lambda: len(llm) == 2)
+    combined, convo_str = _batch("I had a fight with my sister")
+    append_conversation_redis(user, turns_from_batch(combined))
+    answer, total = hp.prompt_LLM(user, get_conversation_turns(user), convo_str)
+    assert (answer, total) == ("reply 3", 30)
+    _wait_for(lambda: get_speculation_waste_r(plan) == wasted + 60)
+    assert get_remaining_tokens(get_user_detail_r(user)) == 1000 - 30
+
+def test_waste_cap_stops_speculation(llm):
+    user = "spec3"
+    cache_user_detail_r(user, {"token_limit": 1000, "token_used": 0, "subscription_plan": "PROMO_FLANK_TRIAL"}, 60)
+    add_speculation_waste_r("PROMO_FLANK_TRIAL", 1)
+    hp.speculate_reply(user, *_batch("hello"))
+    time.sleep(0.1)
+    assert llm == []
+    report = hp.speculation_report()
+    assert 0.0 <= report["commit_rate"] <= 1.0
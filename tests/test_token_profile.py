@@ -0,0 +1,55 @@
+from prompt_engine.conversation import USER, make_turn
+from handler import prompt as hp
+from prompt_engine.user_stage import StageState, build_message_segments, build_messages
+from utils import config
+from utils.token_profile import (
+    SEGMENT_FRAMING, SEGMENT_HISTORY, SEGMENT_RAG, SEGMENT_STAGE, SEGMENT_TOOL, flush_profiles, load_records, record_prompt_profile, summarize
+)
+from utils.tokens import estimate_prompt_tokens
+
+def test_segments_cover_the_whole_prompt(tmp_path):
+    turns = [make_turn(USER, "I keep overthinking everything")]
+    segments = build_message_segments(turns, "Tools", 1, "None")
+    assert [s for s, _ in segments] == [SEGMENT_HISTORY, SEGMENT_STAGE, SEGMENT_TOOL]
+    assert [m for _, m in segments] == build_messages(turns, "Tools", 1, "None")
+
+    counts = record_prompt_profile("Tools", "gpt-4o-mini", segments, path=str(tmp_path / "p.jsonl"))
+    assert sum(counts.values()) == estimate_prompt_tokens([m for _, m in segments])
+    assert counts[SEGMENT_FRAMING] > 0
+
+def test_rag_context_is_its_own_segment():
+    turns = [make_turn(USER, "my sister ignores me")]
+    segments = build_message_segments(turns, "Validation", 1, context="That must feel lonely.")
+    assert [s for s, _ in segments] == [SEGMENT_HISTORY, SEGMENT_RAG, SEGMENT_STAGE]
+    assert "That must feel lonely." in segments[1][1]["content"]
+    assert SEGMENT_RAG not in dict(build_message_segments(turns, "Validation", 1))
+
+def test_report_ranks_segments(tmp_path):
+    path = str(tmp_path / "p.jsonl")
+    turns = [make_turn(USER, "hello " * 200)]
+    for _ in range(3):
+        record_prompt_profile("Greeting", "gpt-4o-mini", build_message_segments(turns, "Greeting", 1), path=path)
+    flush_profiles()
+    records = list(load_records(path))
+    assert "user_id" not in records[0]
+    rows = summarize(records)
+    assert rows[0]["segment"] == SEGMENT_HISTORY
+    assert rows[0]["turns"] == 3
+    assert abs(sum(r["share"] for r in rows) - 1.0) < 1e-9
+
+def test_turn_prompt_carries_the_stage_rag_context(monkeypatch):
+    asked = []
+
+    def retrieve(query, knowledge=None, top_k=3, stage=None, user_id=None):
+        asked.append(stage)
+        return "Take a slow breath with me."
+
+    monkeypatch.setattr(hp, "retrieve_context_jsonl", retrieve)
+    turns = [make_turn(USER, "my sister ignores me")]
+    prepared = hp.prepare_turn(turns, "user: my sister ignores me\n", StageState("Validation", 3), user_id="rag1")
+    assert asked == [prepared.curr_stage]
+    assert dict(prepared.segments)[SEGMENT_RAG]["content"].endswith("Take a slow breath with me.")
+
+    monkeypatch.setitem(config.retrieval, "enabled", False)
+    prepared = hp.prepare_turn(turns, "user: my sister ignores me\n", StageState("Validation", 3), user_id="rag1")
+    assert SEGMENT_RAG not in dict(prepared.segments) and len(asked) == 1
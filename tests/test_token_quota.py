@@ -0,0 +1,48 @@
+from service import redis as redis_service
+from service.redis import cache_user_detail_r, get_remaining_tokens, get_user_detail_r, reserve_tokens_r, settle_tokens_r
+from utils.tokens import estimate_prompt_tokens
+
+def test_estimate_counts_framing():
+    msgs = [{"role": "user", "content": "hello there"}, {"role": "system", "content": ""}]
+    assert estimate_prompt_tokens(msgs) >= 3 + 2 * 3 + 1
+
+def test_reserve_clamps_and_settles(fake_redis):
+    user = "q1"
+    cache_user_detail_r(user, {"token_limit": 500, "token_used": 300}, 60)
+    # 200 left: 120 prompt leaves 80 for the completion
+    assert reserve_tokens_r(user, 120, 300) == 80
+    assert get_remaining_tokens(get_user_detail_r(user)) == 0
+    settle_tokens_r(user, 200, 150)
+    assert get_remaining_tokens(get_user_detail_r(user)) == 50
+
+def test_reserve_rejects_over_quota(fake_redis):
+    user = "q2"
+    cache_user_detail_r(user, {"token_limit": 100, "token_used": 95}, 60)
+    assert reserve_tokens_r(user, 10, 300) == 0
+    assert "token_reserved" not in get_user_detail_r(user)
+
+def test_missing_limit_fails_closed(fake_redis):
+    assert reserve_tokens_r("q3", 10, 300) == 0
+    assert reserve_tokens_r("q3", 10, 300, user_data={"token_usage": "5"}) == 0
+    assert not fake_redis.exists("user:q3:metadata")
+
+def test_expired_hash_is_not_recreated_by_a_reservation(fake_redis):
+    snapshot = {"token_limit": "500", "token_used": "0"}
+    assert reserve_tokens_r("q4", 10, 300, user_data=snapshot) == 0
+    assert not fake_redis.exists("user:q4:metadata")
+
+def test_only_an_unlimited_plan_is_unrestricted(fake_redis, monkeypatch):
+    monkeypatch.setitem(redis_service.subscription_plan, "PROMO_FLANK_UNLIMITED", {"tokens": None})
+    assert get_remaining_tokens({"subscription_plan": "PROMO_FLANK_UNLIMITED"}) is None
+    assert get_remaining_tokens({"subscription_plan": "PROMO_FLANK_TRIAL"}) == 0
+
+def test_refresh_keeps_an_in_flight_reservation(fake_redis):
+    user = "q5"
+    cache_user_detail_r(user, {"token_limit": 500, "token_used": 0, "token_usage": 40}, 60)
+    granted = reserve_tokens_r(user, 100, 300)
+    # The user's details are re-cached from MongoDB while the turn is still running
+    cache_user_detail_r(user, {"token_limit": 500, "token_used": 40}, 60)
+    assert get_user_detail_r(user)["token_reserved"] == str(100 + granted)
+    settle_tokens_r(user, 100 + granted, 150)
+    stored = get_user_detail_r(user)
+    assert stored["token_reserved"] == "0" and get_remaining_tokens(stored) == 500 - 40 - 150
@@ -0,0 +1,47 @@
+from prompt_engine.user_stage import (
+    StageState, detect_tools_trigger, find_stage, load_stage_state, save_stage_state
+)
+
+def test_tools_trigger_alternation():
+    assert detect_tools_trigger("Honestly I'm stuck")
+    assert detect_tools_trigger("any advice?")
+    assert not detect_tools_trigger("my toolbox is full")
+
+def test_transition_table():
+    assert find_stage(StageState("initial"), "ok") == ("Greeting", 1)
+    assert find_stage(StageState("Validation", 3), "ok") == ("Reflection", 1)
+    assert find_stage(StageState("Reflection", 1), "what should i do") == ("Tools", 1)
+    assert find_stage(StageState("Reflection", 2), "hmm") == ("Tools", 1)
+    assert find_stage(StageState("Tools", 2), "ok") == ("Tools", 3)
+    assert find_stage(StageState("Tools", 6), "ok") == ("Next Steps", 1)
+
+def test_greeting_restarts_flow():
+    assert find_stage(StageState("Tools", 3), "hey again") == ("Greeting", 1)
+    assert find_stage(StageState("Reflection", 2), "user: Hello there!\n") == ("Greeting", 1)
+    # A greeting word inside a message is not a new conversation
+    assert find_stage(StageState("Tools", 2, "Box breathing"), "user: hey so about that") == ("Tools", 3)
+    assert find_stage(StageState("Reflection", 1), "user: oh hi, this is hard") == ("Reflection", 2)
+    # substrings no longer count as greetings
+    assert find_stage(StageState("Tools", 3), "This is hard") == ("Tools", 4)
+
+def test_state_round_trip(fake_redis):
+    user = "stage1"
+    fake_redis.hset(f"user:{user}:metadata", mapping={"stage": "Reflection", "stage_step": 2, "tool_name": "None"})
+    state = load_stage_state(user)
+    assert state == StageState("Reflection", 2, "None", None)
+    fields = save_stage_state(user, state, "Tools", 1, "Try this [tool_name=Box breathing]")
+    assert fields == {"stage": "Tools", "stage_step": 1, "tool_name": "Box breathing"}
+    assert load_stage_state(user).tool_name == "Box breathing"
+
+def test_classifier_intents_feed_transitions():
+    assert find_stage(StageState("Tools", 2, "Box breathing"), "no thanks", intent="decline") == ("Next Steps", 1)
+    assert find_stage(StageState("Tools", 2, "None"), "no thanks", intent="decline") == ("Tools", 3)
+    assert find_stage(StageState("Next Steps", 1), "hmm", intent="wants_tool") == ("Tools", 1)
+
+def test_classifier_greeting_never_resets_the_flow():
+    assert find_stage(StageState("Tools", 2, "Box breathing"), "so about that", intent="greeting") == ("Tools", 3)
+
+def test_forwarded_marker_only_restarts_its_own_batch():
+    assert find_stage(StageState("Tools", 3), "user: <1> you never listen", intent="other") == ("Validation", 1)
+    # The next batch carries no marker and continues from where the flow is
+    assert find_stage(StageState("Validation", 1), "user: it hurt", intent="other") == ("Reflection", 1)
@@ -2,4 +2,188 @@ subscription_plan ={
     "PROMO_FLANK_TRIAL": {'plan_name':"Trial Plan", "tokens":1000, "token_used":0, "summary_limit":5, 'ttl':300},
     "PROMO_FLANK_BASIC": {'plan_name':"Basic Plan", "tokens":5000, "token_used":0, "summary_limit":20, "ttl":900},
     "PROMO_FLANK_PRO": {'plan_name':"Pro Plan", "tokens":100000, "token_used":0, "summary_limit":50, "ttl":3600},
-}
\ No newline at end of file
+}
+
+# Per-stage LLM settings for the live pipeline (stage names come from find_stage).
+# Short stages get small caps and lower temperature. Greeting, Validation and Next Steps use
+# prompt_engine.llm.ask_llm's caps; Reflection and Tools keep more room than ask_llm (120 / 200)
+# because the live prompt asks them for a reflection or a tool walkthrough, not one line.
+stage_model_routing = {
+    "default":    {"model": "gpt-4o-mini", "max_tokens": 300, "temperature": 0.8},
+    "Greeting":   {"model": "gpt-4o-mini", "max_tokens": 80,  "temperature": 0.6},
+    "Validation": {"model": "gpt-4o-mini", "max_tokens": 70,  "temperature": 0.6},
+    "Reflection": {"model": "gpt-4o-mini", "max_tokens": 150, "temperature": 0.8},
+    "Tools":      {"model": "gpt-4o-mini", "max_tokens": 300, "temperature": 0.8},
+    "Next Steps": {"model": "gpt-4o-mini", "max_tokens": 100, "temperature": 0.7},
+}
+
+# Per-plan overrides: "*" applies to every stage, stage keys win over "*".
+# "max_tokens_cap" clamps whatever max_tokens the stage resolved to.
+plan_model_routing = {
+    "PROMO_FLANK_TRIAL": {"*": {"max_tokens_cap": 150}},
+    "PROMO_FLANK_PRO": {
+        "Reflection": {"model": "gpt-4o"},
+        "Tools": {"model": "gpt-4o", "max_tokens": 350},
+    },
+}
+
+# Hard quota enforcement: a turn needs room for at least `min_completion_tokens`
+# after its estimated prompt; users are warned once below `low_token_ratio` of their limit.
+token_quota = {
+    "min_completion_tokens": 20,
+    "low_token_ratio": 0.1,
+}
+
+# Redis connection pool (utils.redis_client). A command waits up to `pool_timeout` seconds
+# for one of `max_connections`, then fails. Connection errors are retried `retries` times
+# with jittered backoff; timeouts only with `retry_on_timeout`, since a timed-out write
+# (HINCRBY, RPUSH) may already have been applied. parser: auto | hiredis | python.
+redis_pool = {
+    "max_connections": 32,
+    "pool_timeout": 5.0,
+    "socket_connect_timeout": 2.0,
+    "socket_timeout": 5.0,
+    "health_check_interval": 30,
+    "retries": 3,
+    "retry_on_timeout": False,
+    "backoff_base": 0.05,
+    "backoff_cap": 1.0,
+    "parser": "auto",
+}
+
+# Redis conversation record (a list, one JSON turn per item): capped at `max_turns`, its TTL
+# refreshed on every append, and prompts read the newest `window_turns`.
+conversation_store = {
+    "max_turns": 200,
+    "window_turns": 50,
+    "ttl_seconds": 24 * 3600,
+}
+
+# Session expiry (handler.session_expiry). Metadata deadlines are kept in a sorted set. The
+# process holding the `lease_seconds` leader lease checks it every `poll_seconds` and claims due
+# sessions, at most `workers` summaries at a time. A claim unfinished after `claim_timeout_seconds`
+# is retried, and a failed summary after `retry_seconds`. Expired-key events, when the server
+# publishes them (notify-keyspace-events Ex), only wake the leader early.
+session_expiry = {
+    "enabled": True,
+    "poll_seconds": 5.0,
+    "lease_seconds": 15.0,
+    "workers": 4,
+    "claim_timeout_seconds": 300,
+    "retry_seconds": 60,
+    "pubsub_hint": True,
+}
+
+# Per-segment prompt token records (utils.token_profile). Counts always reach the metrics; the
+# JSONL log is opt-in (set `path`, e.g. "logs/token_profile.jsonl", where the disk is writable)
+# and rotates at `max_bytes`, keeping `backups` old files.
+token_profile = {
+    "path": "",
+    "max_bytes": 10 * 1024 * 1024,
+    "backups": 3,
+}
+
+# Query-embedding cache (utils.embedding_cache): in-process LRU in front of Redis.
+embedding_cache = {
+    "max_items": 4096,
+    "ttl_seconds": 7 * 24 * 3600,
+    "use_redis": True,
+}
+
+# Knowledge-base ANN index (prompt_engine.ann_index). kind: flat | ivf_flat | hnsw | ivf_sq | ivf_pq.
+# nlist None sizes IVF lists from the corpus; nprobe / ef_search are applied at load time.
+knowledge_index = {
+    "kind": "flat",
+    "nlist": None,
+    "nprobe": 8,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+    "pq_m": 64,
+}
+
+# Versioned knowledge artifacts (prompt_engine/knowledge/<version>, selected by CURRENT).
+# Serving processes re-read the pointer at most every `refresh_seconds` and swap in a new
+# version in the background; a build keeps the newest `keep_versions` (plus the current one).
+knowledge_versions = {
+    "refresh_seconds": 10,
+    "keep_versions": 3,
+}
+
+# Embedding backend (prompt_engine.embedders): "openai", or "local" for the offline
+# hashed n-gram embedder. Switching backends needs an index rebuild (the indexer does a full one);
+# until the new version is current, queries are embedded with the model the served version records.
+embedder = {
+    "backend": "openai",
+    "model": "text-embedding-3-small",
+    "local_dim": 384,
+}
+
+# Knowledge retrieval (KnowledgeIndex.retrieve). With `enabled`, every turn's prompt carries the
+# `top_k` responses retrieved from the partitions routed for its stage. mode: vector | lexical | hybrid.
+# In hybrid mode a BM25 hit whose confidence clears `lexical_short_circuit` skips the embedding call;
+# otherwise BM25 and vector rankings of `candidates` each are fused with RRF.
+retrieval = {
+    "enabled": True,
+    "top_k": 3,
+    "mode": "hybrid",
+    "lexical_short_circuit": 0.8,
+    "candidates": 20,
+    "rrf_k": 60,
+}
+
+# Partitioned knowledge sub-indexes: one per value of `field`. `stage_routes` maps a
+# find_stage stage to the partitions worth searching; unlisted stages search everything.
+# Routed partitions that aren't built are skipped, so only route tones the index holds
+# (docs/ chunks are tone "reference"; add it to Tools once docs are indexed).
+knowledge_partitions = {
+    "field": "tone",
+    "stage_routes": {
+        "Greeting":   ["empathetic", "supportive", "reassuring"],
+        "Validation": ["empathetic", "validating", "supportive", "compassionate"],
+        "Reflection": ["reflective", "curious", "empathetic", "validating"],
+        "Tools":      ["guiding", "calming", "encouraging"],
+        "Next Steps": ["guiding", "encouraging", "reassuring"],
+    },
+}
+
+# Speculative query embedding while the debouncer waits (handler.prompt.prefetch_context).
+# Only useful with retrieval["enabled"], otherwise it only spends embedding calls.
+rag_prefetch = {
+    "enabled": False,
+    "workers": 4,
+    # How long retrieval waits for an in-flight prefetch before embedding inline
+    "wait_seconds": 2.0,
+    # An embedding no flush claimed within this long is dropped
+    "ttl_seconds": 60,
+}
+
+# Two-threshold debounce: after `idle_seconds` of silence the reply is generated speculatively
+# and used at the normal flush if no message arrived in between. Discarded replies are never
+# charged to the user; they count against a per-plan daily token cap ("default" for other plans).
+speculation = {
+    "enabled": False,
+    "idle_seconds": 1.5,
+    "workers": 4,
+    # How long the flush waits for a speculative reply that is still being generated
+    "wait_seconds": 15.0,
+    # A reply no flush claimed within this long is dropped and counted as waste
+    "ttl_seconds": 60,
+    "daily_waste_cap": {
+        "default": 20000,
+        "PROMO_FLANK_TRIAL": 0,
+        "PROMO_FLANK_BASIC": 5000,
+        "PROMO_FLANK_PRO": 50000,
+    },
+}
+
+# Per-user long-term memory (prompt_engine.memory): every session summary is embedded and kept
+# (newest `max_memories`); each turn adds up to `top_k` of them scoring at least `min_score`
+# (cosine), within `token_budget` prompt tokens.
+long_term_memory = {
+    "enabled": True,
+    "max_memories": 50,
+    "top_k": 3,
+    "min_score": 0.2,
+    "token_budget": 250,
+}
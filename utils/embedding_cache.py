@@ -0,0 +1,164 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from redis.client import NEVER_DECODE
+
+from utils.metrics import metrics
+from utils.redis_client import RedisClient
+
+logger = logging.getLogger("handlers")
+
+# Vectors are stored as float16 in both tiers: half the bytes, and whichever
+# tier answers, callers see the same values.
+STORE_DTYPE = np.float16
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class _Flight:
+    """One in-progress embedding call that concurrent identical requests wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class EmbeddingCache:
+    """
+    Two-tier query-embedding cache keyed by model + normalized text hash.
+    - In-process LRU of `max_items` vectors.
+    - Redis tier: raw float16 bytes under emb:{model}:{sha1} with a TTL, shared by workers.
+    - Single-flight: concurrent misses for the same key share one `embed_fn` call.
+    Redis errors degrade to a miss; they never fail the embedding.
+    """
+
+    def __init__(self, embed_fn, model: str, max_items: int = 4096,
+                 ttl_seconds: int = 7 * 24 * 3600, use_redis: bool = True):
+        self.embed_fn = embed_fn
+        self.model = model
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.use_redis = use_redis
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        self._flights = {}
+        self.hits = {"memory": 0, "redis": 0}
+        self.misses = 0
+        self.coalesced = 0
+        # Moving average of an embed_fn call, credited as saved on every hit
+        self.miss_ms = None
+
+    def key(self, text: str) -> str:
+        digest = hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"emb:{self.model}:{digest}"
+
+    def get(self, text: str) -> np.ndarray:
+        """float32 embedding for `text`, from cache when possible."""
+        start = time.perf_counter()
+        key = self.key(text)
+
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self.hits["memory"] += 1
+                flight, leader = None, False
+            else:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                else:
+                    self.coalesced += 1
+        if vector is not None:
+            return self._hit("memory", vector, start)
+
+        if not leader:
+            metrics.incr("embedding_cache.coalesced", model=self.model)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.vector.astype(np.float32)
+
+        try:
+            vector = self._redis_get(key)
+            if vector is not None:
+                with self._lock:
+                    self.hits["redis"] += 1
+                self._remember(key, vector)
+                flight.vector = vector
+                return self._hit("redis", vector, start)
+
+            call_start = time.perf_counter()
+            vector = np.asarray(self.embed_fn(text), dtype=np.float32).astype(STORE_DTYPE)
+            call_ms = (time.perf_counter() - call_start) * 1000.0
+            with self._lock:
+                self.misses += 1
+                self.miss_ms = call_ms if self.miss_ms is None else 0.9 * self.miss_ms + 0.1 * call_ms
+            metrics.incr("embedding_cache.misses", model=self.model)
+            self._remember(key, vector)
+            self._redis_set(key, vector)
+            flight.vector = vector
+            return vector.astype(np.float32)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _hit(self, tier, vector, start):
+        metrics.incr("embedding_cache.hits", model=self.model, tier=tier)
+        if self.miss_ms is not None:
+            saved = self.miss_ms - (time.perf_counter() - start) * 1000.0
+            metrics.incr("embedding_cache.saved_ms", max(0.0, saved), model=self.model)
+        return vector.astype(np.float32)
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_items:
+                self._lru.popitem(last=False)
+
+    def _redis_get(self, key):
+        if not self.use_redis:
+            return None
+        try:
+            # Raw bytes even when the shared client decodes responses
+            raw = RedisClient().get_client().execute_command("GET", key, **{NEVER_DECODE: []})
+        except Exception as e:
+            logger.warning("Embedding cache read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        return np.frombuffer(raw, dtype=STORE_DTYPE)
+
+    def _redis_set(self, key, vector):
+        if not self.use_redis:
+            return
+        try:
+            RedisClient().get_client().set(key, vector.tobytes(), ex=self.ttl_seconds)
+        except Exception as e:
+            logger.warning("Embedding cache write failed: %s", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {
+                "size": len(self._lru),
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "miss_ms": self.miss_ms,
+            }
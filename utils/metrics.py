@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Any
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    parts = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{parts}}}"
+
+
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return float(ordered[idx])
+
+
+class Metrics:
+    """
+    A tiny in-process metrics registry.
+    - Counters and gauges are plain numbers keyed by name + labels.
+    - Observations keep the most recent `window` samples for percentiles.
+    - Collectors are callables polled at snapshot time (e.g. breaker state).
+    """
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._samples: Dict[str, deque] = {}
+        self._collectors: Dict[str, Callable[[], Any]] = {}
+
+    def incr(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[_key(name, labels)] += value
+
+    def gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the wall time (ms) of the wrapped block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000.0, **labels)
+
+    def register_collector(self, name: str, fn: Callable[[], Any]):
+        with self._lock:
+            self._collectors[name] = fn
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            samples = {k: list(v) for k, v in self._samples.items()}
+            collectors = dict(self._collectors)
+
+        summaries = {
+            k: {
+                "count": len(v),
+                "p50": percentile(v, 50),
+                "p95": percentile(v, 95),
+                "p99": percentile(v, 99),
+            }
+            for k, v in samples.items()
+        }
+        collected = {}
+        for name, fn in collectors.items():
+            try:
+                collected[name] = fn()
+            except Exception as e:
+                collected[name] = {"error": str(e)}
+
+        return {"counters": counters, "gauges": gauges, "summaries": summaries, "collectors": collected}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._samples.clear()
+
+
+# Process-wide registry
+metrics = Metrics()
@@ -20,6 +20,12 @@ class MongoDB:
             cls._db = cls._client[MONGODB_DB]
         return cls._db
 
+    @classmethod
+    def reset(cls):
+        """Forget the client without closing it (e.g. in a forked worker); the next use reconnects."""
+        cls._client = None
+        cls._db = None
+
     @classmethod
     def get_client(cls):
         """Get the MongoDB client."""
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("handlers")
+
+
+class _Entry:
+    """The speculative computation for one user's latest input."""
+    __slots__ = ("key", "future", "started")
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+        self.started = time.perf_counter()
+
+
+class Prefetcher:
+    """
+    Per-user speculative computation of `compute_fn(key)` on a bounded pool.
+    - submit(): start work for the user's latest key; a different key supersedes
+      the previous one (cancelled if still queued, its result ignored if running).
+    - take(): claim the result for `key`, waiting at most `wait_seconds` for it;
+      None when nothing matching was prefetched, so the caller computes inline.
+    An entry nobody claimed within `ttl_seconds` (its flush failed or never came)
+    is dropped by the next submit / take / pending call.
+    `on_discard(result, reason)` is told about every result that was computed but
+    never claimed (superseded, stale, timeout or expired), e.g. to account for its cost.
+    """
+
+    def __init__(self, compute_fn, name: str, workers: int = 4, wait_seconds: float = 2.0, on_discard=None,
+                 ttl_seconds: float = 60.0):
+        self.compute_fn = compute_fn
+        self.name = name
+        self.wait_seconds = wait_seconds
+        self.on_discard = on_discard
+        self.ttl_seconds = ttl_seconds
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"prefetch-{name}")
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _drop(self, entry, reason: str) -> None:
+        if entry.future.cancel() or self.on_discard is None:
+            return
+
+        def discarded(future):
+            if not future.cancelled() and future.exception() is None:
+                self.on_discard(future.result(), reason)
+
+        entry.future.add_done_callback(discarded)
+
+    def _expire(self) -> None:
+        """Drop entries older than ttl_seconds; call with the lock held."""
+        cutoff = time.perf_counter() - self.ttl_seconds
+        for user_id in [u for u, entry in self._entries.items() if entry.started < cutoff]:
+            self._drop(self._entries.pop(user_id), "expired")
+            metrics.incr("prefetch.expired", kind=self.name)
+
+    def submit(self, user_id, key, *args) -> None:
+        """Start compute_fn(key, *args) for the user unless `key` is already in flight."""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.key == key:
+                return
+            if entry is not None:
+                self._drop(entry, "superseded")
+                metrics.incr("prefetch.superseded", kind=self.name)
+            self._entries[user_id] = _Entry(key, self._pool.submit(self.compute_fn, key, *args))
+        metrics.incr("prefetch.submitted", kind=self.name)
+
+    def discard(self, user_id) -> None:
+        """Abandon the user's speculation, e.g. because more input arrived."""
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._drop(entry, "superseded")
+            metrics.incr("prefetch.superseded", kind=self.name)
+
+    def take(self, user_id, key):
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(user_id, None)
+        if entry is None or entry.key != key:
+            if entry is not None:
+                self._drop(entry, "stale")
+            metrics.incr("prefetch.misses", kind=self.name, reason="absent" if entry is None else "stale")
+            return None
+
+        state = "ready" if entry.future.done() else "waited"
+        start = time.perf_counter()
+        try:
+            result = entry.future.result(timeout=self.wait_seconds)
+        except (FutureTimeout, CancelledError):
+            self._drop(entry, "timeout")
+            metrics.incr("prefetch.misses", kind=self.name, reason="timeout")
+            return None
+        except Exception as e:
+            logger.warning("Prefetch %s for %s failed: %s", self.name, user_id, e)
+            metrics.incr("prefetch.misses", kind=self.name, reason="error")
+            return None
+        metrics.incr("prefetch.hits", kind=self.name, state=state)
+        metrics.observe("prefetch.wait_ms", (time.perf_counter() - start) * 1000.0, kind=self.name)
+        # Lead time: how long before the caller needed it the work started
+        metrics.observe("prefetch.lead_ms", (start - entry.started) * 1000.0, kind=self.name)
+        return result
+
+    def pending(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._entries)
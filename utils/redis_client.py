@@ -1,38 +1,173 @@
-import redis
+"""
+Process-wide Redis client on an explicitly sized, instrumented connection pool.
+
+Host and credentials come from the environment (REDIS_HOST, REDIS_PORT,
+REDIS_DB, REDIS_PASSWORD, REDIS_DECODE_RESPONSES); pool size, timeouts, health
+checks, retries and the reply parser from utils.config.redis_pool. Nothing
+connects until the first command.
+
+Exposed through utils.metrics:
+- redis.pool_wait_ms: time to check out a connection (waiting for a free one,
+  or opening a new one).
+- redis.pool_exhausted: checkouts that gave up after `pool_timeout`.
+- redis.command_ms{command}: per-command latency (pipelines as PIPELINE / MULTI).
+- the "redis_pool" collector: max / created / in use / peak in use.
+"""
+import logging
 import os
+import threading
+import time
+
+import redis
+from redis.backoff import EqualJitterBackoff
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+from redis.utils import HIREDIS_AVAILABLE
+
+from utils.config import redis_pool as pool_config
+from utils.metrics import metrics
+
+logger = logging.getLogger("handlers")
+
+
+class InstrumentedPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool that records checkout waits and connections in use."""
+
+    def reset(self):
+        # Also runs from __init__ and in a forked child
+        super().reset()
+        self._usage_lock = threading.Lock()
+        self._checked_out = set()
+        self.peak_in_use = 0
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except ConnectionError as e:
+            if "No connection available" in str(e):
+                metrics.incr("redis.pool_exhausted")
+            raise
+        finally:
+            # Includes opening the socket when the pool had to create the connection
+            metrics.observe("redis.pool_wait_ms", (time.perf_counter() - start) * 1000.0)
+        with self._usage_lock:
+            self._checked_out.add(id(connection))
+            self.peak_in_use = max(self.peak_in_use, len(self._checked_out))
+        return connection
+
+    def release(self, connection):
+        with self._usage_lock:
+            self._checked_out.discard(id(connection))
+        super().release(connection)
+
+    @property
+    def in_use(self) -> int:
+        return len(self._checked_out)
+
+    def stats(self) -> dict:
+        return {
+            "max_connections": self.max_connections,
+            "created": len(self._connections),
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+        }
+
+
+def _command_name(args) -> str:
+    return str(args[0]).upper() if args else "?"
+
+
+class InstrumentedPipeline(Pipeline):
+    def immediate_execute_command(self, *args, **options):
+        with metrics.timer("redis.command_ms", command=_command_name(args)):
+            return super().immediate_execute_command(*args, **options)
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super().execute(raise_on_error)
+        with metrics.timer("redis.command_ms", command="MULTI" if self.transaction else "PIPELINE"):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """redis.Redis timing every command by name."""
+
+    def execute_command(self, *args, **options):
+        with metrics.timer("redis.command_ms", command=_command_name(args)):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _parser_class(parser: str):
+    """Reply parser for `parser` (auto | hiredis | python); hiredis is optional."""
+    from redis._parsers import _HiredisParser, _RESP2Parser
+
+    if parser == "python":
+        return _RESP2Parser
+    if HIREDIS_AVAILABLE:
+        return _HiredisParser
+    if parser == "hiredis":
+        logger.warning("hiredis requested but not installed; using the pure-Python Redis parser")
+    return _RESP2Parser
+
+
+def make_client(host="localhost", port=6379, db=0, password=None, decode_responses=True,
+                settings=None, **connection_kwargs) -> InstrumentedRedis:
+    """Build a client on its own InstrumentedPool. `connection_kwargs` reach each connection."""
+    settings = {**pool_config, **(settings or {})}
+    retry_on = (ConnectionError, TimeoutError) if settings["retry_on_timeout"] else (ConnectionError,)
+    pool = InstrumentedPool(
+        max_connections=settings["max_connections"],
+        timeout=settings["pool_timeout"],
+        host=host,
+        port=port,
+        db=db,
+        password=password,
+        decode_responses=decode_responses,
+        socket_connect_timeout=settings["socket_connect_timeout"],
+        socket_timeout=settings["socket_timeout"],
+        socket_keepalive=True,
+        health_check_interval=settings["health_check_interval"],
+        retry=Retry(EqualJitterBackoff(settings["backoff_cap"], settings["backoff_base"]),
+                    settings["retries"], supported_errors=retry_on),
+        parser_class=_parser_class(settings["parser"]),
+        **connection_kwargs,
+    )
+    return InstrumentedRedis(connection_pool=pool)
+
 
 class RedisClient:
     _instance = None
+    _lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(RedisClient, cls).__new__(cls)
-            cls._instance._connect()
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super(RedisClient, cls).__new__(cls)
+                    instance._connect()
+                    cls._instance = instance
         return cls._instance
 
     def _connect(self):
         """
-        Initialize Redis connection.
-        Reads configuration from environment variables for security.
+        Configure the shared client. Reads configuration from environment variables
+        for security; no connection is opened here.
         """
         self.host = os.getenv("REDIS_HOST", "localhost")
         self.port = int(os.getenv("REDIS_PORT", 6379))
+        self.db = int(os.getenv("REDIS_DB", 0))
         self.password = os.getenv("REDIS_PASSWORD", None)
-        self.decode_responses = os.getenv("REDIS_DECODE_RESPONSES", "true").lower() == "true"
+        self.decode_responses = os.getenv("REDIS_DECODE_RESPONSES", "true").lower() in ("true", "1")
 
-        self.client = redis.Redis(
-            host=self.host,
-            port=self.port,
-            password=self.password,
-            decode_responses=self.decode_responses  
-        )
-
-        # Test connection
-        try:
-            if self.client.ping():
-                print(f"Connected to Redis at {self.host}:{self.port}")
-        except redis.ConnectionError as e:
-            print(f"Redis connection failed: {e}")
+        self.client = make_client(self.host, self.port, self.db, self.password, self.decode_responses)
+        metrics.register_collector("redis_pool", self.client.connection_pool.stats)
+        logger.info(f"Redis client for {self.host}:{self.port}/{self.db} "
+                    f"(pool of {self.client.connection_pool.max_connections})")
 
     def get_client(self):
         return self.client
@@ -0,0 +1,323 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional, Tuple, Type
+
+import openai
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("resilience")
+
+# HTTP statuses worth retrying: timeouts, conflicts, throttling and server errors
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+# Connection-level OpenAI errors carry no status code but are worth retrying
+OPENAI_TRANSIENT = tuple(getattr(openai, name) for name in ("APIConnectionError",) if hasattr(openai, name))
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the dependency while its breaker is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} unavailable (circuit open, retry in {retry_in:.1f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3         # total attempts, including the first call
+    base_delay: float = 0.25      # seconds, first backoff ceiling
+    max_delay: float = 4.0        # seconds, backoff ceiling cap
+    max_retry_after: float = 10.0 # give up instead of honouring a longer Retry-After
+
+
+class CircuitBreaker:
+    """
+    Per-dependency circuit breaker.
+    - closed: calls flow; `failure_threshold` consecutive transient failures open it.
+    - open: calls fail fast until `reset_timeout` has passed.
+    - half_open: up to `half_open_max_calls` probes; a success closes, a failure re-opens.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def _maybe_half_open(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            logger.info("Circuit %s half-open", self.name)
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        """Return True if a call may proceed (reserving a probe slot when half-open)."""
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Circuit %s closed", self.name)
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_neutral(self):
+        """The call says nothing about the dependency's health: only give a probe slot back."""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened_total += 1
+                    logger.warning("Circuit %s opened after %d failure(s)", self.name, self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probes = 0
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "opened_total": self.opened_total,
+                "rejected_total": self.rejected_total,
+            }
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of recent calls so an outage can't multiply load.
+    Retries are allowed while retries < min_retries + ratio * calls over the window.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 3, window_seconds: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._retries = deque()
+
+    def _purge(self, now):
+        horizon = now - self.window_seconds
+        for q in (self._calls, self._retries):
+            while q and q[0] < horizon:
+                q.popleft()
+
+    def record_call(self):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            self._calls.append(now)
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            if len(self._retries) >= self.min_retries + self.ratio * len(self._calls):
+                return False
+            self._retries.append(now)
+            return True
+
+
+# Defaults per dependency; anything unlisted gets RetryPolicy() / CircuitBreaker defaults
+DEPENDENCY_POLICIES: Dict[str, RetryPolicy] = {
+    "whatsapp-graph": RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=4.0),
+    "openai-chat": RetryPolicy(max_attempts=3, base_delay=0.5, max_delay=8.0, max_retry_after=20.0),
+    "openai-embeddings": RetryPolicy(max_attempts=3, base_delay=0.25, max_delay=4.0),
+}
+
+_registry_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_budgets: Dict[str, RetryBudget] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def get_budget(name: str) -> RetryBudget:
+    with _registry_lock:
+        if name not in _budgets:
+            _budgets[name] = RetryBudget()
+        return _budgets[name]
+
+
+def breaker_states() -> dict:
+    """State of every known breaker, for the metrics endpoint."""
+    with _registry_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.stats() for b in breakers}
+
+
+def reset_breakers():
+    with _registry_lock:
+        _breakers.clear()
+        _budgets.clear()
+
+
+metrics.register_collector("circuit_breakers", breaker_states)
+
+
+def status_of(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds to wait from `retry-after-ms` / `Retry-After` headers, if the error carries any."""
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except (TypeError, ValueError):
+            pass
+
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(exc: BaseException, retry_on: Tuple[Type[BaseException], ...] = ()) -> bool:
+    """Throttling, server errors and connection-level failures are transient; other 4xx are not."""
+    if retry_on and isinstance(exc, retry_on):
+        return True
+    status = status_of(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return isinstance(exc, (OSError, TimeoutError))
+
+
+def backoff_delay(attempt: int, policy: RetryPolicy) -> float:
+    """Full-jitter exponential backoff for the given retry attempt (0-based)."""
+    ceiling = min(policy.max_delay, policy.base_delay * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def call_with_resilience(name: str, fn: Callable, *args,
+                         retry_on: Tuple[Type[BaseException], ...] = (),
+                         policy: Optional[RetryPolicy] = None,
+                         retry_if: Optional[Callable[[BaseException], bool]] = None, **kwargs):
+    """
+    Call `fn(*args, **kwargs)` behind the `name` breaker.
+    - Fails fast with CircuitOpenError while the breaker is open.
+    - Retries transient failures with jittered backoff, honouring Retry-After,
+      while attempts and the dependency's retry budget allow.
+    - `retry_if` narrows which transient failures are retried, for calls that are
+      not safe to repeat; every transient failure still counts against the breaker.
+    """
+    policy = policy or DEPENDENCY_POLICIES.get(name, RetryPolicy())
+    breaker = get_breaker(name)
+    budget = get_budget(name)
+    budget.record_call()
+
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            metrics.incr("resilience.fast_fail", dependency=name)
+            raise CircuitOpenError(name, breaker.retry_in())
+
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            metrics.observe("resilience.call_ms", (time.perf_counter() - start) * 1000.0, dependency=name)
+            if not is_transient(e, retry_on):
+                # The dependency answered; the request itself was bad
+                breaker.record_neutral()
+                raise
+
+            breaker.record_failure()
+            metrics.incr("resilience.failures", dependency=name)
+            if retry_if is not None and not retry_if(e):
+                raise
+            attempt += 1
+            if attempt >= policy.max_attempts:
+                raise
+
+            delay = backoff_delay(attempt - 1, policy)
+            retry_after = parse_retry_after(e)
+            if retry_after is not None:
+                if retry_after > policy.max_retry_after:
+                    logger.warning("%s asked to retry after %.1fs; giving up", name, retry_after)
+                    raise
+                delay = max(delay, retry_after)
+
+            if not budget.try_spend():
+                metrics.incr("resilience.budget_exhausted", dependency=name)
+                logger.warning("%s retry budget exhausted; not retrying", name)
+                raise
+
+            metrics.incr("resilience.retries", dependency=name)
+            logger.info("%s transient failure (%s); retry %d in %.2fs", name, e, attempt, delay)
+            time.sleep(delay)
+            continue
+
+        metrics.observe("resilience.call_ms", (time.perf_counter() - start) * 1000.0, dependency=name)
+        breaker.record_success()
+        return result
@@ -0,0 +1,153 @@
+"""
+Prompt token attribution by segment.
+
+Each LLM turn records how many prompt tokens went to the transcript history,
+the stage prompt, tool instructions, long-term memory and retrieved knowledge (RAG)
+context, so we know what to cut first.
+The counts always go to utils.metrics; the JSONL log is opt-in (token_profile["path"]),
+holds no user identifiers, and is written and rotated by a background thread.
+
+    python -m utils.token_profile [records.jsonl] [--stage Tools]
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from logging.handlers import QueueListener, RotatingFileHandler
+
+from utils.config import token_profile
+from utils.metrics import metrics, percentile
+from utils.tokens import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_tokens
+
+logger = logging.getLogger("handlers")
+
+SEGMENT_STAGE = "stage_prompt"
+SEGMENT_TOOL = "tool_instructions"
+SEGMENT_HISTORY = "history"
+SEGMENT_MEMORY = "long_term_memory"
+SEGMENT_RAG = "rag_context"
+# Per-message and reply-priming overhead of the chat format
+SEGMENT_FRAMING = "framing"
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def segment_tokens(segments, model: str = "gpt-4o-mini") -> dict:
+    """Token count per segment for (segment, message) pairs; counts come from the shared cache."""
+    counts = defaultdict(int)
+    counts[SEGMENT_FRAMING] = TOKENS_PER_REPLY
+    for segment, message in segments:
+        counts[segment] += count_tokens(message.get("content") or "", model)
+        counts[SEGMENT_FRAMING] += TOKENS_PER_MESSAGE
+    return dict(counts)
+
+
+def _writer(path):
+    """Queue for `path`, drained by a listener thread into a rotating file; None if it can't be opened."""
+    with _writers_lock:
+        if path not in _writers:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                handler = RotatingFileHandler(path, maxBytes=token_profile["max_bytes"],
+                                              backupCount=token_profile["backups"], encoding="utf-8")
+            except OSError as e:
+                logger.warning("Token profile log %s unavailable: %s", path, e)
+                _writers[path] = None
+            else:
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                records = queue.SimpleQueue()
+                listener = QueueListener(records, handler)
+                listener.start()
+                _writers[path] = (records, listener)
+        return _writers[path]
+
+
+def flush_profiles():
+    """Write out everything queued and close the files (tests, shutdown)."""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        if writer is not None:
+            writer[1].stop()
+            for handler in writer[1].handlers:
+                handler.close()
+
+
+def record_prompt_profile(stage, model, segments, path=None) -> dict:
+    """Export per-segment prompt tokens as metrics and queue one record for the profile log."""
+    counts = segment_tokens(segments, model)
+    for segment, tokens in counts.items():
+        metrics.observe("prompt.segment_tokens", tokens, stage=stage, segment=segment)
+
+    path = token_profile["path"] if path is None else path
+    writer = _writer(path) if path else None
+    if writer is not None:
+        record = {"ts": int(time.time()), "stage": stage, "model": model,
+                  "segments": counts, "total": sum(counts.values())}
+        writer[0].put_nowait(logging.makeLogRecord({"msg": json.dumps(record), "levelno": logging.INFO}))
+    return counts
+
+
+def load_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def summarize(records, stage=None) -> list:
+    """
+    Percentile breakdown per (stage, segment), largest total first.
+    A segment missing from a record counts as 0 tokens for that turn.
+    """
+    by_stage = defaultdict(list)
+    for r in records:
+        if stage is None or r.get("stage") == stage:
+            by_stage[r.get("stage")].append(r)
+
+    rows = []
+    for stage_name, stage_records in by_stage.items():
+        turn_totals = sum(r.get("total", 0) for r in stage_records) or 1
+        segments = {s for r in stage_records for s in r.get("segments", {})}
+        for segment in segments:
+            values = [r.get("segments", {}).get(segment, 0) for r in stage_records]
+            rows.append({
+                "stage": stage_name,
+                "segment": segment,
+                "turns": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "total": sum(values),
+                "share": sum(values) / turn_totals,
+            })
+    rows.sort(key=lambda row: row["total"], reverse=True)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prompt token breakdown by segment")
+    parser.add_argument("path", nargs="?", default=token_profile["path"])
+    parser.add_argument("--stage", default=None)
+    args = parser.parse_args(argv)
+
+    rows = summarize(load_records(args.path), args.stage)
+    if not rows:
+        print(f"no records in {args.path}")
+        return
+    print(f"{'stage':<12} {'segment':<18} {'turns':>6} {'p50':>6} {'p95':>6} {'p99':>6} {'share':>6}")
+    for row in rows:
+        print(f"{row['stage']!s:<12} {row['segment']:<18} {row['turns']:>6} {row['p50']:>6.0f} "
+              f"{row['p95']:>6.0f} {row['p99']:>6.0f} {row['share']:>6.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import logging
+import math
+from functools import lru_cache
+
+import tiktoken
+
+logger = logging.getLogger("handlers")
+
+DEFAULT_ENCODING = "o200k_base"
+# OpenAI chat framing: every message costs a few tokens, and the reply is primed with 3
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning("tiktoken encoding for %s unavailable (%s); using estimate", model, e)
+        return None
+    try:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning("tiktoken %s unavailable (%s); using estimate", DEFAULT_ENCODING, e)
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Local token count for `text`; ~4 chars/token when the BPE files can't be loaded."""
+    if not text:
+        return 0
+    enc = _encoding(model)
+    if enc is None:
+        return math.ceil(len(text) / 4)
+    return len(enc.encode(text))
+
+
+def estimate_prompt_tokens(messages, model: str = "gpt-4o-mini") -> int:
+    """Estimate prompt tokens for a chat completion request, including message framing."""
+    total = TOKENS_PER_REPLY
+    for m in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(m.get("content") or "", model)
+        if m.get("name"):
+            total += 1 + count_tokens(m["name"], model)
+    return total